@@ -1,6 +1,8 @@
 """ Common methods and functions for command-line python tools """
+import json
 import argparse
-import requests
+import itertools
+import utils.httpsession
 
 
 # Script constants
@@ -58,9 +60,60 @@ def get_imap_orgs(ocl_env_url, ocl_api_token, period_filter='', country_code_fil
     if ocl_api_token:
         ocl_api_headers['Authorization'] = 'Token ' + ocl_api_token
     url_all_orgs = '%s/orgs/' % ocl_env_url
-    response = requests.get(url_all_orgs, headers=ocl_api_headers, params=request_params)
+    response = utils.httpsession.get_session().get(url_all_orgs, headers=ocl_api_headers, params=request_params)
     if verbose:
         print response.url
     response.raise_for_status()
     ocl_all_orgs = response.json()
     return ocl_all_orgs
+
+
+def write_imap_backup_line(output_file, imap_backup):
+    """
+    Writes one IMAP backup to an NDJSON backup file (one JSON object per line) and flushes it,
+    so that every completed IMAP is saved even if the backup does not finish
+    """
+    output_file.write(json.dumps(imap_backup) + '\n')
+    output_file.flush()
+
+
+def iter_imap_backups(input_file):
+    """
+    Generator that reads IMAP backups one at a time from a backup file. Supports both NDJSON
+    backups (one JSON object per line) and the original format of a single JSON array. Lines of an
+    NDJSON backup that cannot be parsed (eg the last line of an interrupted backup) are skipped.
+    """
+    first_char = ''
+    while not first_char:
+        first_char = input_file.read(1)
+        if not first_char:
+            return
+        if first_char.isspace():
+            first_char = ''
+    if first_char == '[':
+        for imap_backup in json.loads(first_char + input_file.read()):
+            yield imap_backup
+        return
+    for line in itertools.chain([first_char + input_file.readline()], input_file):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+
+def get_imap_backup_country_orgs(backup_filename, status_filter=None):
+    """
+    Returns set of country orgs in an IMAP backup file, optionally only those with a matching
+    status (eg "Success"). Returns an empty set if the file does not exist.
+    """
+    country_orgs = set()
+    try:
+        with open(backup_filename, 'rb') as input_file:
+            for imap_backup in iter_imap_backups(input_file):
+                if not status_filter or imap_backup.get('status') in status_filter:
+                    country_orgs.add(imap_backup.get('country_org'))
+    except IOError:
+        pass
+    return country_orgs
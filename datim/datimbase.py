@@ -12,13 +12,21 @@ import zipfile
 import time
 import datetime
 import json
+import shutil
+import hashlib
 from StringIO import StringIO
-import requests
-import grequests
+import gevent
+import gevent.monkey
+import gevent.pool
 import settings
 import ocldev.oclconstants
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+import utils.httpsession
+import utils.adaptiveconcurrency
+import utils.oclexportcache
+import utils.jsonstream
+
+# Use cooperative sockets so that concurrent OCL and DHIS2 requests run in parallel greenlets
+gevent.monkey.patch_all(thread=False, select=False)
 
 
 class DatimBase(object):
@@ -97,6 +105,17 @@ class DatimBase(object):
     DATIM_DEFAULT_DISAG_ID = 'HllvX50cXC0'
     DATIM_DEFAULT_DISAG_REPLACEMENT_NAME = 'Total'
 
+    # Maximum number of OCL exports that are retrieved concurrently by get_ocl_exports
+    DEFAULT_OCL_EXPORT_MAX_WORKERS = 4
+
+    # Adaptive concurrency settings for get_ocl_exports_async. The maximum is kept within the per-host
+    # connection limit of the shared HTTP session (utils.httpsession.DEFAULT_POOL_MAXSIZE), since
+    # connections beyond the pool size are opened and then discarded instead of being reused.
+    DEFAULT_OCL_EXPORT_ASYNC_INITIAL_CONCURRENCY = 2
+    DEFAULT_OCL_EXPORT_ASYNC_MAX_CONCURRENCY = utils.httpsession.DEFAULT_POOL_MAXSIZE
+    OCL_EXPORT_ASYNC_MAX_ATTEMPTS = 5
+    OCL_EXPORT_ASYNC_CAPACITY_POLL_SECONDS = 0.1
+
     # Location to save temporary data files
     # NOTE: File system permissions must be set for this project to read/write from this subfolder
     DATA_SUBFOLDER_NAME = 'data'
@@ -121,6 +140,29 @@ class DatimBase(object):
         self.str_active_dataset_ids = ''
         self.run_ocl_offline = False
         self.datim_moh_source_id = ''
+        self.ocl_export_max_workers = self.DEFAULT_OCL_EXPORT_MAX_WORKERS
+        self.ocl_export_async_initial_concurrency = self.DEFAULT_OCL_EXPORT_ASYNC_INITIAL_CONCURRENCY
+        self.ocl_export_async_max_concurrency = self.DEFAULT_OCL_EXPORT_ASYNC_MAX_CONCURRENCY
+        # Parse large OCL and DHIS2 exports incrementally (see utils.jsonstream) instead of
+        # loading each export into memory in full. Can also be enabled with STREAM_JSON_EXPORTS in settings.
+        self.stream_json_exports = getattr(settings, 'STREAM_JSON_EXPORTS', False)
+
+    @staticmethod
+    def get_http_session():
+        """
+        Returns the shared pooled HTTP session used for all OCL and DHIS2 requests. Connections
+        are kept alive and reused, and requests have a default timeout and retry with backoff.
+        :return: <utils.httpsession.PooledSession>
+        """
+        return utils.httpsession.get_session()
+
+    @staticmethod
+    def get_ocl_export_cache():
+        """
+        Returns the shared on-disk cache of compressed OCL repository version exports
+        :return: <utils.oclexportcache.OclExportCache>
+        """
+        return utils.oclexportcache.get_cache()
 
     def vlog(self, verbose_level=0, *args):
         """
@@ -169,6 +211,25 @@ class DatimBase(object):
     def endpoint2filename_ocl_export_cleaned(endpoint):
         return 'ocl-%s-cleaned.json' % DatimBase._convert_endpoint_to_filename_fmt(endpoint)
 
+    @staticmethod
+    def endpoint2filename_ocl_index(endpoint, repo_version_id):
+        # The endpoint digest keeps the names of other repos' indexes from matching a glob on repo_version_id
+        return 'ocl-%s-%s-%s-index.pickle' % (
+            DatimBase._convert_endpoint_to_filename_fmt(endpoint), hashlib.sha1(endpoint).hexdigest()[:8],
+            repo_version_id)
+
+    @staticmethod
+    def endpoint2filename_ocl_concept_index(endpoint, repo_version_id):
+        # The endpoint digest keeps the names of other repos' indexes from matching a glob on repo_version_id
+        return 'ocl-%s-%s-%s-concepts.pickle' % (
+            DatimBase._convert_endpoint_to_filename_fmt(endpoint), hashlib.sha1(endpoint).hexdigest()[:8],
+            repo_version_id)
+
+    @staticmethod
+    def endpoint2filename_ocl_export_rendered(endpoint, repo_version_id, render_key, export_format):
+        return 'ocl-%s-%s-%s-rendered.%s' % (
+            DatimBase._convert_endpoint_to_filename_fmt(endpoint), repo_version_id, render_key, export_format)
+
     @staticmethod
     def dhis2filename_export_new(dhis2_query_id):
         return 'dhis2-%s-export-new-raw.json' % dhis2_query_id
@@ -181,6 +242,10 @@ class DatimBase(object):
     def dhis2filename_export_converted(dhis2_query_id):
         return 'dhis2-%s-export-converted.json' % dhis2_query_id
 
+    @staticmethod
+    def filename_fingerprints(diff_filename):
+        return '%s-fingerprints.json' % os.path.splitext(diff_filename)[0]
+
     @staticmethod
     def filename_diff_result(import_batch_name):
         return '%s-diff-results-%s.json' % (
@@ -249,7 +314,7 @@ class DatimBase(object):
         filtered_repos = {}
         next_url = self.oclenv + endpoint
         while next_url:
-            response = requests.get(
+            response = DatimBase.get_http_session().get(
                 next_url, headers=self.oclapiheaders, params={"limit": str(limit)})
             self.vlog(2, "Fetching repositories for '%s' from OCL: %s" % (endpoint, response.url))
             response.raise_for_status()
@@ -357,20 +422,43 @@ class DatimBase(object):
             new_repo_version_url = self.oclenv + repo_version_endpoint
             self.vlog(1, 'Create new repo version request URL:', new_repo_version_url)
             self.vlog(1, json.dumps(new_repo_version_data))
-            r = requests.post(new_repo_version_url,
-                              data=json.dumps(new_repo_version_data),
-                              headers=self.oclapiheaders)
+            r = DatimBase.get_http_session().post(new_repo_version_url,
+                                                  data=json.dumps(new_repo_version_data),
+                                                  headers=self.oclapiheaders)
             r.raise_for_status()
             repo_version_endpoint = str(ocl_export_def['endpoint']) + str(new_repo_version_data['id']) + '/'
             self.vlog(1, '[OCL Export %s of %s] %s: Created new repository version "%s"' % (
                 cnt, len(self.OCL_EXPORT_DEFS), ocl_export_key, repo_version_endpoint))
 
-    def get_ocl_exports_async(self, endpoint='', period='', version=''):
+    def get_ocl_export_async_limiter(self, max_concurrency=None):
         """
-        Retrieves all matching exports at the specified 'collections' or 'sources' endpoint
+        Returns a new concurrency limiter for get_ocl_exports_async. Pass the same limiter to concurrent
+        calls so that they share one request budget and back off together.
+        :param max_concurrency: Maximum concurrent requests; defaults to ocl_export_async_max_concurrency.
+            Capped at the per-host connection limit of the shared HTTP session.
+        :return: <utils.adaptiveconcurrency.AdaptiveConcurrency>
+        """
+        return utils.adaptiveconcurrency.AdaptiveConcurrency(
+            initial=self.ocl_export_async_initial_concurrency,
+            maximum=min(max_concurrency or self.ocl_export_async_max_concurrency,
+                        utils.httpsession.DEFAULT_POOL_MAXSIZE))
+
+    def get_ocl_exports_async(self, endpoint='', period='', version='', max_concurrency=None,
+                              delay_seconds=10, max_wait_seconds=120, limiter=None):
+        """
+        Retrieves all matching exports at the specified 'collections' or 'sources' endpoint.
+        Exports are downloaded concurrently. The number of concurrent requests starts at
+        ocl_export_async_initial_concurrency, grows while latency is stable and backs off when
+        OCL throttles (429) or fails (5xx). Exports that are not yet cached are generated in the
+        background and polled while the remaining exports continue downloading.
         :param endpoint: e.g. /orgs/DATIM-MOH-UA-FY19/collections/
         :param period: e.g. FY18, FY19
         :param version: Required, and does not support "latest" (e.g. v2, v3)
+        :param max_concurrency: Maximum concurrent requests; defaults to ocl_export_async_max_concurrency.
+            Capped at the per-host connection limit of the shared HTTP session. Ignored if limiter is passed.
+        :param delay_seconds: Seconds between polls of an export that is being generated
+        :param max_wait_seconds: Maximum seconds to wait for an export to be generated
+        :param limiter: (Optional) Limiter shared with concurrent calls (see get_ocl_export_async_limiter)
         :return: <dict> repository_version_url: repository_version_export
         """
 
@@ -386,57 +474,114 @@ class DatimBase(object):
             self.vlog(1, 'Export URL:', url_ocl_export)
             export_urls.append(url_ocl_export)
 
-        # Define exception handler for async requests
-        def export_exception_handler(request, exception):
-            print('Request failed:', str(request), str(exception))
-
-        # Submit sync export requests with auto-retry in case of connection pooling errors
-        s = requests.Session()
-        retries = Retry(total=5, backoff_factor=0.2)
-        s.mount('http://', HTTPAdapter(max_retries=retries))
-        s.mount('https://', HTTPAdapter(max_retries=retries))
-        export_rs = (
-            grequests.get(url, headers=self.oclapiheaders, session=s) for url in export_urls)
-        export_responses = grequests.map(
-            export_rs, size=2, exception_handler=export_exception_handler)
-        self.vlog(1, 'Results of async query:\n%s' % export_responses)
-
-        # Process collection export results
+        # Download exports with adaptive concurrency, sharing the limiter of the caller if one is passed
+        limiter = limiter or self.get_ocl_export_async_limiter(max_concurrency=max_concurrency)
+        export_cache = DatimBase.get_ocl_export_cache()
+        export_queue = []
+        export_attempts = {}
+        pending_exports = {}  # export_url: time of next poll
+        generating_exports = {}  # export_url: time that export generation was requested
+        active_requests = {}  # greenlet: export_url
         collection_results = {}
-        for export_response in export_responses:
-            if export_response is None:
-                self.vlog(1, 'WARNING: Export value is None')
-                continue
-            original_export_url = export_response.url
-            if export_response.history and export_response.history[0] and export_response.history[0].url:
-                original_export_url = export_response.history[0].url
-            if export_response.status_code == 404:
-                # Repository version does not exist, so we can safely skip this one
-                self.vlog(1, '[%s NOT FOUND] %s -- Current IMAP %s has no mapping for this data element, so we can safely skip' % (
-                    export_response.status_code, export_response.url, country_version_id))
-                continue
-            elif export_response.status_code == 204:
-                # Export not cached for this repository version, so we need to generate it first
-                self.vlog(1, '[%s MISSING EXPORT] %s -- Export not yet cached. Generating...' % (
-                    export_response.status_code, export_response.url))
-                export_response = self.generate_repository_version_export(original_export_url)
+
+        # Exports of released repository versions are read from the cache -- all others are downloaded
+        for export_url in export_urls:
+            cached_content = export_cache.get_trusted(export_url, headers=self.oclapiheaders)
+            if cached_content is not None:
+                self.vlog(2, '[CACHED] %s' % export_url)
+                collection_results[export_url] = DatimBase.parse_ocl_export_content(
+                    cached_content, export_name=export_url)
             else:
-                export_response.raise_for_status()
-
-            if export_response.status_code == 200:
-                # Cached export successfully retrieved for this repository version
-                self.vlog(2, '[%s FOUND] %s' % (export_response.status_code, original_export_url))
-                export_string_handle = StringIO(export_response.content)
-                zipref = zipfile.ZipFile(export_string_handle, "r")
-                if 'export.json' in zipref.namelist():
-                    collection_results[original_export_url] = json.loads(zipref.read('export.json'))
-                    zipref.close()
-                else:
-                    zipref.close()
-                    errmsg = 'ERROR: Invalid export for "%s": export.json not found.' % (
-                        original_export_url)
-                    self.vlog(1, errmsg)
-                    raise Exception(errmsg)
+                export_queue.append(export_url)
+
+        def fetch_export(url):
+            start_time = time.time()
+            try:
+                response = DatimBase.get_http_session().get(url, headers=self.oclapiheaders)
+            except Exception as e:
+                print('Request failed:', url, str(e))
+                return None, time.time() - start_time
+            return response, time.time() - start_time
+
+        try:
+            while export_queue or pending_exports or active_requests:
+                # Queue exports being generated that are due to be polled again
+                now = time.time()
+                for export_url, next_poll_time in pending_exports.items():
+                    if next_poll_time <= now:
+                        del pending_exports[export_url]
+                        export_queue.append(export_url)
+
+                # Start requests up to the current concurrency limit
+                while export_queue and limiter.has_capacity():
+                    export_url = export_queue.pop(0)
+                    export_attempts[export_url] = export_attempts.get(export_url, 0) + 1
+                    limiter.acquire()
+                    active_requests[gevent.spawn(fetch_export, export_url)] = export_url
+                if not active_requests:
+                    if export_queue:
+                        # The shared limit is in use by other callers -- wait for a request to finish
+                        gevent.sleep(self.OCL_EXPORT_ASYNC_CAPACITY_POLL_SECONDS)
+                    else:
+                        gevent.sleep(max(min(pending_exports.values()) - time.time(), 0))
+                    continue
+
+                # Process whichever requests finish first
+                for finished_request in gevent.wait(active_requests.keys(), count=1):
+                    export_url = active_requests.pop(finished_request)
+                    limiter.release()
+                    export_response, elapsed_seconds = finished_request.get()
+                    if export_response is None:
+                        self.vlog(1, 'WARNING: Export value is None')
+                        continue
+
+                    # Adjust concurrency, including for throttled attempts retried by the HTTP session
+                    limiter.record(export_response.status_code, elapsed_seconds)
+                    retries = getattr(export_response.raw, 'retries', None)
+                    if retries and any(h.status and limiter.is_overloaded(h.status) for h in retries.history):
+                        limiter.backoff()
+
+                    if export_response.status_code == 404:
+                        # Repository version does not exist, so we can safely skip this one
+                        self.vlog(1, '[%s NOT FOUND] %s -- Current IMAP %s has no mapping for this data element, so we can safely skip' % (
+                            export_response.status_code, export_url, country_version_id))
+                        continue
+                    elif export_response.status_code == 204:
+                        # Export not cached for this repository version, so generate it and poll in the background
+                        if export_url not in generating_exports:
+                            self.vlog(1, '[%s MISSING EXPORT] %s -- Export not yet cached. Generating...' % (
+                                export_response.status_code, export_url))
+                            self.generate_repository_version_export(export_url, do_wait_until_cached=False)
+                            generating_exports[export_url] = time.time()
+                        elif time.time() - generating_exports[export_url] + delay_seconds >= max_wait_seconds:
+                            msg = 'ERROR: Export taking too long to process: %s. Exiting...' % export_url
+                            self.vlog(1, msg)
+                            raise Exception(msg)
+                        pending_exports[export_url] = time.time() + delay_seconds
+                        continue
+                    elif (limiter.is_overloaded(export_response.status_code) and
+                            export_attempts[export_url] < self.OCL_EXPORT_ASYNC_MAX_ATTEMPTS):
+                        self.vlog(1, '[%s RETRY] %s -- Reducing concurrency to %s' % (
+                            export_response.status_code, export_url, limiter.limit))
+                        export_queue.append(export_url)
+                        continue
+                    export_response.raise_for_status()
+
+                    if export_response.status_code == 200:
+                        # Cached export successfully retrieved for this repository version
+                        self.vlog(2, '[%s FOUND] %s' % (export_response.status_code, export_url))
+                        collection_results[export_url] = DatimBase.parse_ocl_export_content(
+                            export_response.content, export_name=export_url)
+                        export_cache.put(
+                            export_url, export_response.content, etag=export_response.headers.get('ETag'),
+                            headers=self.oclapiheaders, session=DatimBase.get_http_session(),
+                            last_modified=export_response.headers.get('Last-Modified'))
+        finally:
+            # Cancel requests still in flight after an error and return their share of the limiter
+            for active_request in active_requests:
+                active_request.kill()
+                limiter.release()
+        self.vlog(2, 'Final export concurrency: %s (%s backoffs)' % (limiter.limit, limiter.num_backoffs))
         self.vlog(1, '%s repository exports for version "%s" retrieved at endpoint "%s"' % (
             len(collection_results), country_version_id, endpoint))
         return collection_results
@@ -455,53 +600,308 @@ class DatimBase(object):
         :param jsonfilename: Filename to save the decompressed OCL-JSON export to
         :return: bool True upon success; False otherwise
         """
+        content = self.get_ocl_export_content(
+            endpoint=endpoint, version=version, delay_seconds=delay_seconds, max_wait_seconds=max_wait_seconds)
+
+        # Write compressed export to file and decompress
+        self.save_ocl_export(content, zipfilename=zipfilename, jsonfilename=jsonfilename)
+
+        return True
+
+    def get_ocl_export_content(self, endpoint='', version='', delay_seconds=10, max_wait_seconds=120):
+        """
+        Returns the compressed export of the specified repository version, generating the export
+        in OCL if it is not already cached. Use version="latest" for the most recent released repo version.
+        :param endpoint: endpoint for repo only, e.g. '/orgs/myorg/sources/mysource/'
+        :param version: repo version ID or "latest"
+        :return: <str> compressed repository version export
+        """
         # Get the latest version of the repo
         if version == 'latest':
-            url_latest_version = self.oclenv + endpoint + 'latest/'
-            self.vlog(1, 'Latest version request URL:', url_latest_version)
-            response = requests.get(url_latest_version, headers=self.oclapiheaders)
-            response.raise_for_status()
-            latest_version_attr = response.json()
-            repo_version_id = latest_version_attr['id']
-            self.vlog(1, 'Latest version ID:', repo_version_id)
+            repo_version_id = self.get_latest_version_id(endpoint)
         else:
             repo_version_id = version
 
         # Get the export
         url_ocl_export = self.oclenv + endpoint + repo_version_id + '/export/'
         self.vlog(1, 'Export URL:', url_ocl_export)
-        r = requests.get(url_ocl_export, headers=self.oclapiheaders)
-        r.raise_for_status()
-        if r.status_code == 200:
+        status_code, content = DatimBase.get_ocl_export_cache().get_export_content(
+            url_ocl_export, headers=self.oclapiheaders, session=DatimBase.get_http_session())
+        if status_code == 200:
             # Export successfully retrieved
             pass
-        elif r.status_code == 204:
+        elif status_code == 204:
             # Export does not exist, so let's attempt to generate the export and retrieve it...
             self.vlog(
                 1, 'WARNING: Export does not exist for "%s". Creating export...' % url_ocl_export)
             r = self.generate_repository_version_export(
                 repo_export_url=url_ocl_export, delay_seconds=delay_seconds,
                 max_wait_seconds=max_wait_seconds)
+            content = r.content
+            DatimBase.get_ocl_export_cache().put(
+                url_ocl_export, content, etag=r.headers.get('ETag'), headers=self.oclapiheaders,
+                session=DatimBase.get_http_session(), last_modified=r.headers.get('Last-Modified'))
         else:
-            msg = 'ERROR: Unrecognized response from OCL: %s' % str(r.status_code)
+            msg = 'ERROR: Unrecognized response from OCL: %s' % str(status_code)
             self.vlog(1, msg)
             raise Exception(msg)
+        return content
+
+    def get_latest_version_id(self, endpoint=''):
+        """
+        Returns the ID of the most recent released version of the repository
+        :param endpoint: endpoint for repo only, e.g. '/orgs/myorg/sources/mysource/'
+        :return: <str> repo version ID, e.g. "v1.0"
+        """
+        url_latest_version = self.oclenv + endpoint + 'latest/'
+        self.vlog(1, 'Latest version request URL:', url_latest_version)
+        response = DatimBase.get_http_session().get(url_latest_version, headers=self.oclapiheaders)
+        response.raise_for_status()
+        repo_version_id = response.json()['id']
+        self.vlog(1, 'Latest version ID:', repo_version_id)
+        return repo_version_id
+
+    def load_ocl_export(self, endpoint='', version='', zipfilename='', jsonfilename='',
+                        delay_seconds=10, max_wait_seconds=120):
+        """
+        Fetches an export of the specified repository version and returns the parsed export.json.
+        The export is decompressed and parsed in memory; if zipfilename is provided, only the
+        compressed export is saved to file. In offline mode, the export is loaded from jsonfilename
+        if it exists, otherwise from zipfilename.
+        :param endpoint: endpoint for repo only, e.g. '/orgs/myorg/sources/mysource/'
+        :param version: repo version ID or "latest"
+        :param zipfilename: Optional filename to save the compressed OCL export to
+        :param jsonfilename: Filename of a decompressed OCL-JSON export used in offline mode
+        :return: <dict> repository version export
+        """
+        if self.run_ocl_offline:
+            if jsonfilename and self.does_offline_data_file_exist(jsonfilename, exit_if_missing=False):
+                with open(self.attach_absolute_data_path(jsonfilename), 'rb') as input_file:
+                    return json.load(input_file)
+            self.does_offline_data_file_exist(zipfilename, exit_if_missing=True)
+            with open(self.attach_absolute_data_path(zipfilename), 'rb') as input_file:
+                return DatimBase.parse_ocl_export_content(input_file.read(), export_name=zipfilename)
+
+        content = self.get_ocl_export_content(
+            endpoint=endpoint, version=version, delay_seconds=delay_seconds, max_wait_seconds=max_wait_seconds)
+        if zipfilename:
+            with open(self.attach_absolute_data_path(zipfilename), 'wb') as handle:
+                handle.write(content)
+            self.vlog(1, '%s bytes saved to "%s"' % (len(content), zipfilename))
+        return DatimBase.parse_ocl_export_content(content, export_name=endpoint)
+
+    @staticmethod
+    def parse_ocl_export_content(content, export_name=''):
+        """
+        Decompresses export.json from a compressed OCL export in memory and returns it parsed
+        :param content: <str> compressed repository version export
+        :param export_name: Name of the export used in error messages
+        :return: <dict> repository version export
+        """
+        zipref = zipfile.ZipFile(StringIO(content), 'r')
+        try:
+            if 'export.json' not in zipref.namelist():
+                raise Exception('ERROR: Invalid export "%s": export.json not found.' % export_name)
+            return json.loads(zipref.read('export.json'))
+        finally:
+            zipref.close()
+
+    def iter_ocl_export_items(self, endpoint='', version='', keys=None, zipfilename='', jsonfilename='',
+                              delay_seconds=10, max_wait_seconds=120):
+        """
+        Fetches an export of the specified repository version (see load_ocl_export) and returns an
+        iterator of (key, item) for each item of the listed top-level arrays, e.g. "concepts" and
+        "mappings". If stream_json_exports is set, export.json is decompressed and parsed
+        incrementally so that only one item is held in memory at a time. Items are returned in
+        document order when streaming and in the order of keys otherwise.
+        :param keys: List of top-level keys whose items to return, e.g. ['concepts', 'mappings']
+        :return: iterator of (key, item) tuples
+        """
+        if not self.stream_json_exports:
+            return DatimBase.iter_export_items(self.load_ocl_export(
+                endpoint=endpoint, version=version, zipfilename=zipfilename, jsonfilename=jsonfilename,
+                delay_seconds=delay_seconds, max_wait_seconds=max_wait_seconds), keys)
+        if self.run_ocl_offline:
+            if jsonfilename and self.does_offline_data_file_exist(jsonfilename, exit_if_missing=False):
+                return self.iter_json_file_items(jsonfilename, keys)
+            self.does_offline_data_file_exist(zipfilename, exit_if_missing=True)
+            with open(self.attach_absolute_data_path(zipfilename), 'rb') as input_file:
+                content = input_file.read()
+            export_name = zipfilename
+        else:
+            content = self.get_ocl_export_content(
+                endpoint=endpoint, version=version, delay_seconds=delay_seconds,
+                max_wait_seconds=max_wait_seconds)
+            if zipfilename:
+                with open(self.attach_absolute_data_path(zipfilename), 'wb') as handle:
+                    handle.write(content)
+                self.vlog(1, '%s bytes saved to "%s"' % (len(content), zipfilename))
+            export_name = endpoint
+        return DatimBase.iter_ocl_export_content_items(content, keys, export_name=export_name)
+
+    @staticmethod
+    def iter_ocl_export_content_items(content, keys, export_name=''):
+        """
+        Generator that decompresses export.json from a compressed OCL export and parses it
+        incrementally, yielding (key, item) for each item of the listed top-level arrays
+        """
+        zipref = zipfile.ZipFile(StringIO(content), 'r')
+        try:
+            if 'export.json' not in zipref.namelist():
+                raise Exception('ERROR: Invalid export "%s": export.json not found.' % export_name)
+            export_file = zipref.open('export.json')
+            try:
+                for key, item in utils.jsonstream.iter_arrays_items(export_file, keys):
+                    yield key, item
+            finally:
+                export_file.close()
+        finally:
+            zipref.close()
+
+    def iter_json_file_items(self, filename, keys):
+        """
+        Returns an iterator of (key, item) for each item of the listed top-level arrays of a JSON
+        export saved to the data folder, parsed incrementally if stream_json_exports is set
+        """
+        if not self.stream_json_exports:
+            with open(self.attach_absolute_data_path(filename), 'rb') as input_file:
+                return DatimBase.iter_export_items(json.load(input_file), keys)
+        return DatimBase._iter_json_file_items(self.attach_absolute_data_path(filename), keys)
+
+    @staticmethod
+    def _iter_json_file_items(filename, keys):
+        with open(filename, 'rb') as input_file:
+            for key, item in utils.jsonstream.iter_arrays_items(input_file, keys):
+                yield key, item
 
-        # Write compressed export to file
+    def load_json_array_items(self, input_file, key):
+        """
+        Returns the items of the top-level array with the specified key from an open JSON export,
+        e.g. the "dataElements" of a DHIS2 export. If stream_json_exports is set, this returns an
+        iterator that parses the file incrementally, so input_file must remain open while iterating.
+        """
+        if self.stream_json_exports:
+            return utils.jsonstream.iter_array_items(input_file, key)
+        return json.load(input_file)[key]
+
+    @staticmethod
+    def iter_export_items(export, keys):
+        """ Generator yielding (key, item) for each item of the listed arrays of a parsed export """
+        for key in keys:
+            for item in export.get(key) or []:
+                yield key, item
+
+    def save_ocl_export(self, content, zipfilename='', jsonfilename=''):
+        """
+        Writes a compressed OCL export to file and decompresses its export.json
+        directly to jsonfilename. Safe to call concurrently for different exports.
+        :param content: <str> compressed repository version export
+        :param zipfilename: Filename to save the compressed OCL export to
+        :param jsonfilename: Filename to save the decompressed OCL-JSON export to
+        :return: None
+        """
         with open(self.attach_absolute_data_path(zipfilename), 'wb') as handle:
-            for block in r.iter_content(1024):
-                handle.write(block)
-        self.vlog(1, '%s bytes saved to "%s"' % (r.headers['Content-Length'], zipfilename))
+            handle.write(content)
+        self.vlog(1, '%s bytes saved to "%s"' % (len(content), zipfilename))
 
-        # Decompress the export file and rename
         zipref = zipfile.ZipFile(self.attach_absolute_data_path(zipfilename))
-        zipref.extractall(os.path.join(self.__location__, self.DATA_SUBFOLDER_NAME))
-        zipref.close()
-        os.rename(self.attach_absolute_data_path('export.json'),
-                  self.attach_absolute_data_path(jsonfilename))
+        try:
+            if 'export.json' not in zipref.namelist():
+                errmsg = 'ERROR: Invalid export "%s": export.json not found.' % zipfilename
+                self.vlog(1, errmsg)
+                raise Exception(errmsg)
+            with open(self.attach_absolute_data_path(jsonfilename), 'wb') as output_file:
+                shutil.copyfileobj(zipref.open('export.json'), output_file)
+        finally:
+            zipref.close()
         self.vlog(1, 'Export decompressed to "%s"' % jsonfilename)
 
-        return True
+    def get_ocl_exports(self, ocl_export_defs=None, version='latest', max_workers=None,
+                        delay_seconds=10, max_wait_seconds=120):
+        """
+        Fetches exports for multiple repositories concurrently and saves each to the same files
+        that get_ocl_export would use (see endpoint2filename_ocl_export_zip/json). Processing
+        happens in phases, each using up to max_workers concurrent requests: resolve repository
+        versions and request exports, trigger generation of exports that are not yet cached,
+        poll all pending exports together, then download and decompress.
+        :param ocl_export_defs: <dict> export_key: {'endpoint': repo_endpoint, ...}, e.g. OCL_EXPORT_DEFS
+        :param version: repo version ID or "latest"
+        :param max_workers: Maximum number of concurrent requests; defaults to ocl_export_max_workers
+        :param delay_seconds: Seconds to wait between polls for pending exports
+        :param max_wait_seconds: Maximum seconds to wait for pending exports to be generated
+        :return: <dict> export_key: repo_version_id
+        """
+        pool = gevent.pool.Pool(max(max_workers or self.ocl_export_max_workers, 1))
+        export_keys = sorted(ocl_export_defs.keys())
+
+        def resolve_export(export_key):
+            endpoint = ocl_export_defs[export_key]['endpoint']
+            if version == 'latest':
+                repo_version_id = self.get_latest_version_id(endpoint)
+            else:
+                repo_version_id = version
+            url_ocl_export = self.oclenv + endpoint + repo_version_id + '/export/'
+            self.vlog(1, '[%s] Export URL:' % export_key, url_ocl_export)
+            return export_key, repo_version_id, url_ocl_export, request_export(url_ocl_export)
+
+        def request_export(url_ocl_export):
+            status_code, content = DatimBase.get_ocl_export_cache().get_export_content(
+                url_ocl_export, headers=self.oclapiheaders, session=DatimBase.get_http_session())
+            if status_code not in [200, 204]:
+                msg = 'ERROR: Unrecognized response from OCL: %s' % str(status_code)
+                self.vlog(1, msg)
+                raise Exception(msg)
+            return content
+
+        # Resolve repository versions and request the exports (cached exports are read locally)
+        repo_version_ids = {}
+        export_urls = {}
+        export_contents = {}
+        pending_export_keys = []
+        for export_key, repo_version_id, url_ocl_export, content in pool.imap_unordered(
+                resolve_export, export_keys):
+            repo_version_ids[export_key] = repo_version_id
+            export_urls[export_key] = url_ocl_export
+            if content is not None:
+                export_contents[export_key] = content
+            else:
+                pending_export_keys.append(export_key)
+
+        # Trigger generation of missing exports and poll until they are all cached
+        if pending_export_keys:
+            self.vlog(1, 'WARNING: Exports do not exist for %s repositories. Creating exports...' % (
+                len(pending_export_keys)))
+            pool.map(lambda export_key: self.generate_repository_version_export(
+                export_urls[export_key], do_wait_until_cached=False), pending_export_keys)
+            start_time = time.time()
+            while pending_export_keys:
+                if time.time() - start_time + delay_seconds >= max_wait_seconds:
+                    msg = 'ERROR: Exports taking too long to process: %s. Exiting...' % ', '.join(
+                        pending_export_keys)
+                    self.vlog(1, msg)
+                    raise Exception(msg)
+                self.vlog(1, 'INFO: Delaying %s seconds while %s exports are being generated...' % (
+                    delay_seconds, len(pending_export_keys)))
+                gevent.sleep(delay_seconds)
+                poll_results = pool.map(
+                    lambda export_key: (export_key, request_export(export_urls[export_key])), pending_export_keys)
+                pending_export_keys = []
+                for export_key, content in poll_results:
+                    if content is not None:
+                        export_contents[export_key] = content
+                    else:
+                        pending_export_keys.append(export_key)
+
+        # Download and decompress the exports
+        def save_export(export_key):
+            endpoint = ocl_export_defs[export_key]['endpoint']
+            self.save_ocl_export(
+                export_contents[export_key],
+                zipfilename=DatimBase.endpoint2filename_ocl_export_zip(endpoint),
+                jsonfilename=DatimBase.endpoint2filename_ocl_export_json(endpoint))
+        pool.map(save_export, export_keys)
+
+        return repo_version_ids
 
     def generate_repository_version_export(self, repo_export_url, do_wait_until_cached=True,
                                            delay_seconds=10, max_wait_seconds=120):
@@ -517,7 +917,7 @@ class DatimBase(object):
         :return: <Response>
         """
         # Make the initial request
-        request_create_export = requests.post(
+        request_create_export = DatimBase.get_http_session().post(
             repo_export_url, headers=self.oclapiheaders, allow_redirects=True)
         do_delay_on_first_loop = True
         if request_create_export.status_code == 409:
@@ -548,7 +948,7 @@ class DatimBase(object):
                 if do_delay_on_first_loop:
                     time.sleep(delay_seconds)
                     do_delay_on_first_loop = False
-                r = requests.get(repo_export_url, headers=self.oclapiheaders)
+                r = DatimBase.get_http_session().get(repo_export_url, headers=self.oclapiheaders)
                 r.raise_for_status()
                 if r.status_code == 200:
                     return r
@@ -597,7 +997,7 @@ class DatimBase(object):
         repo_versions_url = '%s%sversions/?limit=0' % (self.oclenv, repo_endpoint)
         self.vlog(1, 'Fetching latest repository version for period "%s": %s' % (
             period, repo_versions_url))
-        r = requests.get(repo_versions_url, headers=self.oclapiheaders)
+        r = DatimBase.get_http_session().get(repo_versions_url, headers=self.oclapiheaders)
         repo_versions = r.json()
         for repo_version in repo_versions:
             if repo_version['id'] == 'HEAD' or repo_version['released'] is not True:
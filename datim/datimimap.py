@@ -5,11 +5,9 @@ import sys
 import StringIO
 import csv
 import json
-import re
+import hashlib
 import time
 from operator import itemgetter
-import requests
-import deepdiff
 import datimimapexport
 import datimbase
 import ocldev.oclconstants
@@ -135,15 +133,27 @@ class DatimImap(object):
     SET_EQUAL_MOH_ID_TO_NULL_DISAG = False
 
     def __init__(self, country_code='', country_org='', country_name='', period='', version=None,
-                 imap_data=None, do_add_columns_to_csv=True):
-        """ Constructor for DatimImap class """
+                 imap_data=None, do_add_columns_to_csv=True, compact_storage=False):
+        """
+        Constructor for DatimImap class
+        :param compact_storage: Store rows column-wise with repeated values interned, which
+            uses much less memory when many IMAPs are held at once. Rows are then rebuilt
+            on each access rather than cached.
+        """
         self.country_code = country_code
         self.country_org = country_org
         self.country_name = country_name
         self.period = period
         self.version = version
         self.do_add_columns_to_csv = do_add_columns_to_csv
+        self.compact_storage = compact_storage
         self.__imap_data = None
+        self.__imap_indexes = None
+        self.__imap_row_numbers_by_key = None
+        self.__normalized_rows = None
+        self.__normalized_rows_context = None
+        self.__empty_map_flags = None
+        self.__sorted_row_numbers = None
         self.set_imap_data(imap_data)
 
     def __iter__(self):
@@ -192,27 +202,22 @@ class DatimImap(object):
         :param show_null_disag_as_blank:
         :return: Returns list, dict, or None
         """
-        row = self.__imap_data[row_number].copy()
-        if row and exclude_empty_maps and DatimImap.is_empty_map(row):
+        if exclude_empty_maps and self.is_empty_map_row(row_number):
             return None
 
-        # (Optionally) Replace alternative null disag representations with actual null disag concept
-        if row and auto_fix_null_disag:
-            row = DatimImap.fix_null_disag_in_row(row)
+        # Get the row with null disags fixed and extra info added as requested, then copy it so
+        # that the cached normalized row is never modified by callers
+        row = self.get_normalized_row(
+            row_number, auto_fix_null_disag=auto_fix_null_disag, include_extra_info=include_extra_info)
+        row = row.copy() if row else row
 
         # (Optionally) Exclude classification - used by diff method
         if row and exclude_classification and self.IMAP_FIELD_MOH_CLASSIFICATION in row:
-            row = row.copy()
             del row[self.IMAP_FIELD_MOH_CLASSIFICATION]
 
-        # (Optionally) Add extra info
-        if row and include_extra_info:
-            row = self.add_columns_to_row(row)
-
         # (Optionally) Replace null disags with blank disag ID/Name values
         if (row and show_null_disag_as_blank and
                 row[DatimImap.IMAP_FIELD_MOH_DISAG_ID] == datimbase.DatimBase.NULL_DISAG_ID):
-            row = row.copy()
             row[DatimImap.IMAP_FIELD_MOH_DISAG_ID] = ''
             row[DatimImap.IMAP_FIELD_MOH_DISAG_NAME] = ''
 
@@ -222,6 +227,47 @@ class DatimImap(object):
 
         return row
 
+    def get_normalized_row(self, row_number, auto_fix_null_disag=True, include_extra_info=False):
+        """
+        Returns the specified IMAP row with alternative null disag representations replaced and
+        extra columns added as requested. Each form of a row is computed once, on first use,
+        and cached until set_imap_data is called or the period or country org changes (rows
+        are not cached if compact_storage is set). The returned row may be shared and must
+        not be modified.
+        :param row_number: 0-based row number of the IMAP to return
+        :param auto_fix_null_disag: Replace empty disags with 'null-disag' if True
+        :param include_extra_info: Adds extra columns if True
+        :return: <dict>
+        """
+        context = (self.period, self.country_org)
+        if self.__normalized_rows is None or self.__normalized_rows_context != context:
+            self.__normalized_rows = {}
+            self.__normalized_rows_context = context
+        row_form = (bool(auto_fix_null_disag), bool(include_extra_info))
+        if row_form not in self.__normalized_rows:
+            self.__normalized_rows[row_form] = [None] * self.length()
+        normalized_rows = self.__normalized_rows[row_form]
+        row = normalized_rows[row_number]
+        if row is None:
+            row = self.__imap_data[row_number]
+            if row and auto_fix_null_disag:
+                row = DatimImap.fix_null_disag_in_row(row)
+            if row and include_extra_info:
+                row = self.add_columns_to_row(row)
+            if not self.compact_storage:
+                normalized_rows[row_number] = row
+        return row
+
+    def is_empty_map_row(self, row_number):
+        """
+        Returns True if the specified row is an empty map (see is_empty_map). Evaluated once per row.
+        :param row_number: 0-based row number of the IMAP
+        :return: <bool>
+        """
+        if self.__empty_map_flags is None:
+            self.__empty_map_flags = [DatimImap.is_empty_map(row) for row in self.__imap_data]
+        return self.__empty_map_flags[row_number]
+
     @staticmethod
     def is_empty_map(row):
         """
@@ -282,9 +328,16 @@ class DatimImap(object):
         """
         if convert_to_dict:
             data = {}
+            row_numbers = range(self.length())
         else:
             data = []
-        for row_number in range(self.length()):
+            if sort:
+                row_numbers = self.get_sorted_row_numbers(
+                    auto_fix_null_disag=auto_fix_null_disag,
+                    show_null_disag_as_blank=show_null_disag_as_blank)
+            else:
+                row_numbers = range(self.length())
+        for row_number in row_numbers:
             row = self.get_row(
                 row_number,
                 include_extra_info=include_extra_info,
@@ -296,13 +349,34 @@ class DatimImap(object):
             if not row:
                 continue
             if convert_to_dict:
-                data.update(row.copy())
+                data.update(row)
             else:
-                data.append(row.copy())
-        if sort and not convert_to_dict:
-            data = DatimImap.multikeysort(data, self.IMAP_IMPORT_FIELD_NAMES)
+                data.append(row)
         return data
 
+    def get_sorted_row_numbers(self, auto_fix_null_disag=True, show_null_disag_as_blank=False):
+        """
+        Returns the row numbers of the IMAP ordered by the IMAP import fields, which is the order
+        returned by get_imap_data(sort=True). The order is computed once for each combination of
+        parameters (the only ones that change the values sorted on) and cached until
+        set_imap_data is called. Excluding rows does not change the order of the remaining rows
+        because the sort is stable.
+        :param auto_fix_null_disag: Replaces empty disags with 'null-disag' if True
+        :param show_null_disag_as_blank:
+        :return: <list> of 0-based row numbers
+        """
+        sort_form = (bool(auto_fix_null_disag), bool(show_null_disag_as_blank))
+        if self.__sorted_row_numbers is None:
+            self.__sorted_row_numbers = {}
+        if sort_form not in self.__sorted_row_numbers:
+            rows = [self.get_row(row_number, auto_fix_null_disag=auto_fix_null_disag,
+                                 show_null_disag_as_blank=show_null_disag_as_blank)
+                    for row_number in range(self.length())]
+            self.__sorted_row_numbers[sort_form] = DatimImap.multikeysort(
+                range(self.length()), self.IMAP_IMPORT_FIELD_NAMES,
+                key=lambda row_number: rows[row_number])
+        return self.__sorted_row_numbers[sort_form]
+
     @staticmethod
     def get_imap_row_key(row, country_org):
         """
@@ -340,19 +414,41 @@ class DatimImap(object):
         :param convert_to_dict:
         :return:
         """
-        row_key_dict = DatimImap.parse_imap_row_key(row_key)
-        if row_key_dict:
+        row_number = self.get_imap_row_number_by_key(row_key)
+        if row_number is None:
+            return None
+        return self.get_row(row_number, auto_fix_null_disag=auto_fix_null_disag,
+                            include_extra_info=include_extra_info, convert_to_dict=convert_to_dict)
+
+    def get_imap_row_number_by_key(self, row_key):
+        """
+        Returns the 0-based row number of the first row matching the specified string row_key,
+        or None if no row matches. Row keys are generated by get_imap_row_key using this IMAP's
+        country_org. Keys that do not match exactly (e.g. a different operation or country org)
+        fall back to matching the DATIM indicator+disag IDs and MOH indicator+disag IDs.
+        The lookup maps are built on first use and discarded whenever set_imap_data is called.
+        :param row_key:
+        :return: <int> or None
+        """
+        if self.__imap_row_numbers_by_key is None:
+            row_numbers_by_key = {}
+            row_numbers_by_mapping = {}
             for row_number in range(self.length()):
                 row = self.get_row(row_number, exclude_empty_maps=True, auto_fix_null_disag=True)
                 if not row:
                     continue
-                if (row[DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID] == row_key_dict[DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID] and
-                        row[DatimImap.IMAP_FIELD_DATIM_DISAG_ID] == row_key_dict[DatimImap.IMAP_FIELD_DATIM_DISAG_ID] and
-                        row[DatimImap.IMAP_FIELD_MOH_INDICATOR_ID] == row_key_dict[DatimImap.IMAP_FIELD_MOH_INDICATOR_ID] and
-                        row[DatimImap.IMAP_FIELD_MOH_DISAG_ID] == row_key_dict[DatimImap.IMAP_FIELD_MOH_DISAG_ID]):
-                    # Request the row again applying the format attributes
-                    return self.get_row(row_number, auto_fix_null_disag=auto_fix_null_disag,
-                                        include_extra_info=include_extra_info, convert_to_dict=convert_to_dict)
+                row_numbers_by_key.setdefault(
+                    DatimImap.get_imap_row_key(row, self.country_org), row_number)
+                row_numbers_by_mapping.setdefault(
+                    DatimImap.get_operation_mapping_key(row), row_number)
+            self.__imap_row_numbers_by_key = (row_numbers_by_key, row_numbers_by_mapping)
+        row_numbers_by_key, row_numbers_by_mapping = self.__imap_row_numbers_by_key
+
+        if row_key in row_numbers_by_key:
+            return row_numbers_by_key[row_key]
+        row_key_dict = DatimImap.parse_imap_row_key(row_key)
+        if row_key_dict:
+            return row_numbers_by_mapping.get(DatimImap.get_operation_mapping_key(row_key_dict))
         return None
 
     @staticmethod
@@ -387,7 +483,10 @@ class DatimImap(object):
         :return:
         """
         # TODO: Fix the explicit UTF-8 character encoding and ignoring unicode decoding errors
-        self.__imap_data = []
+        if self.compact_storage:
+            self.__imap_data = DatimImapColumnStore(self.IMAP_EXPORT_FIELD_NAMES)
+        else:
+            self.__imap_data = []
         if isinstance(imap_data, csv.DictReader) or type(imap_data) == type([]):
             for row in imap_data:
                 # Get rid of unrecognized columns and ensure unicode encoding
@@ -400,6 +499,89 @@ class DatimImap(object):
         else:
             raise Exception("Cannot set IMAP data with '%s'" % imap_data)
 
+        # Discard lookup indexes and normalized rows built from the previous IMAP data
+        self.__imap_indexes = None
+        self.__imap_row_numbers_by_key = None
+        self.__normalized_rows = None
+        self.__empty_map_flags = None
+        self.__sorted_row_numbers = None
+
+    def get_imap_indexes(self):
+        """
+        Returns hash indexes of the non-empty rows of the IMAP that are used to answer the
+        has_country_* methods in constant time. Indexes are built on first use after the IMAP
+        data is set and are discarded whenever set_imap_data is called. Values are evaluated
+        after replacing alternative null disag representations, same as get_imap_data.
+        :return: <dict> of index name to <set>
+        """
+        if self.__imap_indexes is not None:
+            return self.__imap_indexes
+        indexes = {
+            'num_rows': 0,
+            'indicator_ids': set(),
+            'indicator_names': set(),
+            'indicators': set(),
+            'disag_ids': set(),
+            'disag_names': set(),
+            'disags': set(),
+            'collection_ids': set(),
+            'datim_mappings': set(),
+            'operation_mappings': set(),
+        }
+        for row in self.get_imap_data(exclude_empty_maps=True):
+            indexes['num_rows'] += 1
+            indexes['indicator_ids'].add(row[DatimImap.IMAP_FIELD_MOH_INDICATOR_ID])
+            indexes['indicator_names'].add(row[DatimImap.IMAP_FIELD_MOH_INDICATOR_NAME])
+            indexes['indicators'].add((
+                row[DatimImap.IMAP_FIELD_MOH_INDICATOR_ID],
+                row[DatimImap.IMAP_FIELD_MOH_INDICATOR_NAME]))
+            indexes['disag_ids'].add(row[DatimImap.IMAP_FIELD_MOH_DISAG_ID])
+            indexes['disag_names'].add(row[DatimImap.IMAP_FIELD_MOH_DISAG_NAME])
+            indexes['disags'].add((
+                row[DatimImap.IMAP_FIELD_MOH_DISAG_ID],
+                row[DatimImap.IMAP_FIELD_MOH_DISAG_NAME]))
+            indexes['collection_ids'].add(DatimImap.get_country_collection_id(row))
+            indexes['datim_mappings'].add(DatimImap.get_datim_mapping_key(row))
+            indexes['operation_mappings'].add(DatimImap.get_operation_mapping_key(row))
+        self.__imap_indexes = indexes
+        return self.__imap_indexes
+
+    @staticmethod
+    def get_country_collection_id(row):
+        """
+        Returns the ID of the country collection for the DATIM indicator+disag pair of a row,
+        e.g. "HTS-TST-N-MOH-Age-Agg-Sex-Result-FSmIqIsgheB"
+        :param row:
+        :return: <str>
+        """
+        moh_collection_id = '%s_%s' % (
+            row[DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID],
+            row[DatimImap.IMAP_FIELD_DATIM_DISAG_ID])
+        return moh_collection_id.replace('_', '-')
+
+    @staticmethod
+    def get_datim_mapping_key(row):
+        """
+        Returns a tuple of the DATIM indicator+disag IDs of a row
+        :param row:
+        :return: <tuple>
+        """
+        return (row[DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID],
+                row[DatimImap.IMAP_FIELD_DATIM_DISAG_ID])
+
+    @staticmethod
+    def get_operation_mapping_key(row):
+        """
+        Returns a tuple of the DATIM indicator+disag IDs and the MOH indicator+disag IDs of a row.
+        Names and the mapping operation are not part of the key.
+        :param row:
+        :return: <tuple>
+        """
+        return (row[DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID],
+                row[DatimImap.IMAP_FIELD_DATIM_DISAG_ID],
+                row[DatimImap.IMAP_FIELD_MOH_INDICATOR_ID],
+                row[DatimImap.IMAP_FIELD_MOH_DISAG_ID])
+
     @staticmethod
     def uors2u(object, encoding='utf8', errors='strict'):
         """
@@ -561,18 +743,34 @@ class DatimImap(object):
         return DatimImapDiff(self, imap, exclude_empty_maps=exclude_empty_maps)
 
     @staticmethod
-    def multikeysort(items, columns):
-        from operator import itemgetter
-        comparers = [((itemgetter(col[1:].strip()), -1) if col.startswith('-') else
-                      (itemgetter(col.strip()), 1)) for col in columns]
-        def comparer(left, right):
-            for fn, mult in comparers:
-                result = cmp(fn(left), fn(right))
-                if result:
-                    return mult * result
+    def multikeysort(items, columns, key=None):
+        """
+        Returns items sorted by multiple columns. Prefix a column name with '-' to sort it
+        in descending order. Each run of columns sorted in the same direction is sorted with a
+        single tuple key, applied from the last run to the first, which relies on the sort
+        being stable.
+        :param items: <list> of dicts to sort
+        :param columns: <list> of column names, e.g. ['DATIM_Indicator_ID', '-Operation']
+        :param key: Optional function that returns the dict for an item
+        :return: <list>
+        """
+        runs = []
+        for col in columns:
+            is_descending = col.startswith('-')
+            col_name = col[1:].strip() if is_descending else col.strip()
+            if runs and runs[-1][0] == is_descending:
+                runs[-1][1].append(col_name)
             else:
-                return 0
-        return sorted(items, cmp=comparer)
+                runs.append((is_descending, [col_name]))
+        items = list(items)
+        for is_descending, col_names in reversed(runs):
+            get_values = itemgetter(*col_names)
+            if key:
+                sort_key = lambda item, get_values=get_values: get_values(key(item))
+            else:
+                sort_key = get_values
+            items.sort(key=sort_key, reverse=is_descending)
+        return items
 
     def add_columns_to_row(self, row):
         """
@@ -643,10 +841,7 @@ class DatimImap(object):
         row[DatimImap.IMAP_EXTRA_FIELD_MOH_COLLECTION_NAME] = '%s: %s' % (
             row[DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID],
             row[DatimImap.IMAP_FIELD_DATIM_DISAG_NAME])
-        moh_collection_id = '%s_%s' % (
-            row[DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID],
-            row[DatimImap.IMAP_FIELD_DATIM_DISAG_ID])
-        row[DatimImap.IMAP_EXTRA_FIELD_MOH_COLLECTION_ID] = moh_collection_id.replace('_', '-')
+        row[DatimImap.IMAP_EXTRA_FIELD_MOH_COLLECTION_ID] = DatimImap.get_country_collection_id(row)
 
         # DATIM HAS OPTION mapping
         row[DatimImap.IMAP_EXTRA_FIELD_DATIM_FROM_CONCEPT_URI] = '/%s/%s/sources/%s/concepts/%s/' % (
@@ -717,11 +912,14 @@ class DatimImap(object):
         :param indicator_name:
         :return: bool
         """
-        for row in self.get_imap_data(exclude_empty_maps=True):
-            if ((not indicator_id or (indicator_id and indicator_id == row[DatimImap.IMAP_FIELD_MOH_INDICATOR_ID])) and
-                    (not indicator_name or (indicator_name and indicator_name == row[DatimImap.IMAP_FIELD_MOH_INDICATOR_NAME]))):
-                return True
-        return False
+        indexes = self.get_imap_indexes()
+        if indicator_id and indicator_name:
+            return (indicator_id, indicator_name) in indexes['indicators']
+        elif indicator_id:
+            return indicator_id in indexes['indicator_ids']
+        elif indicator_name:
+            return indicator_name in indexes['indicator_names']
+        return bool(indexes['num_rows'])
 
     def has_country_disag(self, disag_id='', disag_name=''):
         """
@@ -733,11 +931,14 @@ class DatimImap(object):
         :param disag_name:
         :return: bool
         """
-        for row in self.get_imap_data(exclude_empty_maps=True):
-            if ((not disag_id or (disag_id and disag_id == row[DatimImap.IMAP_FIELD_MOH_DISAG_ID])) and
-                    (not disag_name or (disag_name and disag_name == row[DatimImap.IMAP_FIELD_MOH_DISAG_NAME]))):
-                return True
-        return False
+        indexes = self.get_imap_indexes()
+        if disag_id and disag_name:
+            return (disag_id, disag_name) in indexes['disags']
+        elif disag_id:
+            return disag_id in indexes['disag_ids']
+        elif disag_name:
+            return disag_name in indexes['disag_names']
+        return bool(indexes['num_rows'])
 
     def has_country_collection(self, csv_row_needle):
         """
@@ -747,14 +948,11 @@ class DatimImap(object):
         :return: bool
         """
         # TODO: This method perpetuates the problem! Need to check the actual mappings, not the collection name
-        full_csv_row_needle = self.add_columns_to_row(csv_row_needle.copy())
-        needle_collection_id = full_csv_row_needle[DatimImap.IMAP_EXTRA_FIELD_MOH_COLLECTION_ID]
-        if not needle_collection_id:
+        # NOTE: Collection IDs are only generated for rows with an MOH indicator ID
+        if not csv_row_needle[DatimImap.IMAP_FIELD_MOH_INDICATOR_ID]:
             return False
-        for row in self.get_imap_data(exclude_empty_maps=True, include_extra_info=True):
-            if row[DatimImap.IMAP_EXTRA_FIELD_MOH_COLLECTION_ID] == needle_collection_id:
-                return True
-        return False
+        needle_collection_id = DatimImap.get_country_collection_id(csv_row_needle)
+        return needle_collection_id in self.get_imap_indexes()['collection_ids']
 
     def has_country_operation_mapping(self, csv_row):
         """
@@ -765,13 +963,8 @@ class DatimImap(object):
         :param csv_row:
         :return: bool
         """
-        for row in self.get_imap_data(exclude_empty_maps=True):
-            if (row[DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID] == csv_row[DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID] and
-                    row[DatimImap.IMAP_FIELD_DATIM_DISAG_ID] == csv_row[DatimImap.IMAP_FIELD_DATIM_DISAG_ID] and
-                    row[DatimImap.IMAP_FIELD_MOH_INDICATOR_ID] == csv_row[DatimImap.IMAP_FIELD_MOH_INDICATOR_ID] and
-                    row[DatimImap.IMAP_FIELD_MOH_DISAG_ID] == csv_row[DatimImap.IMAP_FIELD_MOH_DISAG_ID]):
-                return True
-        return False
+        return (DatimImap.get_operation_mapping_key(csv_row) in
+                self.get_imap_indexes()['operation_mappings'])
 
     def has_country_datim_mapping(self, csv_row):
         """
@@ -779,11 +972,7 @@ class DatimImap(object):
         :param csv_row:
         :return: bool
         """
-        for row in self.get_imap_data(exclude_empty_maps=True):
-            if (row[DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID] == csv_row[DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID] and
-                    row[DatimImap.IMAP_FIELD_DATIM_DISAG_ID] == csv_row[DatimImap.IMAP_FIELD_DATIM_DISAG_ID]):
-                return True
-        return False
+        return DatimImap.get_datim_mapping_key(csv_row) in self.get_imap_indexes()['datim_mappings']
 
     def get_country_indicator_update_json(self, row):
         if DatimImap.IMAP_EXTRA_FIELD_NAMES[0] not in row:
@@ -842,6 +1031,54 @@ class DatimImap(object):
             imap_input=self, csv_row=row, defs=defs)
 
 
+class DatimImapColumnStore(object):
+    """
+    Compact backing store for IMAP rows. Each field is stored as a list of values rather than
+    each row as a dict, and the values of heavily repeated fields are interned so that all
+    rows (of all IMAPs) share a single copy of each. Supports the subset of the list interface
+    used by DatimImap: len, indexing and iteration, each returning rows as new dicts.
+    """
+
+    # Fields whose values repeat across rows and countries, e.g. DATIM indicator/disag IDs
+    INTERNED_FIELD_NAMES = [
+        DatimImap.IMAP_FIELD_DATIM_INDICATOR_CATEGORY,
+        DatimImap.IMAP_FIELD_DATIM_INDICATOR_ID,
+        DatimImap.IMAP_FIELD_DATIM_DISAG_ID,
+        DatimImap.IMAP_FIELD_DATIM_DISAG_NAME,
+        DatimImap.IMAP_FIELD_OPERATION,
+        DatimImap.IMAP_FIELD_MOH_CLASSIFICATION,
+    ]
+
+    # Interned values shared by all column stores
+    _interned_values = {}
+
+    def __init__(self, field_names):
+        self.field_names = list(field_names)
+        self.columns = [[] for field_name in self.field_names]
+        self.interned_columns = [
+            field_name in self.INTERNED_FIELD_NAMES for field_name in self.field_names]
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, row_number):
+        return dict(zip(self.field_names, [column[row_number] for column in self.columns]))
+
+    def __iter__(self):
+        field_names = self.field_names
+        for values in zip(*self.columns):
+            yield dict(zip(field_names, values))
+
+    def append(self, row):
+        """ Adds a row, which must be a dict with a value for every field """
+        interned_values = DatimImapColumnStore._interned_values
+        for column, field_name, is_interned in zip(self.columns, self.field_names, self.interned_columns):
+            value = row[field_name]
+            if is_interned:
+                value = interned_values.setdefault(value, value)
+            column.append(value)
+
+
 class DatimImapFactory(object):
     """ Factory class for the DatimImap object """
 
@@ -920,7 +1157,7 @@ class DatimImapFactory(object):
         org_url = "%s/orgs/%s/" % (ocl_env_url, org_id)
         if verbose:
             print('INFO: Checking if org "%s" exists...' % org_url)
-        r = requests.get(org_url, headers=ocl_api_headers)
+        r = datimbase.DatimBase.get_http_session().get(org_url, headers=ocl_api_headers)
         if r.status_code == 404:
             if verbose:
                 print('Org "%s" not found or not authorized.' % org_id)
@@ -958,7 +1195,7 @@ class DatimImapFactory(object):
         org_url = "%s/orgs/%s/" % (oclenv, org_id)
         if verbose:
             print('INFO: Checking if org "%s" exists...' % org_url)
-        r = requests.get(org_url, headers=oclapiheaders)
+        r = datimbase.DatimBase.get_http_session().get(org_url, headers=oclapiheaders)
         if r.status_code == 404:
             if verbose:
                 print('Org "%s" not found. Could not delete.' % org_id)
@@ -969,9 +1206,10 @@ class DatimImapFactory(object):
                 print('Unrecognized response code: "%s". Could not delete.' % r.status_code)
             return False
 
-        # Delete the org
-        r = requests.delete(org_url, headers=oclapiheaders)
+        # Delete the org -- its repository versions may be recreated under the same URLs, so drop cached exports
+        r = datimbase.DatimBase.get_http_session().delete(org_url, headers=oclapiheaders)
         r.raise_for_status()
+        datimbase.DatimBase.get_ocl_export_cache().remove_url_prefix(org_url)
         if r.status_code == 204:
             if verbose:
                 print('Org "%s" successfully deleted. Continuing...' % org_id)
@@ -992,7 +1230,7 @@ class DatimImapFactory(object):
             'Content-Type': 'application/json'
         }
         repo_versions_url = '%sversions/?limit=100' % repo_url
-        r = requests.get(repo_versions_url, headers=oclapiheaders)
+        r = datimbase.DatimBase.get_http_session().get(repo_versions_url, headers=oclapiheaders)
         r.raise_for_status()
         repo_versions = r.json()
         if repo_versions:
@@ -1109,6 +1347,43 @@ class DatimImapFactory(object):
         }
         return new_version_data
 
+    # Resource attributes that together identify an OCL resource in an import list
+    RESOURCE_IDENTITY_FIELDS = ['type', 'owner_type', 'owner', 'source', 'collection', 'id', 'url']
+
+    @staticmethod
+    def get_resource_identity(resource):
+        """
+        Returns a hashable key identifying an OCL-formatted resource by its type, owner, repository
+        and ID or URL. Resources without an ID or URL (e.g. references) are identified by an MD5
+        digest of their sorted JSON representation.
+        :param resource: <dict> OCL-formatted resource
+        :return: <tuple> or <str>
+        """
+        if resource.get('id') or resource.get('url'):
+            return tuple(resource.get(field_name)
+                         for field_name in DatimImapFactory.RESOURCE_IDENTITY_FIELDS)
+        return hashlib.md5(json.dumps(resource, sort_keys=True)).hexdigest()
+
+    @staticmethod
+    def dedup_import_list(import_list):
+        """
+        Returns the import list with duplicate resources removed, keeping the first occurrence of
+        each resource in its original position. Resources are only considered duplicates if they
+        are equal; the resource identity is used to avoid comparing every pair of resources.
+        :param import_list: <list> of OCL-formatted resources
+        :return: <list>
+        """
+        resources_by_identity = {}
+        import_list_dedup = []
+        for resource in import_list:
+            identical_resources = resources_by_identity.setdefault(
+                DatimImapFactory.get_resource_identity(resource), [])
+            if resource in identical_resources:
+                continue
+            identical_resources.append(resource)
+            import_list_dedup.append(resource)
+        return import_list_dedup
+
     @staticmethod
     def generate_import_script_from_diff(imap_diff, verbose=True):
         """
@@ -1122,11 +1397,10 @@ class DatimImapFactory(object):
         import_list_narrative = []
         diff_data = imap_diff.get_diff()
 
-        # Handle 'dictionary_item_added' - new country mapping
-        if 'dictionary_item_added' in diff_data:
-            for diff_key in diff_data['dictionary_item_added'].keys():
-                row_key = diff_key.strip("root['").strip("']")
-                csv_row = diff_data['dictionary_item_added'][diff_key]
+        # Handle added rows - new country mapping
+        if DatimImapDiff.DIFF_ROW_ADDED in diff_data:
+            for row_key in sorted(diff_data[DatimImapDiff.DIFF_ROW_ADDED]):
+                csv_row = diff_data[DatimImapDiff.DIFF_ROW_ADDED][row_key]
 
                 # country indicator
                 country_indicator_id = csv_row[DatimImap.IMAP_FIELD_MOH_INDICATOR_ID]
@@ -1197,10 +1471,9 @@ class DatimImapFactory(object):
                         csv_row[DatimImap.IMAP_FIELD_MOH_DISAG_NAME]))
                     import_list += imap_diff.imap_b.get_country_operation_mapping_create_json(csv_row)
 
-        # Handle 'dictionary_item_removed' - removed country mapping
-        if 'dictionary_item_removed' in diff_data:
-            for diff_key in diff_data['dictionary_item_removed'].keys():
-                row_key = diff_key.strip("root['").strip("']")
+        # Handle removed rows - removed country mapping
+        if DatimImapDiff.DIFF_ROW_REMOVED in diff_data:
+            for row_key in sorted(diff_data[DatimImapDiff.DIFF_ROW_REMOVED]):
                 csv_row = imap_diff.imap_a.get_imap_row_by_key(row_key)
 
                 # TODO: Retire country operation mapping
@@ -1247,37 +1520,34 @@ class DatimImapFactory(object):
                 are not in the removed list? If no, retire the DATIM mapping
                 """
 
-        # Handle 'values_changed' - updated name for country indicator or disag
+        # Handle changed values - updated name for country indicator or disag
         # NOTE: Names changes to DATIM indicator/disags are ignored
-        if 'values_changed' in diff_data:
-            regex_pattern = r"^root\[\'([a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+)\'\]\[\'(MOH_Disag_Name|MOH_Indicator_Name)\'\]$"
-            for diff_key in diff_data['values_changed'].keys():
-                # Parse the diff resource key
-                regex_result = re.match(regex_pattern, diff_key)
-                if not regex_result:
+        if DatimImapDiff.DIFF_VALUE_CHANGED in diff_data:
+            for row_key in sorted(diff_data[DatimImapDiff.DIFF_VALUE_CHANGED]):
+                changed_fields = diff_data[DatimImapDiff.DIFF_VALUE_CHANGED][row_key]
+                if (DatimImap.IMAP_FIELD_MOH_INDICATOR_NAME not in changed_fields and
+                        DatimImap.IMAP_FIELD_MOH_DISAG_NAME not in changed_fields):
                     continue
-                row_key = regex_result.group(1)
-                matched_field_name = regex_result.group(2)
 
                 # JP 2019-08-22 not currently used: csv_row_old = imap_diff.imap_a.get_imap_row_by_key(row_key)
                 csv_row_new = imap_diff.imap_b.get_imap_row_by_key(row_key)
 
                 # MOH_Indicator_Name
-                if matched_field_name == DatimImap.IMAP_FIELD_MOH_INDICATOR_NAME:
+                if DatimImap.IMAP_FIELD_MOH_INDICATOR_NAME in changed_fields:
                     import_list_narrative.append('Update country indicator name: %s, %s' % (
                         csv_row_new[DatimImap.IMAP_FIELD_MOH_INDICATOR_ID],
                         csv_row_new[DatimImap.IMAP_FIELD_MOH_INDICATOR_NAME]))
                     import_list += imap_diff.imap_b.get_country_indicator_update_json(csv_row_new)
 
                 # MOH_Disag_Name
-                if matched_field_name == DatimImap.IMAP_FIELD_MOH_DISAG_NAME:
+                if DatimImap.IMAP_FIELD_MOH_DISAG_NAME in changed_fields:
                     import_list_narrative.append('Update country disag name: %s, %s' % (
                         csv_row_new[DatimImap.IMAP_FIELD_MOH_DISAG_ID],
                         csv_row_new[DatimImap.IMAP_FIELD_MOH_DISAG_NAME]))
                     import_list += imap_diff.imap_b.get_country_disag_update_json(csv_row_new)
 
         # Dedup the import list without changing order
-        import_list_dedup = [i for n, i in enumerate(import_list) if i not in import_list[n + 1:]]
+        import_list_dedup = DatimImapFactory.dedup_import_list(import_list)
         import_list_narrative_dedup = []
         [import_list_narrative_dedup.append(i) for i in import_list_narrative if not import_list_narrative_dedup.count(i)]
 
@@ -1312,8 +1582,8 @@ class DatimImapFactory(object):
         datim_csv_converter.set_resource_definitions(datim_csv_resource_definitions)
         import_list = datim_csv_converter.process_by_definition()
 
-        # Dedup the import list without changing order using list enumeration
-        import_list_dedup = [i for n, i in enumerate(import_list) if i not in import_list[n + 1:]]
+        # Dedup the import list without changing order
+        import_list_dedup = DatimImapFactory.dedup_import_list(import_list)
 
         # Display additional debug info
         if verbose:
@@ -1340,8 +1610,8 @@ class DatimImapFactory(object):
         datim_csv_converter.set_resource_definitions(datim_csv_resource_definitions)
         import_list = datim_csv_converter.process_by_definition()
 
-        # Dedup the import list using list enumeration
-        import_list_dedup = [i for n, i in enumerate(import_list) if i not in import_list[n + 1:]]
+        # Dedup the import list without changing order
+        import_list_dedup = DatimImapFactory.dedup_import_list(import_list)
 
         # Display additional debug info
         if verbose:
@@ -1527,7 +1797,27 @@ class DatimImapFactory(object):
 
 
 class DatimImapDiff(object):
-    """ Object representing the diff between two IMAP objects """
+    """
+    Object representing the diff between two IMAP objects. Rows are matched by their row key
+    (see DatimImap.get_imap_row_key) and the diff is stored as a dictionary of diff categories:
+        {
+            DIFF_ROW_ADDED: { row_key: row_b, ... },
+            DIFF_ROW_REMOVED: { row_key: row_a, ... },
+            DIFF_VALUE_CHANGED: { row_key: { field_name: {'old_value': a, 'new_value': b}, ... }, ... }
+        }
+    Categories without any diffs are omitted.
+    """
+
+    # Diff categories
+    DIFF_ROW_ADDED = 'row_added'
+    DIFF_ROW_REMOVED = 'row_removed'
+    DIFF_VALUE_CHANGED = 'value_changed'
+
+    # Fields whose values are not compared, e.g. DATIM names that may differ between IMAP sources
+    DIFF_IGNORED_FIELD_NAMES = [DatimImap.IMAP_FIELD_DATIM_DISAG_NAME]
+
+    # Pairs of old/new values that are treated as equal, e.g. "default" vs. "Total" disag names
+    DIFF_EQUIVALENT_VALUES = [('default', 'Total')]
 
     def __init__(self, imap_a, imap_b, exclude_empty_maps=False):
         self.imap_a = imap_a
@@ -1545,28 +1835,53 @@ class DatimImapDiff(object):
         """
         self.imap_a = imap_a
         self.imap_b = imap_b
-        self.__diff_data = deepdiff.DeepDiff(
-            imap_a.get_imap_data(sort=True, exclude_empty_maps=exclude_empty_maps,
-                                 exclude_classification=True, convert_to_dict=True),
-            imap_b.get_imap_data(sort=True, exclude_empty_maps=exclude_empty_maps,
-                                 exclude_classification=True, convert_to_dict=True),
-            verbose_level=2)
-
-        # Post-processing Step 1: Remove the Total vs. default differences
-        if 'values_changed' in self.__diff_data:
-            for diff_key in self.__diff_data['values_changed'].keys():
-                if (self.__diff_data['values_changed'][diff_key]['new_value'] == 'Total' and
-                        self.__diff_data['values_changed'][diff_key]['old_value'] == 'default'):
-                    del(self.__diff_data['values_changed'][diff_key])
-
-        # Post-processing Step 2: Remove name discrepancies in the DATIM indicator and disag names
-        if 'values_changed' in self.__diff_data:
-            regex_pattern = r"^root\[\'([a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+,[a-zA-Z0-9.\-_]+)\'\]\[\'(DATIM_Disag_Name)\'\]$"
-            for diff_key in self.__diff_data['values_changed'].keys():
-                # Parse the diff resource key
-                regex_result = re.match(regex_pattern, diff_key)
-                if regex_result is not None:
-                    del(self.__diff_data['values_changed'][diff_key])
+        rows_a = imap_a.get_imap_data(exclude_empty_maps=exclude_empty_maps,
+                                      exclude_classification=True, convert_to_dict=True)
+        rows_b = imap_b.get_imap_data(exclude_empty_maps=exclude_empty_maps,
+                                      exclude_classification=True, convert_to_dict=True)
+        self.__diff_data = DatimImapDiff.diff_rows(rows_a, rows_b)
+
+    @staticmethod
+    def diff_rows(rows_a, rows_b):
+        """
+        Compares two dictionaries of IMAP rows keyed by row key and returns the diff categories
+        described in the class docstring
+        :param rows_a: <dict> row_key: row
+        :param rows_b: <dict> row_key: row
+        :return: <dict>
+        """
+        rows_added = {}
+        rows_removed = {}
+        values_changed = {}
+        for row_key, row_b in rows_b.iteritems():
+            if row_key not in rows_a:
+                rows_added[row_key] = row_b
+                continue
+            row_a = rows_a[row_key]
+            if row_a == row_b:
+                continue
+            changed_fields = {}
+            for field_name, new_value in row_b.iteritems():
+                old_value = row_a.get(field_name)
+                if (old_value == new_value or
+                        field_name in DatimImapDiff.DIFF_IGNORED_FIELD_NAMES or
+                        (old_value, new_value) in DatimImapDiff.DIFF_EQUIVALENT_VALUES):
+                    continue
+                changed_fields[field_name] = {'old_value': old_value, 'new_value': new_value}
+            if changed_fields:
+                values_changed[row_key] = changed_fields
+        for row_key, row_a in rows_a.iteritems():
+            if row_key not in rows_b:
+                rows_removed[row_key] = row_a
+
+        diff_data = {}
+        if rows_added:
+            diff_data[DatimImapDiff.DIFF_ROW_ADDED] = rows_added
+        if rows_removed:
+            diff_data[DatimImapDiff.DIFF_ROW_REMOVED] = rows_removed
+        if values_changed:
+            diff_data[DatimImapDiff.DIFF_VALUE_CHANGED] = values_changed
+        return diff_data
 
     def get_diff(self):
         """
@@ -1576,17 +1891,25 @@ class DatimImapDiff(object):
         return self.__diff_data
 
     def get_num_diffs(self):
+        """
+        Returns the number of added rows, removed rows and changed field values
+        :return: <int>
+        """
         num = 0
         for diff_category in self.__diff_data.keys():
-            for resource_diff_key, resource_diff in self.__diff_data[diff_category].items():
-                num += 1
+            if diff_category == DatimImapDiff.DIFF_VALUE_CHANGED:
+                for changed_fields in self.__diff_data[diff_category].values():
+                    num += len(changed_fields)
+            else:
+                num += len(self.__diff_data[diff_category])
         return num
 
     def display(self):
         for diff_category in self.__diff_data.keys():
             print '** DIFF CATEGORY: %s' % diff_category
             i = 0
-            for resource_diff_key, resource_diff in self.__diff_data[diff_category].items():
+            for resource_diff_key in sorted(self.__diff_data[diff_category]):
+                resource_diff = self.__diff_data[diff_category][resource_diff_key]
                 i += 1
                 print '    [%s of %s] %s -- %s' % (
                     i, len(self.__diff_data[diff_category]), resource_diff_key, resource_diff)
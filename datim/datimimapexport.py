@@ -17,7 +17,11 @@ period (e.g. FY17). Export follows the format of the country mapping CSV templat
 ** Issues:
 1. Implement long-term method for populating the indicator category column (currently manually set a custom attribute)
 """
-import json
+import os
+import glob
+import tempfile
+import cPickle as pickle
+import gevent.pool
 import datimbase
 import datimimap
 import datimimapimport
@@ -45,6 +49,16 @@ class DatimImapExport(datimbase.DatimBase):
     Class to export PEPFAR country mapping metadata stored in OCL in various formats.
     """
 
+    # Format version of the DATIM-MOH indicator+disag index saved to disk -- increment to
+    # invalidate existing indexes if the index structure changes
+    DATIM_MOH_INDEX_FORMAT_VERSION = 1
+
+    # Serialized DATIM-MOH indexes already loaded by this process, keyed by (oclenv, endpoint, version ID)
+    _datim_moh_indexes = {}
+
+    # Maximum number of countries exported concurrently by get_imaps
+    DEFAULT_IMAP_EXPORT_MAX_WORKERS = 4
+
     def __init__(self, oclenv='', oclapitoken='', verbosity=0, run_ocl_offline=False):
         """
         Initialize an DatimImapExport object
@@ -59,6 +73,7 @@ class DatimImapExport(datimbase.DatimBase):
         self.oclenv = oclenv
         self.oclapitoken = oclapitoken
         self.run_ocl_offline = run_ocl_offline
+        self.imap_export_max_workers = self.DEFAULT_IMAP_EXPORT_MAX_WORKERS
 
         # Prepare the headers
         self.oclapiheaders = {
@@ -76,6 +91,179 @@ class DatimImapExport(datimbase.DatimBase):
         if self.run_ocl_offline:
             self.log('**** RUNNING OCL IN OFFLINE MODE ****')
 
+    def get_imaps(self, orgs, max_workers=None):
+        """
+        Generator that exports the IMAPs of multiple country orgs, yielding (org, imap, error) for
+        each org as soon as its export completes. The DATIM-MOH indicator+disag index is retrieved
+        once per period and shared by all countries of that period. Countries are exported
+        concurrently by a bounded pool of workers, so results are yielded in order of completion.
+        The collection exports of all countries share one concurrency limiter, so the batch stays
+        within the connection limit of the HTTP session and backs off as a whole.
+        :param orgs: List of IMAP orgs as returned by common.get_imap_orgs
+        :param max_workers: Maximum number of countries to export concurrently
+        :return: Generator of (org, <DatimImap> or None, <Exception> or None)
+        """
+        max_workers = max_workers or self.imap_export_max_workers
+        limiter = self.get_ocl_export_async_limiter()
+
+        # Get the DATIM-MOH index once for each period -- errors are reported for every org in the period
+        datim_indexes = {}
+        for org in orgs:
+            period = org['extras'].get('datim_moh_period')
+            if period not in datim_indexes:
+                try:
+                    datim_indexes[period] = self.get_datim_moh_index(period)
+                except Exception as e:
+                    datim_indexes[period] = e
+
+        def export_imap(org):
+            period = org['extras'].get('datim_moh_period')
+            if isinstance(datim_indexes[period], Exception):
+                return org, None, datim_indexes[period]
+            try:
+                imap = self.get_imap(
+                    period=period, country_org=org['id'],
+                    country_code=org['extras'].get('datim_moh_country_code'),
+                    datim_index=datim_indexes[period], limiter=limiter)
+            except Exception as e:
+                return org, None, e
+            return org, imap, None
+
+        pool = gevent.pool.Pool(max(max_workers, 1))
+        for result in pool.imap_unordered(export_imap, orgs):
+            yield result
+
+    def get_datim_moh_index(self, period):
+        """
+        Returns the serialized indicator+disag index of the latest released DATIM-MOH source version
+        for the period, building and saving it from the source export if it does not exist yet
+        :param period: FY18, FY19
+        :return: <str> serialized index (see build_datim_moh_index)
+        """
+        datim_source_endpoint = datimbase.DatimBase.get_datim_moh_source_endpoint(period)
+        datim_source_url = '%s%s' % (self.oclenv, datim_source_endpoint)
+        datim_version = datimimap.DatimImapFactory.get_repo_latest_period_version(
+            repo_url=datim_source_url, period=period, oclapitoken=self.oclapitoken)
+        if not datim_version:
+            msg = 'ERROR: %s does not exist or no valid repository version defined for period (e.g. FY19.v1)' % (
+                datim_source_endpoint)
+            self.vlog(1, msg)
+            raise DatimUnknownDatimPeriodError(msg)
+        datim_version_id = datim_version['id']
+        datim_index = self.load_datim_moh_index(datim_source_endpoint, datim_version_id)
+        if datim_index is not None:
+            self.vlog(1, 'Using saved indicator+disag index for "%s" version "%s"' % (
+                datim_source_endpoint, datim_version_id))
+            return datim_index
+        datim_source_zip_filename = self.endpoint2filename_ocl_export_zip(datim_source_endpoint)
+        datim_source_json_filename = self.endpoint2filename_ocl_export_json(datim_source_endpoint)
+        datim_source_items = self.iter_ocl_export_items(
+            endpoint=datim_source_endpoint, version=datim_version_id, keys=['concepts', 'mappings'],
+            zipfilename=datim_source_zip_filename, jsonfilename=datim_source_json_filename)
+        datim_index = self.build_datim_moh_index(datim_source_items)
+        self.save_datim_moh_index(datim_source_endpoint, datim_version_id, datim_index)
+        return datim_index
+
+    def build_datim_moh_index(self, datim_source_items):
+        """
+        Builds the DATIM-MOH indicator+disag structure from the concepts and mappings of a DATIM-MOH
+        source export. Only the attributes used to build an IMAP are kept.
+        :param datim_source_items: Iterator of (key, item) over the source concepts and mappings
+        :return: <str> serialized tuple of (indicators, disaggregate URLs), where indicators is a
+            dictionary of indicator concepts keyed by URL with their "Has Option" mappings
+        """
+        indicators = {}
+        disaggregates = set()
+        datim_mappings = []
+
+        # Split up the indicator and disaggregate concepts. Mappings are set aside until all
+        # indicators are known, since a streamed export may list mappings before concepts.
+        for export_key, export_item in datim_source_items:
+            if export_key == 'mappings':
+                if export_item['map_type'] == self.DATIM_MOH_MAP_TYPE_HAS_OPTION:
+                    datim_mappings.append(export_item)
+                else:
+                    self.vlog(1, 'SKIPPING: Unrecognized map type "%s" for mapping: %s' % (
+                        export_item['map_type'], str(export_item)))
+            elif export_item['concept_class'] == self.DATIM_MOH_CONCEPT_CLASS_DISAGGREGATE:
+                disaggregates.add(export_item['url'])
+            elif export_item['concept_class'] == self.DATIM_MOH_CONCEPT_CLASS_DE:
+                extras = None
+                if type(export_item.get('extras')) is dict and (
+                        datimimap.DatimImap.IMAP_INDICATOR_CATEGORY_CUSTOM_ATTRIBUTE in export_item['extras']):
+                    extras = {datimimap.DatimImap.IMAP_INDICATOR_CATEGORY_CUSTOM_ATTRIBUTE: export_item['extras'][
+                        datimimap.DatimImap.IMAP_INDICATOR_CATEGORY_CUSTOM_ATTRIBUTE]}
+                indicators[export_item['url']] = {
+                    'id': export_item['id'],
+                    'external_id': export_item['external_id'],
+                    'extras': extras,
+                    'mappings': [],
+                }
+
+        # Now attach the mappings to their indicators
+        for mapping in datim_mappings:
+            if mapping['from_concept_url'] not in indicators:
+                msg = 'ERROR: Missing indicator from_concept: %s' % (mapping['from_concept_url'])
+                self.vlog(1, msg)
+                raise Exception(msg)
+            indicators[mapping['from_concept_url']]['mappings'].append({
+                'from_concept_url': mapping['from_concept_url'],
+                'to_concept_url': mapping['to_concept_url'],
+                'to_concept_code': mapping['to_concept_code'],
+                'to_concept_name': mapping['to_concept_name'],
+            })
+
+        return pickle.dumps((indicators, disaggregates), pickle.HIGHEST_PROTOCOL)
+
+    def load_datim_moh_index(self, datim_source_endpoint, datim_version_id):
+        """
+        Returns the serialized DATIM-MOH indicator+disag index for the source version, first from
+        this process and then from the data folder, or None if it has not been built yet
+        """
+        index_key = (self.oclenv, datim_source_endpoint, datim_version_id)
+        if index_key in DatimImapExport._datim_moh_indexes:
+            return DatimImapExport._datim_moh_indexes[index_key]
+        index_filename = self.endpoint2filename_ocl_index(datim_source_endpoint, datim_version_id)
+        try:
+            with open(self.attach_absolute_data_path(index_filename), 'rb') as input_file:
+                index_attr = pickle.load(input_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if (index_attr.get('format_version') != self.DATIM_MOH_INDEX_FORMAT_VERSION or
+                index_attr.get('oclenv') != self.oclenv):
+            return None
+        DatimImapExport._datim_moh_indexes[index_key] = index_attr['index']
+        return index_attr['index']
+
+    def save_datim_moh_index(self, datim_source_endpoint, datim_version_id, datim_index):
+        """
+        Saves the serialized DATIM-MOH indicator+disag index for the source version and removes
+        indexes saved for other versions of the same source
+        """
+        DatimImapExport._datim_moh_indexes[(self.oclenv, datim_source_endpoint, datim_version_id)] = datim_index
+        index_filename = self.attach_absolute_data_path(
+            self.endpoint2filename_ocl_index(datim_source_endpoint, datim_version_id))
+
+        # Write to a temporary file first so that other processes never read a partial index
+        handle, temp_filename = tempfile.mkstemp(dir=os.path.dirname(index_filename))
+        with os.fdopen(handle, 'wb') as output_file:
+            pickle.dump({
+                'format_version': self.DATIM_MOH_INDEX_FORMAT_VERSION,
+                'oclenv': self.oclenv,
+                'index': datim_index,
+            }, output_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, index_filename)
+        self.vlog(1, 'DATIM-MOH indicator+disag index saved to "%s"' % index_filename)
+
+        # Remove indexes of superseded versions
+        for old_index_filename in glob.glob(self.attach_absolute_data_path(
+                self.endpoint2filename_ocl_index(datim_source_endpoint, '*'))):
+            if old_index_filename != index_filename:
+                try:
+                    os.remove(old_index_filename)
+                except OSError:
+                    pass
+
     @staticmethod
     def get_format_from_string(format_string, default_fmt='CSV'):
         """
@@ -89,7 +277,7 @@ class DatimImapExport(datimbase.DatimBase):
                 return fmt
         return default_fmt
 
-    def get_imap(self, period='', version='', country_org='', country_code=''):
+    def get_imap(self, period='', version='', country_org='', country_code='', datim_index=None, limiter=None):
         """
         Fetch JSON exports from OCL and build the IMAP export
         If version is not specified, then the latest released version for the given period will be used.
@@ -102,6 +290,10 @@ class DatimImapExport(datimbase.DatimBase):
             (or simply leave blank) to automatically retrieve the latest version for the specified period.
         :param country_org: DATIM-MOH-UA-FY19
         :param country_code: UA
+        :param datim_index: (Optional) DATIM-MOH indicator+disag index for the period returned by
+            get_datim_moh_index. Retrieved automatically if omitted.
+        :param limiter: (Optional) Concurrency limiter shared with other IMAP exports, passed to
+            get_ocl_exports_async
         :return:
         """
 
@@ -157,77 +349,35 @@ class DatimImapExport(datimbase.DatimBase):
         self.vlog(1, 'Using version "%s" for country "%s"' % (country_version_id, country_org))
         imap_timer.lap(label='STEP 2: Parse IMAP export parameters')
 
-        # STEP 3 of 8: Download DATIM-MOH-xx source for specified period (e.g. DATIM-MOH-FY18)
-        self.vlog(1, '**** STEP 3 of 8: Download DATIM-MOH source for specified period (e.g. DATIM-MOH-FY18)')
+        # STEP 3 of 8: Get DATIM-MOH-xx indicator+disag index for specified period (e.g. DATIM-MOH-FY18)
+        # NOTE: The structure is identical for every country in a period, so it is saved as an index
+        # for each DATIM-MOH source version and reused until a new version is released
+        self.vlog(1, '**** STEP 3 of 8: Get DATIM-MOH indicator+disag index for specified period (e.g. DATIM-MOH-FY18)')
         datim_moh_source_id = datimbase.DatimBase.get_datim_moh_source_id(period)
-        datim_source_endpoint = datimbase.DatimBase.get_datim_moh_source_endpoint(period)
-        datim_source_url = '%s%s' % (self.oclenv, datim_source_endpoint)
-        datim_version = datimimap.DatimImapFactory.get_repo_latest_period_version(
-            repo_url=datim_source_url, period=period, oclapitoken=self.oclapitoken)
-        if not datim_version:
-            msg = 'ERROR: %s does not exist or no valid repository version defined for period (e.g. FY19.v1)' % (
-                datim_source_endpoint)
-            self.vlog(1, msg)
-            raise DatimUnknownDatimPeriodError(msg)
-        datim_version_id = datim_version['id']
-        datim_source_zip_filename = self.endpoint2filename_ocl_export_zip(datim_source_endpoint)
-        datim_source_json_filename = self.endpoint2filename_ocl_export_json(datim_source_endpoint)
-        if not self.run_ocl_offline:
-            self.get_ocl_export(
-                endpoint=datim_source_endpoint, version=datim_version_id,
-                zipfilename=datim_source_zip_filename, jsonfilename=datim_source_json_filename)
-        else:
-            self.does_offline_data_file_exist(datim_source_json_filename, exit_if_missing=True)
-        imap_timer.lap(label='STEP 3: Download DATIM-MOH-xx source')
+        if datim_index is None:
+            datim_index = self.get_datim_moh_index(period)
+        imap_timer.lap(label='STEP 3: Get DATIM-MOH-xx indicator+disag index')
 
-        # STEP 4 of 8: Pre-process DATIM-MOH indicator+disag structure (before loading country source)
-        self.vlog(1, '**** STEP 4 of 8: Pre-process DATIM-MOH indicator+disag structure')
-        indicators = {}
-        disaggregates = {}
-        with open(self.attach_absolute_data_path(datim_source_json_filename), 'rb') as handle_datim_source:
-            datim_source = json.load(handle_datim_source)
-
-            # Split up the indicator and disaggregate concepts
-            for concept in datim_source['concepts']:
-                if concept['concept_class'] == self.DATIM_MOH_CONCEPT_CLASS_DISAGGREGATE:
-                    disaggregates[concept['url']] = concept.copy()
-                elif concept['concept_class'] == self.DATIM_MOH_CONCEPT_CLASS_DE:
-                    indicators[concept['url']] = concept.copy()
-                    indicators[concept['url']]['mappings'] = []
-
-            # Now iterate through the mappings
-            for mapping in datim_source['mappings']:
-                if mapping['map_type'] == self.DATIM_MOH_MAP_TYPE_HAS_OPTION:
-                    if mapping['from_concept_url'] not in indicators:
-                        msg = 'ERROR: Missing indicator from_concept: %s' % (mapping['from_concept_url'])
-                        self.vlog(1, msg)
-                        raise Exception(msg)
-                    indicators[mapping['from_concept_url']]['mappings'].append(mapping.copy())
-                else:
-                    self.vlog(1, 'SKIPPING: Unrecognized map type "%s" for mapping: %s' % (
-                        mapping['map_type'], str(mapping)))
-        imap_timer.lap(label='STEP 4: Pre-process DATIM-MOH indicator+disag structure')
+        # STEP 4 of 8: Load DATIM-MOH indicator+disag structure (before loading country source)
+        self.vlog(1, '**** STEP 4 of 8: Load DATIM-MOH indicator+disag structure')
+        indicators, disaggregates = pickle.loads(datim_index)
+        imap_timer.lap(label='STEP 4: Load DATIM-MOH indicator+disag structure')
 
         # STEP 5 of 8: Download and process country source
         # NOTE: This returns the individual country concepts and mappings
         self.vlog(1, '**** STEP 5 of 8: Download and process country source')
         country_source_zip_filename = self.endpoint2filename_ocl_export_zip(country_source_endpoint)
         country_source_json_filename = self.endpoint2filename_ocl_export_json(country_source_endpoint)
-        if not self.run_ocl_offline:
-            self.get_ocl_export(
-                endpoint=country_source_endpoint, version=country_version_id,
-                zipfilename=country_source_zip_filename, jsonfilename=country_source_json_filename)
-        else:
-            self.does_offline_data_file_exist(country_source_json_filename, exit_if_missing=True)
+        country_source_items = self.iter_ocl_export_items(
+            endpoint=country_source_endpoint, version=country_version_id, keys=['concepts'],
+            zipfilename=country_source_zip_filename, jsonfilename=country_source_json_filename)
         country_indicators = {}
         country_disaggregates = {}
-        with open(self.attach_absolute_data_path(country_source_json_filename), 'rb') as handle_country_source:
-            country_source = json.load(handle_country_source)
-            for concept in country_source['concepts']:
-                if concept['concept_class'] == self.DATIM_MOH_CONCEPT_CLASS_DISAGGREGATE:
-                    country_disaggregates[concept['url']] = concept.copy()
-                elif concept['concept_class'] == self.DATIM_MOH_CONCEPT_CLASS_DE:
-                    country_indicators[concept['url']] = concept.copy()
+        for export_key, concept in country_source_items:
+            if concept['concept_class'] == self.DATIM_MOH_CONCEPT_CLASS_DISAGGREGATE:
+                country_disaggregates[concept['url']] = concept.copy()
+            elif concept['concept_class'] == self.DATIM_MOH_CONCEPT_CLASS_DE:
+                country_indicators[concept['url']] = concept.copy()
         imap_timer.lap(label='STEP 5: Download and process country source')
 
         # STEP 6 of 8: Async download of country indicator+disag collections
@@ -238,7 +388,8 @@ class DatimImapExport(datimbase.DatimBase):
         if self.run_ocl_offline:
             self.vlog(1, 'WARNING: Offline not supported here yet. Taking this ship online!')
         country_collections = self.get_ocl_exports_async(
-            endpoint=country_collections_endpoint, period=period, version=country_minor_version)
+            endpoint=country_collections_endpoint, period=period, version=country_minor_version,
+            limiter=limiter)
         imap_timer.lap(label='STEP 5: Async download of country indicator+disag mappings')
 
         # STEP 7 of 8: Process one country collection at a time
@@ -15,13 +15,17 @@ The import script creates OCL-formatted JSON consisting of:
 TODO: Exclude "null-disag" update from the import scripts -- this does not have any effect, its just an unnecessary step
 """
 import json
+import time
+import multiprocessing
+import gevent
+import gevent.pool
 import datimbase
 import datimimap
 import ocldev.oclfleximporter
-import ocldev.oclexport
 import ocldev.oclconstants
 import ocldev.oclresourcelist
 import utils.timer
+import utils.oclexportcache
 
 
 class ImapCountryLockedForPeriodError(Exception):
@@ -29,6 +33,11 @@ class ImapCountryLockedForPeriodError(Exception):
     pass
 
 
+class ImapDuplicateCountryOrgError(Exception):
+    """ ImapDuplicateCountryOrgError: IMAP skipped because a later IMAP for the same country org is imported """
+    pass
+
+
 class DatimImapImport(datimbase.DatimBase):
     """
     Class to import DATIM country indicator mapping metadata into OCL.
@@ -38,6 +47,12 @@ class DatimImapImport(datimbase.DatimBase):
     DATIM_IMAP_RESULT_WARNING = 0
     DATIM_IMAP_RESULT_ERROR = -1
 
+    # Default number of IMAPs that import_imaps prepares and submits to OCL concurrently
+    DEFAULT_MAX_CONCURRENT_IMPORTS = 4
+
+    # Default number of worker processes that import_imaps uses to validate IMAPs and generate import scripts
+    DEFAULT_IMPORT_MAX_WORKERS = 2
+
     def __init__(self, oclenv='', oclapitoken='', verbosity=0, run_ocl_offline=False,
                  test_mode=False, country_public_access='View'):
         datimbase.DatimBase.__init__(self)
@@ -54,10 +69,12 @@ class DatimImapImport(datimbase.DatimBase):
             'Content-Type': 'application/json'
         }
 
-    def import_imap(self, imap_input=None):
+    def import_imap(self, imap_input=None, datim_moh_source_export=None):
         """
         Import the specified IMAP into OCL
         :param imap_input: IMAP to import
+        :param datim_moh_source_export: (Optional) OclExport of the DATIM-MOH source for the IMAP period
+            returned by get_datim_moh_source_export. Retrieved automatically if omitted.
         :return: OCL bulk import status ID if successfully submitted. None if nothing to import.
         """
 
@@ -71,33 +88,14 @@ class DatimImapImport(datimbase.DatimBase):
         imap_timer = utils.timer.Timer()
         imap_timer.start()
         self.vlog(1, '**** STEP 1 of 5: Make sure an import for same country+period is not underway')
-        status_filter = ['PENDING', 'STARTED']
-        queued_imports = ocldev.oclfleximporter.OclBulkImporter.get_queued_imports(
-            api_url_root=self.oclenv, api_token=self.oclapitoken, queue=imap_input.country_org,
-            status_filter=status_filter)
-        if queued_imports:
-            err_msg = 'IMAP import is already underway for same country and period: %s' % (
-                imap_input.country_org)
-            raise ImapCountryLockedForPeriodError(err_msg)
+        self.check_import_queue(imap_input.country_org)
         imap_timer.lap(label='STEP 1: Make sure an import for same country+period is not underway')
 
         # STEP 2 of 5: Download PEPFAR/DATIM-MOH-FY## export for specified period from OCL
         self.vlog(1, '**** STEP 2 of 5: Download PEPFAR/DATIM-MOH-FY## export for specified period')
+        if datim_moh_source_export is None:
+            datim_moh_source_export = self.get_datim_moh_source_export(imap_input.period)
         self.datim_moh_source_id = datimbase.DatimBase.get_datim_moh_source_id(imap_input.period)
-        datim_source_endpoint = datimbase.DatimBase.get_datim_moh_source_endpoint(imap_input.period)
-        datim_source_version = self.get_latest_version_for_period(
-            repo_endpoint=datim_source_endpoint, period=imap_input.period)
-        if not datim_source_version:
-            msg = 'ERROR: Could not find released version for period "%s" for source "%s"' % (
-                imap_input.period, datim_source_endpoint)
-            self.vlog(1, msg)
-            raise Exception(msg)
-        self.vlog(1, 'Latest version found for period "%s" for source "%s": "%s"' % (
-            imap_input.period, datim_source_endpoint, datim_source_version))
-        datim_moh_source_export = ocldev.oclexport.OclExportFactory.load_export(
-            repo_version_url='%s%s/%s/' % (
-                self.oclenv, datim_source_endpoint, datim_source_version),
-            oclapitoken=self.oclapitoken)
         imap_timer.lap(label='STEP 3: Download DATIM-MOH-FYxx Export')
 
         # STEP 3 of 5: Validate input country mapping CSV file
@@ -116,21 +114,15 @@ class DatimImapImport(datimbase.DatimBase):
 
         # STEP 4 of 5: Generate IMAP import script
         self.vlog(1, '**** STEP 4 of 5: Generate IMAP import script')
-        import_list = ocldev.oclresourcelist.OclJsonResourceList()
         does_imap_org_exist = datimimap.DatimImapFactory.check_if_imap_org(
             org_id=imap_input.country_org, ocl_env_url=self.oclenv,
             ocl_api_token=self.oclapitoken, verbose=bool(self.verbosity))
         if does_imap_org_exist:
             self.vlog(1, 'Org "%s" already exists.' % imap_input.country_org)
-            import_list.append({
-                '__action': 'DELETE',
-                'type': 'Organization',
-                'id': imap_input.country_org
-            })
         else:
             self.vlog(1, 'Org "%s" not found.' % imap_input.country_org)
-        import_list.append(datimimap.DatimImapFactory.generate_resource_list_from_imap(
-            imap_input=imap_input, verbose=bool(self.verbosity)))
+        import_list = DatimImapImport.get_import_list(
+            imap_input, does_imap_org_exist=does_imap_org_exist, verbose=bool(self.verbosity))
         if self.verbosity >= 2:
             for resource in import_list:
                 print json.dumps(resource)
@@ -140,14 +132,9 @@ class DatimImapImport(datimbase.DatimBase):
         # NOTE: Everything is non-destructive up to this point. Changes are committed to OCL here.
         self.vlog(1, '**** STEP 5 of 5: Bulk import into OCL')
         if import_list and not self.test_mode:
-            self.vlog(1, 'Bulk importing %s resources to OCL...' % len(import_list))
-            # TODO: Implement better OclBulkImporter response -- a new class OclBulkImportResponse?
-            bulk_import_response = ocldev.oclfleximporter.OclBulkImporter.post(
-                input_list=import_list, api_token=self.oclapitoken, api_url_root=self.oclenv,
-                queue=imap_input.country_org)
-            bulk_import_response.raise_for_status()
-            task_id = bulk_import_response.json()['task']
-            self.vlog(1, 'BULK IMPORT TASK ID: %s' % task_id)
+            task_id = self.post_bulk_import(import_list, queue=imap_input.country_org)
+            if does_imap_org_exist:
+                self.remove_cached_org_exports(imap_input.country_org)
             imap_timer.stop(label='STOP')
             self.vlog(1, '** IMAP import time breakdown:\n', imap_timer)
             return task_id
@@ -160,3 +147,195 @@ class DatimImapImport(datimbase.DatimBase):
             imap_timer.stop(label='STOP')
             self.vlog(1, '** IMAP import time breakdown:\n', imap_timer)
         return None
+
+    def check_import_queue(self, country_org):
+        """
+        Raises ImapCountryLockedForPeriodError if an import is already pending or in progress
+        in the OCL bulk import queue of the country org
+        """
+        status_filter = ['PENDING', 'STARTED']
+        queued_imports = ocldev.oclfleximporter.OclBulkImporter.get_queued_imports(
+            api_url_root=self.oclenv, api_token=self.oclapitoken, queue=country_org,
+            status_filter=status_filter)
+        if queued_imports:
+            err_msg = 'IMAP import is already underway for same country and period: %s' % (
+                country_org)
+            raise ImapCountryLockedForPeriodError(err_msg)
+
+    def get_datim_moh_source_export(self, period):
+        """
+        Returns OclExport of the latest released version of the DATIM-MOH source for the period
+        :param period: FY18, FY19
+        :return: <ocldev.oclexport.OclExport>
+        """
+        datim_source_endpoint = datimbase.DatimBase.get_datim_moh_source_endpoint(period)
+        datim_source_version = self.get_latest_version_for_period(
+            repo_endpoint=datim_source_endpoint, period=period)
+        if not datim_source_version:
+            msg = 'ERROR: Could not find released version for period "%s" for source "%s"' % (
+                period, datim_source_endpoint)
+            self.vlog(1, msg)
+            raise Exception(msg)
+        self.vlog(1, 'Latest version found for period "%s" for source "%s": "%s"' % (
+            period, datim_source_endpoint, datim_source_version))
+        return utils.oclexportcache.load_export(
+            repo_version_url='%s%s/%s/' % (self.oclenv, datim_source_endpoint, datim_source_version),
+            oclapitoken=self.oclapitoken)
+
+    @staticmethod
+    def get_import_list(imap_input, does_imap_org_exist=False, verbose=False):
+        """
+        Returns the OclJsonResourceList to import the IMAP into OCL, replacing the country org
+        if it already exists
+        """
+        import_list = ocldev.oclresourcelist.OclJsonResourceList()
+        if does_imap_org_exist:
+            import_list.append({
+                '__action': 'DELETE',
+                'type': 'Organization',
+                'id': imap_input.country_org
+            })
+        import_list.append(datimimap.DatimImapFactory.generate_resource_list_from_imap(
+            imap_input=imap_input, verbose=verbose))
+        return import_list
+
+    def remove_cached_org_exports(self, country_org):
+        """
+        Removes the cached exports of a country org that is replaced by an import, since its
+        repository versions are recreated under the same URLs
+        """
+        datimbase.DatimBase.get_ocl_export_cache().remove_url_prefix('%s/orgs/%s/' % (self.oclenv, country_org))
+
+    def post_bulk_import(self, import_list, queue=''):
+        """ Submits the import list to the OCL bulk import queue and returns the bulk import task ID """
+        self.vlog(1, 'Bulk importing %s resources to OCL...' % len(import_list))
+        # TODO: Implement better OclBulkImporter response -- a new class OclBulkImportResponse?
+        bulk_import_response = ocldev.oclfleximporter.OclBulkImporter.post(
+            input_list=import_list, api_token=self.oclapitoken, api_url_root=self.oclenv,
+            queue=queue)
+        bulk_import_response.raise_for_status()
+        task_id = bulk_import_response.json()['task']
+        self.vlog(1, 'BULK IMPORT TASK ID: %s' % task_id)
+        return task_id
+
+    def import_imaps(self, imap_inputs, max_concurrent_imports=None, max_workers=None):
+        """
+        Generator that imports multiple IMAPs into OCL, yielding (imap_input, task_id, error) for
+        each IMAP as soon as it is submitted or fails. IMAPs are grouped by period so that each
+        DATIM-MOH source export is loaded only once. Validation and import script generation
+        run in a pool of worker processes, and up to max_concurrent_imports IMAPs are checked
+        and submitted to OCL at a time. Only one IMAP is imported per country org, since OCL
+        processes the imports of a country org sequentially in its own queue: if the same
+        country org is listed more than once, the last IMAP is imported and the others are
+        yielded first with an ImapDuplicateCountryOrgError.
+        :param imap_inputs: List of DatimImap objects
+        :param max_concurrent_imports: Maximum number of IMAPs submitted concurrently
+        :param max_workers: Number of worker processes for validation and script generation.
+            Set to 1 to run in the current process.
+        :return: Generator of (<DatimImap>, task_id or None, <Exception> or None)
+        """
+        max_concurrent_imports = max_concurrent_imports or self.DEFAULT_MAX_CONCURRENT_IMPORTS
+        max_workers = max_workers or self.DEFAULT_IMPORT_MAX_WORKERS
+
+        # Keep the last IMAP for each country org and group them by period
+        imap_inputs_by_country_org = {}
+        for imap_input in imap_inputs:
+            if imap_input.country_org in imap_inputs_by_country_org:
+                msg = 'SKIPPING: Duplicate IMAP for "%s" replaced by a later IMAP' % imap_input.country_org
+                self.vlog(1, msg)
+                yield (imap_inputs_by_country_org[imap_input.country_org], None,
+                       ImapDuplicateCountryOrgError(msg))
+            imap_inputs_by_country_org[imap_input.country_org] = imap_input
+        imap_inputs = sorted(imap_inputs_by_country_org.values(), key=lambda x: (x.period, x.country_org))
+        num_imaps = len(imap_inputs)
+
+        # Load each DATIM-MOH source export once -- errors are reported for every IMAP in the period
+        datim_moh_source_exports = {}
+        for imap_input in imap_inputs:
+            if imap_input.period not in datim_moh_source_exports:
+                try:
+                    datim_moh_source_exports[imap_input.period] = self.get_datim_moh_source_export(
+                        imap_input.period)
+                except Exception as e:
+                    datim_moh_source_exports[imap_input.period] = e
+
+        loaded_datim_moh_source_exports = {
+            period: source_export for period, source_export in datim_moh_source_exports.items()
+            if not isinstance(source_export, Exception)}
+        process_pool = None
+        if max_workers > 1:
+            process_pool = multiprocessing.Pool(
+                processes=max_workers, initializer=_init_import_worker,
+                initargs=(loaded_datim_moh_source_exports,))
+        else:
+            _init_import_worker(loaded_datim_moh_source_exports)
+
+        def import_one(imap_input):
+            if isinstance(datim_moh_source_exports[imap_input.period], Exception):
+                return imap_input, None, datim_moh_source_exports[imap_input.period]
+            try:
+                self.check_import_queue(imap_input.country_org)
+                does_imap_org_exist = datimimap.DatimImapFactory.check_if_imap_org(
+                    org_id=imap_input.country_org, ocl_env_url=self.oclenv,
+                    ocl_api_token=self.oclapitoken, verbose=bool(self.verbosity))
+                task_args = (imap_input, does_imap_org_exist)
+                if process_pool:
+                    # Wait without blocking the other imports
+                    async_result = process_pool.apply_async(_generate_import_list, (task_args,))
+                    while not async_result.ready():
+                        gevent.sleep(0.1)
+                    import_list, warnings = async_result.get()
+                else:
+                    import_list, warnings = _generate_import_list(task_args)
+                if warnings:
+                    self.vlog(1, 'WARNING: The following warnings were found in the IMAP for "%s":\n' % (
+                        imap_input.country_org), warnings)
+                else:
+                    self.vlog(1, 'The IMAP for "%s" passed validation' % imap_input.country_org)
+                task_id = None
+                if import_list and not self.test_mode:
+                    task_id = self.post_bulk_import(import_list, queue=imap_input.country_org)
+                    if does_imap_org_exist:
+                        self.remove_cached_org_exports(imap_input.country_org)
+            except Exception as e:
+                return imap_input, None, e
+            return imap_input, task_id, None
+
+        # Import the IMAPs and report progress as each one completes
+        start_time = time.time()
+        num_completed = 0
+        pool = gevent.pool.Pool(max(max_concurrent_imports, 1))
+        try:
+            for result in pool.imap_unordered(import_one, imap_inputs):
+                num_completed += 1
+                elapsed_seconds = time.time() - start_time
+                self.vlog(1, '[IMAP %s of %s] %s: %s (%.1f IMAPs/minute)' % (
+                    num_completed, num_imaps, result[0].country_org,
+                    'Error' if result[2] else 'Submitted',
+                    num_completed * 60.0 / elapsed_seconds if elapsed_seconds else 0))
+                yield result
+        finally:
+            if process_pool:
+                process_pool.close()
+                process_pool.join()
+
+
+# DATIM-MOH source exports keyed by period, set in each import_imaps worker process
+_import_worker_datim_moh_source_exports = {}
+
+
+def _init_import_worker(datim_moh_source_exports):
+    global _import_worker_datim_moh_source_exports
+    _import_worker_datim_moh_source_exports = datim_moh_source_exports
+
+
+def _generate_import_list(task_args):
+    """
+    Validates an IMAP and returns (import_list, warnings), where warnings is the string returned by
+    DatimImap.is_valid or None if the IMAP passed validation. Runs in an import_imaps worker process.
+    """
+    imap_input, does_imap_org_exist = task_args
+    is_valid = imap_input.is_valid(
+        datim_moh_source_export=_import_worker_datim_moh_source_exports[imap_input.period])
+    warnings = is_valid if type(is_valid) == str else None
+    return DatimImapImport.get_import_list(imap_input, does_imap_org_exist=does_imap_org_exist), warnings
@@ -1,15 +1,61 @@
 """
 Shared class for custom presentations (i.e. shows) of DATIM metadata
 """
+import os
 import csv
 import sys
 import json
-from xml.etree.ElementTree import Element
-from xml.etree.ElementTree import SubElement
-from xml.etree.ElementTree import tostring
+import glob
+import hashlib
+import tempfile
+import cPickle as pickle
+import settings
 import datimbase
 
 
+class TeeOutputFile(object):
+    """ File-like object that writes to several files at once """
+
+    def __init__(self, *output_files):
+        self.output_files = output_files
+
+    def write(self, data):
+        for output_file in self.output_files:
+            output_file.write(data)
+
+    def flush(self):
+        for output_file in self.output_files:
+            output_file.flush()
+
+
+class BufferedOutputFile(object):
+    """ File-like object that collects small writes and passes them on in large chunks """
+
+    DEFAULT_BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, output_file, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.output_file = output_file
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered_size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered_size += len(data)
+        if self.buffered_size >= self.buffer_size:
+            self.write_buffer()
+
+    def write_buffer(self):
+        if self.buffer:
+            self.output_file.write(''.join(self.buffer))
+            self.buffer = []
+            self.buffered_size = 0
+
+    def flush(self):
+        self.write_buffer()
+        self.output_file.flush()
+
+
 class DatimShow(datimbase.DatimBase):
     """
     Shared class for custom presentations (i.e. shows) of DATIM metadata
@@ -27,6 +73,12 @@ class DatimShow(datimbase.DatimBase):
         DATIM_FORMAT_CSV
     ]
 
+    # Formats that can be rendered while rows are built, i.e. without the row count up front
+    STREAMING_FORMATS = [
+        DATIM_FORMAT_HTML,
+        DATIM_FORMAT_CSV
+    ]
+
     # Set to True to only allow presentation of OCL repositories explicitly
     # defined in OCL_EXPORT_DEFS
     REQUIRE_OCL_EXPORT_DEFINITION = False
@@ -37,15 +89,38 @@ class DatimShow(datimbase.DatimBase):
     # Default endpoint to use if unspecified OCL export
     DEFAULT_REPO_LIST_ENDPOINT = ''
 
+    # Increment to invalidate previously rendered output, e.g. when a show_build_row_method changes
+    RENDER_CACHE_FORMAT_VERSION = 1
+
+    # Increment when the structure of the concept index built by build_concept_index changes
+    CONCEPT_INDEX_FORMAT_VERSION = 1
+
+    # Map types of the mappings kept with each concept in the concept index
+    CONCEPT_INDEX_MAP_TYPES = [datimbase.DatimBase.DATIM_MOH_MAP_TYPE_HAS_OPTION]
+
+    # Concept indexes loaded by this process, keyed by (oclenv, repo endpoint, repo version ID).
+    # Only the most recently used version of each repo is kept (see remember_concept_index).
+    _concept_indexes = {}
+
     def __init__(self):
         datimbase.DatimBase.__init__(self)
         self.run_ocl_offline = False
         self.cache_intermediate = True
+        # Serve previously rendered output of the latest repo version from the data folder.
+        # Can also be disabled with CACHE_RENDERED_SHOWS in settings.
+        self.cache_rendered_output = getattr(settings, 'CACHE_RENDERED_SHOWS', True)
 
     def build_show_grid(self, repo_title='', repo_subtitle='', headers='',
                         concepts_with_mappings=None, input_filename='',
-                        show_build_row_method=''):
-        """ Builds the intermediate export from source data """
+                        show_build_row_method='', ocl_export=None, ocl_export_items=None,
+                        stream_rows=False):
+        """
+        Builds the intermediate export from source data: either a parsed OCL export, an iterator
+        of (key, item) over the concepts and mappings of an OCL export (see iter_ocl_export_items),
+        an OCL export saved to disk as input_filename, or a list of concepts_with_mappings.
+        If stream_rows is True, "rows" is an iterator that builds each row as it is rendered
+        and "height" is None, which is supported by the HTML and CSV formats only.
+        """
         # Setup the headers
         intermediate = {
             'title': repo_title,
@@ -56,28 +131,20 @@ class DatimShow(datimbase.DatimBase):
         }
         intermediate['width'] = len(intermediate['headers'])
 
-        # Read in the content from the file saved to disk
-        if input_filename:
-            with open(self.attach_absolute_data_path(input_filename), 'rb') as input_file:
-                ocl_export_raw = json.load(input_file)
-                raw_concepts_dict = {ocl_export_raw['concepts'][i]['url']: ocl_export_raw[
-                    'concepts'][i] for i in range(len(ocl_export_raw['concepts']))}
-                raw_mappings = ocl_export_raw['mappings']
-
-                # add the to_concepts to the mappings so that they are available to the
-                # "show_build_row_method" method
-                for i in range(len(raw_mappings)):
-                    to_concept_url = raw_mappings[i]['to_concept_url']
-                    if to_concept_url in raw_concepts_dict:
-                        raw_mappings[i]['to_concept'] = raw_concepts_dict[to_concept_url]
-
-                # Add the mappings to the from concepts
-                for concept_id in raw_concepts_dict:
-                    concept = raw_concepts_dict[concept_id]
-                    concept['mappings'] = [mapping for mapping in raw_mappings if str(
-                        mapping["from_concept_url"]) == concept['url']]
-
-                concepts_with_mappings = raw_concepts_dict.values()
+        # Read in the content from the file saved to disk if the export was not provided
+        if ocl_export is not None:
+            ocl_export_items = datimbase.DatimBase.iter_export_items(ocl_export, ['concepts', 'mappings'])
+        elif ocl_export_items is None and input_filename:
+            ocl_export_items = self.iter_json_file_items(input_filename, ['concepts', 'mappings'])
+        if ocl_export_items is not None:
+            raw_concepts_dict, mappings_by_from_concept_url = DatimShow.group_export_items(
+                ocl_export_items)
+
+            # Add the mappings to the from concepts
+            for concept_url, concept in raw_concepts_dict.iteritems():
+                concept['mappings'] = mappings_by_from_concept_url.get(concept_url, [])
+
+            concepts_with_mappings = raw_concepts_dict.values()
 
         elif isinstance(concepts_with_mappings, list):
             # These are already in the correct format
@@ -85,20 +152,58 @@ class DatimShow(datimbase.DatimBase):
         else:
             raise Exception('Must provide either "input_filename" or "concepts_with_mappings".')
 
-        if concepts_with_mappings:
-            for concept in concepts_with_mappings:
-                result = getattr(self, show_build_row_method)(
-                    concept, headers=headers, direct_mappings=concept['mappings'],
-                    repo_title=repo_title, repo_subtitle=repo_subtitle)
-                if result:
-                    if isinstance(result, dict):
-                        intermediate['rows'].append(result)
-                    elif isinstance(result, list):
-                        for item in result:
-                            intermediate['rows'].append(item)
+        rows = self.iter_show_grid_rows(
+            concepts_with_mappings or [], headers=headers, show_build_row_method=show_build_row_method,
+            repo_title=repo_title, repo_subtitle=repo_subtitle)
+        if stream_rows:
+            intermediate['rows'] = rows
+            intermediate['height'] = None
+        else:
+            intermediate['rows'] = list(rows)
             intermediate['height'] = len(intermediate['rows'])
         return intermediate
 
+    def iter_show_grid_rows(self, concepts_with_mappings, headers='', show_build_row_method='',
+                            repo_title='', repo_subtitle=''):
+        """ Generator yielding the output rows built for each concept by show_build_row_method """
+        build_row = getattr(self, show_build_row_method)
+        for concept in concepts_with_mappings:
+            result = build_row(
+                concept, headers=headers, direct_mappings=concept['mappings'],
+                repo_title=repo_title, repo_subtitle=repo_subtitle)
+            if result:
+                if isinstance(result, dict):
+                    yield result
+                elif isinstance(result, list):
+                    for item in result:
+                        yield item
+
+    @staticmethod
+    def group_export_items(ocl_export_items):
+        """
+        Indexes the concepts and mappings of an OCL export in a single pass. Each mapping's
+        to_concept is attached (if it is in the export) so that it is available to the
+        "show_build_row_method" method.
+        :param ocl_export_items: Iterator of (key, item) over the concepts and mappings of an export
+        :return: tuple of (<dict> of concept URL to concept,
+            <dict> of from_concept_url to <list> of mappings in export order)
+        """
+        concepts_by_url = {}
+        mappings_by_from_concept_url = {}
+        raw_mappings = []
+        for export_key, export_item in ocl_export_items:
+            if export_key == 'concepts':
+                concepts_by_url[export_item['url']] = export_item
+            else:
+                raw_mappings.append(export_item)
+                mappings_by_from_concept_url.setdefault(
+                    export_item['from_concept_url'], []).append(export_item)
+        for mapping in raw_mappings:
+            to_concept_url = mapping['to_concept_url']
+            if to_concept_url in concepts_by_url:
+                mapping['to_concept'] = concepts_by_url[to_concept_url]
+        return concepts_by_url, mappings_by_from_concept_url
+
     def default_show_build_row(self, concept, headers=None, direct_mappings=None,
                                repo_title='', repo_subtitle=''):
         """ Default method for building one output row in the presentation layer """
@@ -108,56 +213,56 @@ class DatimShow(datimbase.DatimBase):
         row[headers[0]['column']] = str(concept)
         return row
 
-    def transform_to_format(self, content, export_format):
+    def transform_to_format(self, content, export_format, output_file=None):
         """
         Displays the intermediate content in the requested export format
         :param content: Intermediate content shared by all formats
         :param export_format: Export format
+        :param output_file: File-like object to write to. Defaults to sys.stdout
         :return:
         """
+        output_file = output_file or sys.stdout
         if export_format == self.DATIM_FORMAT_HTML:
-            self.transform_to_html(content)
+            self.transform_to_html(content, output_file=output_file)
         elif export_format == self.DATIM_FORMAT_JSON:
-            self.transform_to_json(content)
+            self.transform_to_json(content, output_file=output_file)
         elif export_format == self.DATIM_FORMAT_XML:
-            self.transform_to_xml(content)
+            self.transform_to_xml(content, output_file=output_file)
         elif export_format == self.DATIM_FORMAT_CSV:
-            self.transform_to_csv(content)
+            self.transform_to_csv(content, output_file=output_file)
 
-    def transform_to_html(self, content):
-        """ Transform intermediate export to HTML """
+    def transform_to_html(self, content, output_file=None):
+        """ Transform intermediate export to HTML, writing each row as it is read from content """
+        output_file = BufferedOutputFile(output_file or sys.stdout)
         css = ('<style tye="text/css">.gridDiv {font-family:sans-serif, arial;}'
                'table.gridTable {border-collapse: collapse; font-size: 11pt;}'
                '.gridTable th,.gridTable td {padding: 8px 4px 7px 4px; border: 1px solid #e7e7e7;}'
                '.gridTable th {background-color: #f3f3f3; font-weight: bold;}</style>\n')
-        sys.stdout.write(css)
-        sys.stdout.write('<div class="gridDiv"><h3>%s</h3>\n' % content['title'].encode('utf-8'))
+        output_file.write(css)
+        output_file.write('<div class="gridDiv"><h3>%s</h3>\n' % content['title'].encode('utf-8'))
         if 'subtitle' in content and content['subtitle']:
-            sys.stdout.write('<h4>%s</h4>\n' % content['subtitle'].encode('utf-8'))
-        sys.stdout.write('<table class="gridTable">\n<thead><tr>')
+            output_file.write('<h4>%s</h4>\n' % content['subtitle'].encode('utf-8'))
+        output_file.write('<table class="gridTable">\n<thead><tr>')
         for header in content['headers']:
-            sys.stdout.write('<th>%s</th>' % str(header['name']))
-        sys.stdout.write('</tr></thead>\n<tbody>')
+            output_file.write('<th>%s</th>' % str(header['name']))
+        output_file.write('</tr></thead>\n<tbody>')
+        header_names = [header['name'] for header in content['headers']]
         for row in content['rows']:
-            sys.stdout.write('\n<tr>')
-            for header in content['headers']:
-                sys.stdout.write('<td>%s</td>' % str(row[header['name']].encode('utf-8')))
-        sys.stdout.write('</tr>')
-        sys.stdout.write('\n</tbody></table></div>')
-        sys.stdout.flush()
+            output_file.write('\n<tr>' + ''.join(
+                '<td>%s</td>' % str(row[header_name].encode('utf-8')) for header_name in header_names))
+        output_file.write('</tr>')
+        output_file.write('\n</tbody></table></div>')
+        output_file.flush()
 
-    def transform_to_json(self, content):
-        """ Transform intermediate export to JSON """
+    def transform_to_json(self, content, output_file=None):
+        """ Transform intermediate export to JSON, encoding and writing it in chunks """
+        output_file = BufferedOutputFile(output_file or sys.stdout)
         # convert the rows to lists in the same column order as the headers
-        reduced_rows = []
-        for row in content['rows']:
-            reduced_row = []
-            for header in content['headers']:
-                reduced_row.append(row[header['name']])
-            reduced_rows.append(reduced_row)
-        content['rows'] = reduced_rows
-        sys.stdout.write(json.dumps(content, indent=4, sort_keys=True))
-        sys.stdout.flush()
+        header_names = [header['name'] for header in content['headers']]
+        content['rows'] = [[row[header_name] for header_name in header_names] for row in content['rows']]
+        for chunk in json.JSONEncoder(indent=4, sort_keys=True).iterencode(content):
+            output_file.write(chunk)
+        output_file.flush()
 
     def xml_dict_clean(self, intermediate_data):
         """ Cleans data for XML export """
@@ -171,32 +276,73 @@ class DatimShow(datimbase.DatimBase):
             new_dict[key] = str(value)
         return new_dict
 
-    def transform_to_xml(self, content):
-        """ Transform intermediate export to XML """
+    @staticmethod
+    def get_xml_start_tag(tag, attrib=None, is_empty=False):
+        """ Returns an XML start tag (or empty element tag) serialized the same way as ElementTree """
+        xml_attrs = ''.join(' %s="%s"' % (key, DatimShow.xml_escape_attrib(attrib[key]))
+                            for key in sorted(attrib or {}))
+        return '<%s%s%s>' % (tag, xml_attrs, ' /' if is_empty else '')
+
+    @staticmethod
+    def xml_escape_text(text):
+        """ Escapes XML character data as ASCII, same as ElementTree.tostring """
+        text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        return text.encode('us-ascii', 'xmlcharrefreplace')
+
+    @staticmethod
+    def xml_escape_attrib(text):
+        """ Escapes an XML attribute value as ASCII, same as ElementTree.tostring """
+        text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        text = text.replace('"', '&quot;').replace('\n', '&#10;')
+        return text.encode('us-ascii', 'xmlcharrefreplace')
+
+    def transform_to_xml(self, content, output_file=None):
+        """
+        Transform intermediate export to XML, writing each row as it is read from content rather
+        than building the whole document in memory. Output is identical to ElementTree.tostring.
+        """
+        output_file = BufferedOutputFile(output_file or sys.stdout)
         top_attr = {
             'title': content['title'],
             'subtitle': content['subtitle'],
             'width': str(content['width']),
             'height': str(content['height'])
         }
-        top = Element('grid', top_attr)
-        headers = SubElement(top, 'headers')
-        for header in content['headers']:
-            SubElement(headers, 'header', self.xml_dict_clean(header))
-        rows = SubElement(top, 'rows')
+        output_file.write(DatimShow.get_xml_start_tag('grid', top_attr))
+        if content['headers']:
+            output_file.write('<headers>')
+            for header in content['headers']:
+                output_file.write(DatimShow.get_xml_start_tag(
+                    'header', self.xml_dict_clean(header), is_empty=True))
+            output_file.write('</headers>')
+        else:
+            output_file.write('<headers />')
+        has_rows = False
         for row_values in content['rows']:
-            row = SubElement(rows, 'row')
+            if not has_rows:
+                output_file.write('<rows>')
+                has_rows = True
+            if not row_values:
+                output_file.write('<row />')
+                continue
+            xml_fields = []
             for field_name in row_values:
-                field = SubElement(row, 'field')
-                field.text = row_values[field_name]
-        print tostring(top)
+                if row_values[field_name]:
+                    xml_fields.append('<field>%s</field>' % DatimShow.xml_escape_text(row_values[field_name]))
+                else:
+                    xml_fields.append('<field />')
+            output_file.write('<row>%s</row>' % ''.join(xml_fields))
+        output_file.write('</rows>' if has_rows else '<rows />')
+        output_file.write('</grid>\n')
+        output_file.flush()
 
-    def transform_to_csv(self, content):
-        """ Transform intermediate export to CSV """
+    def transform_to_csv(self, content, output_file=None):
+        """ Transform intermediate export to CSV, writing each row as it is read from content """
+        output_file = BufferedOutputFile(output_file or sys.stdout)
         fieldnames = []
         for header in content['headers']:
             fieldnames.append(header['name'])
-        writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
+        writer = csv.DictWriter(output_file, fieldnames=fieldnames)
         writer.writeheader()
         for row in content['rows']:
             # convert to utf-8 encoded strings
@@ -204,7 +350,7 @@ class DatimShow(datimbase.DatimBase):
             for key in row:
                 row_utf8[key] = row[key].encode('utf-8')
             writer.writerow(row_utf8)
-        sys.stdout.flush()
+        output_file.flush()
 
     @staticmethod
     def get_format_from_string(format_string, default_fmt='html'):
@@ -221,51 +367,44 @@ class DatimShow(datimbase.DatimBase):
         :param export_format: One of the supported export formats. See DATIM_FORMAT constants
         :return:
         """
-        repo_title = ''
-        repo_subtitle = ''
-        repo_endpoint = ''
-        show_build_row_method = ''
-        show_headers_key = ''
         if export_format not in self.PRESENTATION_FORMATS:
             export_format = self.DATIM_FORMAT_HTML
-
-        # Setup the export
-        if repo_id in self.OCL_EXPORT_DEFS:
-            repo_endpoint = self.OCL_EXPORT_DEFS[repo_id]['endpoint']
-            repo_title = self.OCL_EXPORT_DEFS[repo_id].get('title')
-            repo_subtitle = self.OCL_EXPORT_DEFS[repo_id].get('subtitle', '')
-            show_build_row_method = self.OCL_EXPORT_DEFS[repo_id].get('show_build_row_method', '')
-            show_headers_key = self.OCL_EXPORT_DEFS[repo_id].get('show_headers_key', '')
-        elif not self.REQUIRE_OCL_EXPORT_DEFINITION:
-            repo_endpoint = '%s%s/' % (self.DEFAULT_REPO_LIST_ENDPOINT, repo_id)
-            show_build_row_method = self.DEFAULT_SHOW_BUILD_ROW_METHOD
-        else:
-            msg = 'Unrecognized key "%s"' % repo_id
-            self.log(msg)
-            raise Exception(msg)
-        if not repo_title:
-            repo_title = repo_id
-        if not show_headers_key:
-            show_headers_key = self.headers.items()[0][0]
+        show_def = self.get_show_definition(repo_id)
+        repo_endpoint = show_def['endpoint']
+        repo_title = show_def['title']
+        repo_subtitle = show_def['subtitle']
+        show_build_row_method = show_def['show_build_row_method']
+        show_headers_key = show_def['show_headers_key']
 
         # STEP 1 of 4: Fetch latest version of relevant OCL repository export
         self.vlog(1, '**** STEP 1 of 4: Fetch latest version of relevant OCL repository export')
         self.vlog(1, '%s:' % repo_endpoint)
+        repo_version = 'latest'
+        render_key = ''
+        rendered_filename = ''
+        if self.cache_rendered_output and not self.run_ocl_offline:
+            repo_version = self.get_latest_version_id(repo_endpoint)
+            render_key = self.get_render_key(
+                repo_endpoint, repo_title, repo_subtitle, show_build_row_method, show_headers_key)
+            rendered_filename = self.attach_absolute_data_path(self.endpoint2filename_ocl_export_rendered(
+                repo_endpoint, repo_version, render_key, export_format))
+            if self.write_rendered_output(rendered_filename, sys.stdout):
+                self.vlog(1, 'Served previously rendered output from "%s"' % rendered_filename)
+                return
         zip_filename = self.endpoint2filename_ocl_export_zip(repo_endpoint)
         json_filename = self.endpoint2filename_ocl_export_json(repo_endpoint)
-        if not self.run_ocl_offline:
-            self.get_ocl_export(endpoint=repo_endpoint, version='latest', zipfilename=zip_filename,
-                                jsonfilename=json_filename)
-        else:
-            self.does_offline_data_file_exist(json_filename, exit_if_missing=True)
+        ocl_export_items = self.iter_ocl_export_items(
+            endpoint=repo_endpoint, version=repo_version, keys=['concepts', 'mappings'],
+            zipfilename=zip_filename, jsonfilename=json_filename)
 
-        # STEP 2 of 4: Transform OCL export to intermediary state
+        # STEP 2 of 4: Transform OCL export to intermediary state. Rows are built while they
+        # are rendered unless the intermediate is cached or the format needs the row count first.
         self.vlog(1, '**** STEP 2 of 4: Transform to intermediary state')
-        json_filename = self.endpoint2filename_ocl_export_json(repo_endpoint)
         intermediate = self.build_show_grid(
             repo_title=repo_title, repo_subtitle=repo_subtitle,
-            headers=self.headers[show_headers_key], input_filename=json_filename,
-            show_build_row_method=show_build_row_method)
+            headers=self.headers[show_headers_key], ocl_export_items=ocl_export_items,
+            show_build_row_method=show_build_row_method,
+            stream_rows=(not self.cache_intermediate and export_format in self.STREAMING_FORMATS))
 
         # STEP 3 of 4: Cache the intermediate output
         self.vlog(1, '**** STEP 3 of 4: Cache the intermediate output')
@@ -279,14 +418,249 @@ class DatimShow(datimbase.DatimBase):
 
         # STEP 4 of 4: Transform to requested format and stream
         self.vlog(1, '**** STEP 4 of 4: Transform to requested format and stream')
-        self.transform_to_format(intermediate, export_format)
+        if not rendered_filename:
+            self.transform_to_format(intermediate, export_format)
+            return
+
+        # Stream and save the rendered output at the same time. The output is written to a
+        # temporary file first so that a partially rendered file is never served.
+        handle, temp_filename = tempfile.mkstemp(dir=os.path.dirname(rendered_filename))
+        try:
+            with os.fdopen(handle, 'wb') as rendered_file:
+                self.transform_to_format(
+                    intermediate, export_format, output_file=TeeOutputFile(sys.stdout, rendered_file))
+            os.rename(temp_filename, rendered_filename)
+        except Exception:
+            if os.path.isfile(temp_filename):
+                os.remove(temp_filename)
+            raise
+        self.vlog(1, 'Rendered output saved to "%s"' % rendered_filename)
+        self.remove_superseded_rendered_output(repo_endpoint, repo_version, render_key, export_format)
+
+    def get_show_definition(self, repo_id):
+        """
+        Returns the endpoint, title, subtitle, show_build_row_method and show_headers_key used to
+        present the repo, from its OCL_EXPORT_DEF or the defaults for this class
+        :param repo_id: ID of the repo that matches an OCL_EXPORT_DEF key
+        :return: <dict>
+        """
+        repo_title = ''
+        repo_subtitle = ''
+        show_headers_key = ''
+        if repo_id in self.OCL_EXPORT_DEFS:
+            repo_endpoint = self.OCL_EXPORT_DEFS[repo_id]['endpoint']
+            repo_title = self.OCL_EXPORT_DEFS[repo_id].get('title')
+            repo_subtitle = self.OCL_EXPORT_DEFS[repo_id].get('subtitle', '')
+            show_build_row_method = self.OCL_EXPORT_DEFS[repo_id].get('show_build_row_method', '')
+            show_headers_key = self.OCL_EXPORT_DEFS[repo_id].get('show_headers_key', '')
+        elif not self.REQUIRE_OCL_EXPORT_DEFINITION:
+            repo_endpoint = '%s%s/' % (self.DEFAULT_REPO_LIST_ENDPOINT, repo_id)
+            show_build_row_method = self.DEFAULT_SHOW_BUILD_ROW_METHOD
+        else:
+            msg = 'Unrecognized key "%s"' % repo_id
+            self.log(msg)
+            raise Exception(msg)
+        if not repo_title:
+            repo_title = repo_id
+        if not show_headers_key:
+            show_headers_key = self.headers.items()[0][0]
+        return {
+            'endpoint': repo_endpoint,
+            'title': repo_title,
+            'subtitle': repo_subtitle,
+            'show_build_row_method': show_build_row_method,
+            'show_headers_key': show_headers_key,
+        }
 
-    def getByDataElementIds(self, data_element_ids='', export_format=''):
+    def get_render_key(self, repo_endpoint, repo_title, repo_subtitle, show_build_row_method,
+                       show_headers_key):
         """
-        Change "get" to a router function that routes the request to getByDataElementIds or getByExport
-        Get the a repository in the specified format
-        :param data_element_ids: ID of the datim element id's
+        Returns a short digest of everything other than the repo version and format that the
+        rendered output of a repo depends on, used to name the rendered output file
+        """
+        render_attr = [self.RENDER_CACHE_FORMAT_VERSION, self.oclenv, type(self).__name__, repo_endpoint,
+                       repo_title, repo_subtitle, show_build_row_method, show_headers_key]
+        return hashlib.sha1(json.dumps(render_attr)).hexdigest()[:12]
+
+    @staticmethod
+    def write_rendered_output(rendered_filename, output_file, chunk_size=64 * 1024):
+        """
+        Copies previously rendered output to output_file
+        :return: bool True if the rendered output exists; False otherwise
+        """
+        try:
+            input_file = open(rendered_filename, 'rb')
+        except IOError:
+            return False
+        with input_file:
+            chunk = input_file.read(chunk_size)
+            while chunk:
+                output_file.write(chunk)
+                chunk = input_file.read(chunk_size)
+        output_file.flush()
+        return True
+
+    def remove_superseded_rendered_output(self, repo_endpoint, repo_version, render_key, export_format):
+        """ Removes output rendered for any other version of the repo with the same render key """
+        rendered_filename = self.attach_absolute_data_path(self.endpoint2filename_ocl_export_rendered(
+            repo_endpoint, repo_version, render_key, export_format))
+        for old_rendered_filename in glob.glob(self.attach_absolute_data_path(
+                self.endpoint2filename_ocl_export_rendered(repo_endpoint, '*', render_key, export_format))):
+            if old_rendered_filename != rendered_filename:
+                try:
+                    os.remove(old_rendered_filename)
+                except OSError:
+                    pass
+
+    def getByDataElementIds(self, data_element_ids='', export_format='', repo_id=''):
+        """
+        Get the specified data elements of a repository in the specified format. Data elements
+        are looked up in a concept index of the latest repo version (see get_concept_index), so
+        only the first request for a repo version requires its export.
+        :param data_element_ids: List or comma-separated string of data element IDs. Each ID is
+            matched against concept IDs and then against concept external IDs (e.g. DHIS2 UIDs).
         :param export_format: One of the supported export formats. See DATIM_FORMAT constants
+        :param repo_id: ID of the repo that matches an OCL_EXPORT_DEF key. Required.
         :return:
         """
-        return None
+        if not repo_id:
+            msg = 'A repo_id is required to look up data elements'
+            self.log(msg)
+            raise Exception(msg)
+        if export_format not in self.PRESENTATION_FORMATS:
+            export_format = self.DATIM_FORMAT_HTML
+        if isinstance(data_element_ids, basestring):
+            data_element_ids = data_element_ids.split(',')
+        if not isinstance(data_element_ids, list):
+            raise Exception('Invalid list of data element IDs: %s' % str(data_element_ids))
+        show_def = self.get_show_definition(repo_id)
+
+        # STEP 1 of 3: Get the concept index of the latest repo version
+        self.vlog(1, '**** STEP 1 of 3: Get the concept index of the latest repo version')
+        concept_index = self.get_concept_index(show_def['endpoint'])
+
+        # STEP 2 of 3: Look up the data elements and transform to intermediary state
+        self.vlog(1, '**** STEP 2 of 3: Look up data elements and transform to intermediary state')
+        concepts_with_mappings = []
+        concept_ids = set()
+        for data_element_id in data_element_ids:
+            data_element_id = data_element_id.strip()
+            concept_id = data_element_id
+            if concept_id not in concept_index['concepts']:
+                concept_id = concept_index['external_ids'].get(data_element_id)
+            if concept_id is None:
+                self.vlog(1, 'NOT FOUND: %s' % data_element_id)
+                continue
+            if concept_id not in concept_ids:
+                concept_ids.add(concept_id)
+                concepts_with_mappings.append(concept_index['concepts'][concept_id])
+        intermediate = self.build_show_grid(
+            repo_title=show_def['title'], repo_subtitle=show_def['subtitle'],
+            headers=self.headers[show_def['show_headers_key']],
+            concepts_with_mappings=concepts_with_mappings,
+            show_build_row_method=show_def['show_build_row_method'])
+
+        # STEP 3 of 3: Transform to requested format and stream
+        self.vlog(1, '**** STEP 3 of 3: Transform to requested format and stream')
+        self.transform_to_format(intermediate, export_format)
+
+    def get_concept_index(self, repo_endpoint):
+        """
+        Returns the concept index of the latest version of the repo, first from this process, then
+        from the data folder, and otherwise built from the repo export and saved. In offline mode,
+        the index is built from the saved export and is not saved.
+        :param repo_endpoint: endpoint for repo only, e.g. '/orgs/myorg/sources/mysource/'
+        :return: <dict> (see build_concept_index)
+        """
+        if self.run_ocl_offline:
+            repo_version_id = 'latest'
+        else:
+            repo_version_id = self.get_latest_version_id(repo_endpoint)
+        concept_index = self.load_concept_index(repo_endpoint, repo_version_id)
+        if concept_index is not None:
+            self.vlog(1, 'Using saved concept index for "%s" version "%s"' % (repo_endpoint, repo_version_id))
+            return concept_index
+        ocl_export_items = self.iter_ocl_export_items(
+            endpoint=repo_endpoint, version=repo_version_id, keys=['concepts', 'mappings'],
+            zipfilename=self.endpoint2filename_ocl_export_zip(repo_endpoint),
+            jsonfilename=self.endpoint2filename_ocl_export_json(repo_endpoint))
+        concept_index = self.build_concept_index(ocl_export_items)
+        if self.run_ocl_offline:
+            self.remember_concept_index(repo_endpoint, repo_version_id, concept_index)
+        else:
+            self.save_concept_index(repo_endpoint, repo_version_id, concept_index)
+        return concept_index
+
+    def build_concept_index(self, ocl_export_items):
+        """
+        Builds an index of the concepts of a repo export for looking up data elements by ID
+        :param ocl_export_items: Iterator of (key, item) over the concepts and mappings of an export
+        :return: <dict> with "concepts", a dictionary of concepts keyed by concept ID, each with
+            its mappings of the types in CONCEPT_INDEX_MAP_TYPES as "mappings", and "external_ids",
+            a dictionary of concept IDs keyed by external ID
+        """
+        concepts_by_url, mappings_by_from_concept_url = DatimShow.group_export_items(ocl_export_items)
+        concept_index = {'concepts': {}, 'external_ids': {}}
+        for concept_url, concept in concepts_by_url.iteritems():
+            concept['mappings'] = [
+                mapping for mapping in mappings_by_from_concept_url.get(concept_url, [])
+                if mapping.get('map_type') in self.CONCEPT_INDEX_MAP_TYPES]
+            concept_index['concepts'][concept['id']] = concept
+            if concept.get('external_id'):
+                concept_index['external_ids'][concept['external_id']] = concept['id']
+        return concept_index
+
+    def load_concept_index(self, repo_endpoint, repo_version_id):
+        """ Returns the saved concept index for the repo version, or None if it has not been built yet """
+        index_key = (self.oclenv, repo_endpoint, repo_version_id)
+        if index_key in DatimShow._concept_indexes:
+            return DatimShow._concept_indexes[index_key]
+        if self.run_ocl_offline:
+            return None
+        index_filename = self.endpoint2filename_ocl_concept_index(repo_endpoint, repo_version_id)
+        try:
+            with open(self.attach_absolute_data_path(index_filename), 'rb') as input_file:
+                index_attr = pickle.load(input_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if (index_attr.get('format_version') != self.CONCEPT_INDEX_FORMAT_VERSION or
+                index_attr.get('oclenv') != self.oclenv):
+            return None
+        self.remember_concept_index(repo_endpoint, repo_version_id, index_attr['index'])
+        return index_attr['index']
+
+    def remember_concept_index(self, repo_endpoint, repo_version_id, concept_index):
+        """ Keeps the concept index in this process, replacing indexes of other versions of the same repo """
+        for index_key in DatimShow._concept_indexes.keys():
+            if index_key[:2] == (self.oclenv, repo_endpoint) and index_key[2] != repo_version_id:
+                del DatimShow._concept_indexes[index_key]
+        DatimShow._concept_indexes[(self.oclenv, repo_endpoint, repo_version_id)] = concept_index
+
+    def save_concept_index(self, repo_endpoint, repo_version_id, concept_index):
+        """
+        Saves the concept index for the repo version and removes indexes saved for other
+        versions of the same repo
+        """
+        self.remember_concept_index(repo_endpoint, repo_version_id, concept_index)
+        index_filename = self.attach_absolute_data_path(
+            self.endpoint2filename_ocl_concept_index(repo_endpoint, repo_version_id))
+
+        # Write to a temporary file first so that other processes never read a partial index
+        handle, temp_filename = tempfile.mkstemp(dir=os.path.dirname(index_filename))
+        with os.fdopen(handle, 'wb') as output_file:
+            pickle.dump({
+                'format_version': self.CONCEPT_INDEX_FORMAT_VERSION,
+                'oclenv': self.oclenv,
+                'index': concept_index,
+            }, output_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, index_filename)
+        self.vlog(1, 'Concept index saved to "%s"' % index_filename)
+
+        # Remove indexes of superseded versions
+        for old_index_filename in glob.glob(self.attach_absolute_data_path(
+                self.endpoint2filename_ocl_concept_index(repo_endpoint, '*'))):
+            if old_index_filename != index_filename:
+                try:
+                    os.remove(old_index_filename)
+                except OSError:
+                    pass
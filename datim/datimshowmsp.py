@@ -6,7 +6,7 @@ See showmsp.py for an example of usage.
 Supported Formats: html, xml, csv, json
 """
 from __future__ import with_statement
-import requests
+import gevent.pool
 import datimshow
 import datimbase
 
@@ -25,6 +25,10 @@ class DatimShowMsp(datimshow.DatimShow):
 
     DEFAULT_SHOW_BUILD_ROW_METHOD = 'build_mer_data_element_output'
 
+    # Default number of data elements to fetch concurrently when a list of IDs is requested
+    # (kept within the per-host connection limit of the shared HTTP session)
+    DEFAULT_DATA_ELEMENT_MAX_WORKERS = 8
+
     # Output headers
     headers = {
         'msp': [
@@ -57,6 +61,7 @@ class DatimShowMsp(datimshow.DatimShow):
         self.run_ocl_offline = run_ocl_offline
         self.verbosity = verbosity
         self.cache_intermediate = cache_intermediate
+        self.data_element_max_workers = self.DEFAULT_DATA_ELEMENT_MAX_WORKERS
         self.oclapiheaders = {
             'Content-Type': 'application/json'
         }
@@ -75,19 +80,8 @@ class DatimShowMsp(datimshow.DatimShow):
                 data_element_ids = data_element_ids.split(',')
             if not isinstance(data_element_ids, list):
                 raise Exception('Invalid list of data element IDs: %s' % str(data_element_ids))
-            data_element_results = []
-            for data_element_id in data_element_ids:
-                data_element_url = '%s/%s/%s/sources/%s/concepts/%s/?includeMappings=true' % (
-                    self.oclenv, datimbase.DatimBase.owner_type_to_stem(owner_type),
-                    owner, source, str(data_element_id.strip()))
-                self.vlog(2, data_element_url)
-                data_element_response = requests.get(data_element_url, headers=self.oclapiheaders)
-                if data_element_response.status_code == 404:
-                    self.vlog(1, '404 NOT FOUND')
-                    continue
-                # For other errors, go ahead and raise an exception
-                data_element_response.raise_for_status()
-                data_element_results.append(data_element_response.json())
+            data_element_results = self.get_data_elements(
+                data_element_ids, owner=owner, owner_type=owner_type, source=source)
             intermediate = self.build_show_grid(
                 repo_title='Custom Query',
                 repo_subtitle='',
@@ -100,6 +94,34 @@ class DatimShowMsp(datimshow.DatimShow):
         else:
             raise Exception('Must provide either data_element_ids or repo_id.')
 
+    def get_data_elements(self, data_element_ids, owner='PEPFAR', owner_type='Organization', source='MER',
+                          max_workers=None):
+        """
+        Fetches data element concepts with their mappings from OCL. Requests are made concurrently
+        over the shared HTTP session by a bounded pool of workers.
+        :param data_element_ids: List of data element concept IDs
+        :param max_workers: Maximum number of concurrent requests
+        :return: <list> of concepts in the order requested. IDs that are not found are skipped.
+        """
+        max_workers = max_workers or self.data_element_max_workers
+
+        def fetch_data_element(data_element_id):
+            data_element_url = '%s/%s/%s/sources/%s/concepts/%s/?includeMappings=true' % (
+                self.oclenv, datimbase.DatimBase.owner_type_to_stem(owner_type),
+                owner, source, str(data_element_id.strip()))
+            self.vlog(2, data_element_url)
+            data_element_response = self.get_http_session().get(data_element_url, headers=self.oclapiheaders)
+            if data_element_response.status_code == 404:
+                self.vlog(1, '404 NOT FOUND: %s' % data_element_url)
+                return None
+            # For other errors, go ahead and raise an exception
+            data_element_response.raise_for_status()
+            return data_element_response.json()
+
+        pool = gevent.pool.Pool(max(max_workers, 1))
+        return [data_element for data_element in pool.imap(fetch_data_element, data_element_ids)
+                if data_element is not None]
+
     def build_mer_data_element_output(self, concept, headers=None, direct_mappings=None,
                                       repo_title='', repo_subtitle=''):
         """ Builds export rows  """
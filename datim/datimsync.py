@@ -14,18 +14,20 @@ Import batches should be structured as follows:
 }
 """
 import json
-import requests
+import hashlib
+import functools
 import os
 import sys
 import pprint
 import time
+import gevent.pool
 from requests.auth import HTTPBasicAuth
 from shutil import copyfile
-import deepdiff
 import datimbase
 import ocldev.oclconstants
 import ocldev.oclfleximporter
 import utils.timer
+import utils.jsonstream
 
 
 class DatimSync(datimbase.DatimBase):
@@ -46,6 +48,11 @@ class DatimSync(datimbase.DatimBase):
     DATIM_SYNC_NO_DIFF = 0
     DATIM_SYNC_DIFF = 1
 
+    # Diff categories returned by perform_diff for each import batch and resource type
+    DIFF_ITEM_ADDED = 'dictionary_item_added'
+    DIFF_ITEM_REMOVED = 'dictionary_item_removed'
+    DIFF_VALUES_CHANGED = 'values_changed'
+
     # Intended to be overwritten in a child class
     OCL_EXPORT_DEFS = {}
     DHIS2_QUERIES = {}
@@ -60,7 +67,13 @@ class DatimSync(datimbase.DatimBase):
     # Sets an upper limit for the number of concept references to include in a single API request
     CONSOLIDATED_REFERENCE_BATCH_LIMIT = 25
 
-    # Default fields to strip from OCL exports before performing deep diffs
+    # Version of the fingerprint table format -- tables saved in another format are ignored
+    FINGERPRINTS_FORMAT_VERSION = 2
+
+    # Maximum number of DHIS2 queries that are fetched concurrently
+    DEFAULT_DHIS2_MAX_CONCURRENT_QUERIES = 4
+
+    # Default fields to strip from OCL exports before performing diffs
     DEFAULT_CONCEPT_FIELDS_TO_REMOVE = ['version_created_by', 'created_on', 'updated_on',
                                         'version_created_on', 'created_by', 'updated_by', 'display_name',
                                         'display_locale', 'uuid', 'version', 'owner_url', 'source_url',
@@ -82,12 +95,17 @@ class DatimSync(datimbase.DatimBase):
         datimbase.DatimBase.__init__(self)
         self.dhis2_diff = {}
         self.ocl_diff = {}
+        self.dhis2_fingerprints = {}
+        self.ocl_fingerprints = {}
+        self.dhis2_skipped_sources = {}
+        self.ocl_skipped_sources = {}
         self.ocl_collections = []
         self.str_dataset_ids = ''
         self.run_dhis2_offline = False
         self.compare2previousexport = True
         self.import_limit = 0
         self.import_delay = 0
+        self.dhis2_max_concurrent_queries = self.DEFAULT_DHIS2_MAX_CONCURRENT_QUERIES
         self.diff_result = None
         self.sync_resource_types = None
         self.write_diff_to_file = True
@@ -113,21 +131,27 @@ class DatimSync(datimbase.DatimBase):
 
     def prepare_ocl_exports(self, cleaning_attr=None):
         """
-        Convert OCL exports into the diff format
+        Convert OCL exports into the diff format. Exports that are unchanged since the previous run are not
+        cleaned -- their resource fingerprints are reused from the previous run's fingerprint table instead.
         :param cleaning_attr: Optional cleaning attributes that are made available to each cleaning method
         :return: None
         """
+        previous_fingerprints = self.load_fingerprints(self.OCL_CLEANED_EXPORT_FILENAME)
+        self.ocl_fingerprints = {'format_version': self.FINGERPRINTS_FORMAT_VERSION, 'sources': {}}
+        self.ocl_skipped_sources = {}
         cnt = 0
         num_total = len(self.OCL_EXPORT_DEFS)
         for ocl_export_def_key, export_def in self.OCL_EXPORT_DEFS.iteritems():
             cnt += 1
             self.vlog(1, '** [OCL Export %s of %s] %s:' % (cnt, num_total, ocl_export_def_key))
             cleaning_method_name = export_def.get('cleaning_method', self.DEFAULT_OCL_EXPORT_CLEANING_METHOD)
-            getattr(self, cleaning_method_name)(export_def, cleaning_attr=cleaning_attr)
-        with open(self.attach_absolute_data_path(self.OCL_CLEANED_EXPORT_FILENAME), 'wb') as output_file:
-            output_file.write(json.dumps(self.ocl_diff))
-            self.vlog(1, 'Cleaned OCL exports successfully written to "%s"' % (
-                self.OCL_CLEANED_EXPORT_FILENAME))
+            source_digest = self.get_diff_source_digest(
+                datimbase.DatimBase.endpoint2filename_ocl_export_json(export_def['endpoint']),
+                cleaning_method_name, export_def, cleaning_attr)
+            self.prepare_diff_source(
+                'ocl_diff', self.ocl_fingerprints, self.ocl_skipped_sources, previous_fingerprints,
+                ocl_export_def_key, source_digest,
+                functools.partial(getattr(self, cleaning_method_name), export_def, cleaning_attr=cleaning_attr))
 
     @staticmethod
     def get_mapping_key_by_dict(m):
@@ -242,24 +266,33 @@ class DatimSync(datimbase.DatimBase):
         import_batch_key = ocl_export_def['import_batch']
         json_filename = datimbase.DatimBase.endpoint2filename_ocl_export_json(ocl_export_def['endpoint'])
         with open(self.attach_absolute_data_path(json_filename), 'rb') as input_file:
-            ocl_repo_export_raw = json.load(input_file)
+            if self.stream_json_exports:
+                # Only read the export attributes here -- source concepts and mappings are streamed below
+                ocl_repo_export_raw = utils.jsonstream.load_object_members(
+                    input_file, skip_keys=['concepts', 'mappings'])
+            else:
+                ocl_repo_export_raw = json.load(input_file)
 
             if ocl_repo_export_raw['type'] in ['Source', 'Source Version']:
 
-                # Concepts
+                # Concepts and mappings
                 num_concepts = 0
-                for c in ocl_repo_export_raw['concepts']:
-                    self.ocl_diff[import_batch_key][
-                        ocldev.oclconstants.OclConstants.RESOURCE_TYPE_CONCEPT][c['url']] = self.clean_concept(c)
-                    num_concepts += 1
-
-                # Mappings
                 num_mappings = 0
-                for m in ocl_repo_export_raw['mappings']:
-                    mapping_key = DatimSync.get_mapping_key_by_dict(m)
-                    self.ocl_diff[import_batch_key][
-                        ocldev.oclconstants.OclConstants.RESOURCE_TYPE_MAPPING][mapping_key] = self.clean_mapping(m)
-                    num_mappings += 1
+                if self.stream_json_exports:
+                    export_items = self.iter_json_file_items(json_filename, ['concepts', 'mappings'])
+                else:
+                    export_items = datimbase.DatimBase.iter_export_items(
+                        ocl_repo_export_raw, ['concepts', 'mappings'])
+                for export_key, export_item in export_items:
+                    if export_key == 'concepts':
+                        self.ocl_diff[import_batch_key][ocldev.oclconstants.OclConstants.RESOURCE_TYPE_CONCEPT][
+                            export_item['url']] = self.clean_concept(export_item)
+                        num_concepts += 1
+                    else:
+                        mapping_key = DatimSync.get_mapping_key_by_dict(export_item)
+                        self.ocl_diff[import_batch_key][ocldev.oclconstants.OclConstants.RESOURCE_TYPE_MAPPING][
+                            mapping_key] = self.clean_mapping(export_item)
+                        num_mappings += 1
 
                 self.vlog(1, 'Cleaned %s concepts and %s mappings' % (num_concepts, num_mappings))
 
@@ -306,20 +339,27 @@ class DatimSync(datimbase.DatimBase):
 
     def transform_dhis2_exports(self, conversion_attr=None):
         """
-        Transforms DHIS2 exports into the diff format
+        Transforms DHIS2 exports into the diff format. Exports that are unchanged since the previous run are not
+        converted -- their resource fingerprints are reused from the previous run's fingerprint table instead.
         TODO: Replace DHIS2_CONVERTED_EXPORT_FILENAME constant with a method in DatimBase
         :param conversion_attr: Optional conversion attributes that are made available to each conversion method
         :return: None
         """
+        previous_fingerprints = self.load_fingerprints(self.DHIS2_CONVERTED_EXPORT_FILENAME)
+        self.dhis2_fingerprints = {'format_version': self.FINGERPRINTS_FORMAT_VERSION, 'sources': {}}
+        self.dhis2_skipped_sources = {}
         cnt = 0
         for dhis2_query_key, dhis2_query_def in self.DHIS2_QUERIES.iteritems():
             cnt += 1
             self.vlog(1, '** [DHIS2 Export %s of %s] %s:' % (cnt, len(self.DHIS2_QUERIES), dhis2_query_key))
-            getattr(self, dhis2_query_def['conversion_method'])(dhis2_query_def, conversion_attr=conversion_attr)
-        with open(self.attach_absolute_data_path(self.DHIS2_CONVERTED_EXPORT_FILENAME), 'wb') as output_file:
-            output_file.write(json.dumps(self.dhis2_diff))
-            self.vlog(1, 'Transformed DHIS2 exports successfully written to "%s"' % (
-                self.DHIS2_CONVERTED_EXPORT_FILENAME))
+            source_digest = self.get_diff_source_digest(
+                datimbase.DatimBase.dhis2filename_export_new(dhis2_query_def['id']),
+                dhis2_query_def, conversion_attr)
+            self.prepare_diff_source(
+                'dhis2_diff', self.dhis2_fingerprints, self.dhis2_skipped_sources, previous_fingerprints,
+                dhis2_query_key, source_digest,
+                functools.partial(getattr(self, dhis2_query_def['conversion_method']), dhis2_query_def,
+                                  conversion_attr=conversion_attr))
 
     def save_dhis2_query_to_file(self, query='', query_attr=None, outputfilename=''):
         """ Execute DHIS2 query and save to file """
@@ -332,8 +372,8 @@ class DatimSync(datimbase.DatimBase):
         auth_info = None
         if self.dhis2uid and self.dhis2pwd:
             auth_info = HTTPBasicAuth(self.dhis2uid, self.dhis2pwd)
-        r = requests.get(
-            url_dhis2_query, auth=auth_info, verify=False)
+        r = self.get_http_session().get(
+            url_dhis2_query, auth=auth_info, verify=False, stream=True)
         r.raise_for_status()
         content_length = 0
         with open(self.attach_absolute_data_path(outputfilename), 'wb') as handle:
@@ -342,13 +382,272 @@ class DatimSync(datimbase.DatimBase):
                 content_length += len(block)
         return content_length
 
-    def perform_diff(self, ocl_diff=None, dhis2_diff=None):
+    @staticmethod
+    def get_canonical_resource(resource):
+        """
+        Returns a canonical, order-independent representation of a cleaned resource. Dictionary keys
+        are sorted and list items are sorted by their own canonical form, so that resources differing
+        only in the order of their names, descriptions, etc. have the same canonical form.
+        :param resource: Resource or resource field value
+        :return: JSON-serializable canonical form
+        """
+        if isinstance(resource, dict):
+            return [[k, DatimSync.get_canonical_resource(v)] for k, v in sorted(resource.iteritems())]
+        elif isinstance(resource, (list, tuple)):
+            return sorted(DatimSync.get_canonical_resource(v) for v in resource)
+        return resource
+
+    @staticmethod
+    def get_resource_digest(resource):
+        """
+        Returns an MD5 digest of the canonical form of a cleaned resource
+        :param resource: Resource or resource field value
+        :return: <str> hex digest
+        """
+        return hashlib.md5(json.dumps(DatimSync.get_canonical_resource(resource))).hexdigest()
+
+    @staticmethod
+    def get_fingerprints(diff_content):
+        """
+        Returns a fingerprint table with the digest of every resource in prepared diff content:
+            { import_batch_key: { resource_type: { resource_key: digest, ... }, ... }, ... }
+        :param diff_content: Cleaned OCL or converted DHIS2 content in the diff format
+        :return: <dict>
+        """
+        fingerprints = {}
+        for import_batch_key in diff_content:
+            fingerprints[import_batch_key] = {}
+            for resource_type in diff_content[import_batch_key]:
+                fingerprints[import_batch_key][resource_type] = dict(
+                    (resource_key, DatimSync.get_resource_digest(resource)) for resource_key, resource in
+                    diff_content[import_batch_key][resource_type].iteritems())
+        return fingerprints
+
+    @staticmethod
+    def get_merged_fingerprints(fingerprint_table):
+        """
+        Merges the per-source resource fingerprints of a fingerprint table into a single table in the
+        format returned by get_fingerprints
+        :param fingerprint_table: Fingerprint table of the OCL or DHIS2 content (see prepare_diff_source)
+        :return: <dict>
+        """
+        fingerprints = {}
+        for source_key in sorted(fingerprint_table.get('sources', {})):
+            source_fingerprints = fingerprint_table['sources'][source_key]['resources']
+            for import_batch_key in source_fingerprints:
+                for resource_type in source_fingerprints[import_batch_key]:
+                    fingerprints.setdefault(import_batch_key, {}).setdefault(resource_type, {}).update(
+                        source_fingerprints[import_batch_key][resource_type])
+        return fingerprints
+
+    @staticmethod
+    def has_unmatched_fingerprints(fingerprints, other_fingerprints):
+        """
+        Returns True if any resource in a fingerprint table is missing from or has a different digest in the
+        other fingerprint table, meaning that the resource must be materialized for the diff
+        :param fingerprints: <dict> in the format returned by get_fingerprints
+        :param other_fingerprints: <dict> in the format returned by get_fingerprints
+        :return: <bool>
+        """
+        for import_batch_key in fingerprints:
+            for resource_type in fingerprints[import_batch_key]:
+                other_digests = other_fingerprints.get(import_batch_key, {}).get(resource_type, {})
+                for resource_key, digest in fingerprints[import_batch_key][resource_type].iteritems():
+                    if other_digests.get(resource_key) != digest:
+                        return True
+        return False
+
+    def get_empty_diff_content(self):
+        """ Returns empty diff content with a dictionary for each import batch and sync resource type """
+        diff_content = {}
+        for import_batch_key in self.IMPORT_BATCHES:
+            diff_content[import_batch_key] = {}
+            for resource_type in self.sync_resource_types:
+                diff_content[import_batch_key][resource_type] = {}
+        return diff_content
+
+    def get_diff_source_digest(self, input_filename, *source_args):
+        """
+        Returns an MD5 digest of everything a cleaning or conversion method depends on: the export file
+        that it reads, the arguments it is called with and the resource types of the current run
+        :param input_filename: Name of the OCL or DHIS2 export file read by the method
+        :param source_args: JSON-serializable arguments of the method
+        :return: <str> hex digest
+        """
+        digest = hashlib.md5(json.dumps(
+            [self.FINGERPRINTS_FORMAT_VERSION, self.__class__.__name__, self.sync_resource_types, source_args],
+            sort_keys=True, default=str))
+        with open(self.attach_absolute_data_path(input_filename), 'rb') as input_file:
+            for block in iter(lambda: input_file.read(1024 * 1024), ''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def process_diff_source(self, diff_attr_name, process_method):
+        """
+        Runs a cleaning or conversion method against empty diff content, merges the resources that it
+        produced into the diff content and returns their fingerprints
+        :param diff_attr_name: 'ocl_diff' or 'dhis2_diff'
+        :param process_method: Cleaning or conversion method bound to its arguments
+        :return: <dict> fingerprints of the produced resources in the format returned by get_fingerprints
+        """
+        diff_content = getattr(self, diff_attr_name)
+        setattr(self, diff_attr_name, self.get_empty_diff_content())
+        try:
+            process_method()
+            source_content = getattr(self, diff_attr_name)
+        finally:
+            setattr(self, diff_attr_name, diff_content)
+        for import_batch_key in source_content:
+            for resource_type in source_content[import_batch_key]:
+                diff_content.setdefault(import_batch_key, {}).setdefault(resource_type, {}).update(
+                    source_content[import_batch_key][resource_type])
+        return DatimSync.get_fingerprints(source_content)
+
+    def prepare_diff_source(self, diff_attr_name, fingerprint_table, skipped_sources, previous_fingerprint_table,
+                            source_key, source_digest, process_method):
+        """
+        Adds a source (OCL export or DHIS2 query) to a fingerprint table. If the source digest matches the
+        previous run, the method is skipped and the previous resource fingerprints are reused -- the method is
+        only run later if the diff needs its resources (see materialize_diff_sources). Fingerprint table format:
+            { 'format_version': 2, 'sources': { source_key: { 'digest': source_digest, 'resources': {
+                import_batch_key: { resource_type: { resource_key: digest, ... }, ... }, ... } }, ... } }
+        :param diff_attr_name: 'ocl_diff' or 'dhis2_diff'
+        :param fingerprint_table: Fingerprint table of the current run
+        :param skipped_sources: <dict> source_key: process_method of the skipped sources
+        :param previous_fingerprint_table: Fingerprint table of the previous run or None
+        :param source_key: OCL export definition key or DHIS2 query key
+        :param source_digest: Digest returned by get_diff_source_digest
+        :param process_method: Cleaning or conversion method bound to its arguments
+        :return: None
+        """
+        previous_source = (previous_fingerprint_table or {}).get('sources', {}).get(source_key)
+        if previous_source and previous_source['digest'] == source_digest:
+            self.vlog(1, 'SKIPPING: Unchanged since the previous run, reusing its resource fingerprints')
+            skipped_sources[source_key] = process_method
+            resource_fingerprints = previous_source['resources']
+        else:
+            resource_fingerprints = self.process_diff_source(diff_attr_name, process_method)
+        fingerprint_table['sources'][source_key] = {'digest': source_digest, 'resources': resource_fingerprints}
+
+    def materialize_diff_sources(self, diff_attr_name, fingerprint_table, skipped_sources, other_fingerprints):
+        """
+        Runs the skipped cleaning or conversion methods whose resources are needed for the diff, i.e. those
+        that produced at least one resource that does not have a matching fingerprint on the other side
+        :param diff_attr_name: 'ocl_diff' or 'dhis2_diff'
+        :param fingerprint_table: Fingerprint table of the current run
+        :param skipped_sources: <dict> source_key: process_method of the skipped sources
+        :param other_fingerprints: Merged fingerprints of the other side (see get_merged_fingerprints)
+        :return: None
+        """
+        for source_key in sorted(skipped_sources.keys()):
+            source_fingerprints = fingerprint_table['sources'][source_key]
+            if not DatimSync.has_unmatched_fingerprints(source_fingerprints['resources'], other_fingerprints):
+                continue
+            self.vlog(1, 'Materializing "%s" because its resources differ from the other side' % source_key)
+            source_fingerprints['resources'] = self.process_diff_source(diff_attr_name, skipped_sources[source_key])
+            del skipped_sources[source_key]
+
+    def save_fingerprints(self, fingerprint_table, diff_filename):
         """
-        Performs deep diff on the prepared OCL and DHIS2 resources
+        Writes a fingerprint table to the file next to the diff file it was generated from
+        :param fingerprint_table: Fingerprint table generated by prepare_diff_source
+        :param diff_filename: Name of the cleaned OCL or converted DHIS2 export file
+        :return: None
+        """
+        fingerprints_filename = datimbase.DatimBase.filename_fingerprints(diff_filename)
+        with open(self.attach_absolute_data_path(fingerprints_filename), 'wb') as output_file:
+            output_file.write(json.dumps(fingerprint_table))
+            self.vlog(1, 'Resource fingerprints successfully written to "%s"' % fingerprints_filename)
+
+    def load_fingerprints(self, diff_filename):
+        """
+        Loads the fingerprint table saved by the previous run next to a diff file. Returns None if no table
+        in the current format is available.
+        :param diff_filename: Name of the cleaned OCL or converted DHIS2 export file
+        :return: <dict> or None
+        """
+        fingerprints_filename = datimbase.DatimBase.filename_fingerprints(diff_filename)
+        if not os.path.isfile(self.attach_absolute_data_path(fingerprints_filename)):
+            self.vlog(1, 'INFO: Resource fingerprints "%s" not found. All exports will be processed...' % (
+                fingerprints_filename))
+            return None
+        with open(self.attach_absolute_data_path(fingerprints_filename), 'rb') as input_file:
+            fingerprint_table = json.load(input_file)
+        if not isinstance(fingerprint_table, dict) or (
+                fingerprint_table.get('format_version') != self.FINGERPRINTS_FORMAT_VERSION):
+            self.vlog(1, 'INFO: Resource fingerprints "%s" are in an outdated format and are ignored' % (
+                fingerprints_filename))
+            return None
+        return fingerprint_table
+
+    @staticmethod
+    def diff_resources(resources_a, resources_b, digests_a=None, digests_b=None):
+        """
+        Compares two dictionaries of cleaned resources keyed by their unique resource key. Key sets are
+        compared first, then the digests of resources present in both, and only resources whose digests
+        differ are compared field by field. Digests are taken from the optional fingerprint tables and
+        only computed for resources missing from them. A resource listed in a fingerprint table does not need
+        to be materialized if the other side has the same digest. Order of list items is ignored. Returns a
+        dictionary of diff categories (categories without diffs are omitted):
+            {
+                DIFF_ITEM_ADDED: { resource_key: resource_b, ... },
+                DIFF_ITEM_REMOVED: { resource_key: resource_a, ... },
+                DIFF_VALUES_CHANGED: { resource_key: { field_name: {'old_value': a, 'new_value': b}, ... }, ... }
+            }
+        :param resources_a: <dict> resource_key: resource
+        :param resources_b: <dict> resource_key: resource
+        :param digests_a: <dict> resource_key: digest
+        :param digests_b: <dict> resource_key: digest
+        :return: <dict>
+        """
+        digests_a = digests_a or {}
+        digests_b = digests_b or {}
+        items_added = {}
+        items_removed = {}
+        values_changed = {}
+        resource_keys_a = set(resources_a) | set(digests_a)
+        resource_keys_b = set(resources_b) | set(digests_b)
+        for resource_key in resource_keys_b:
+            if resource_key not in resource_keys_a:
+                items_added[resource_key] = resources_b[resource_key]
+                continue
+            digest_a = digests_a.get(resource_key) or DatimSync.get_resource_digest(resources_a[resource_key])
+            digest_b = digests_b.get(resource_key) or DatimSync.get_resource_digest(resources_b[resource_key])
+            if digest_a == digest_b:
+                continue
+            resource_a = resources_a[resource_key]
+            resource_b = resources_b[resource_key]
+            changed_fields = {}
+            for field_name in set(resource_a.keys()) | set(resource_b.keys()):
+                old_value = resource_a.get(field_name)
+                new_value = resource_b.get(field_name)
+                if (field_name not in resource_a or field_name not in resource_b or
+                        DatimSync.get_canonical_resource(old_value) != DatimSync.get_canonical_resource(new_value)):
+                    changed_fields[field_name] = {'old_value': old_value, 'new_value': new_value}
+            values_changed[resource_key] = changed_fields
+        for resource_key in resource_keys_a - resource_keys_b:
+            items_removed[resource_key] = resources_a[resource_key]
+
+        resource_diff = {}
+        if items_added:
+            resource_diff[DatimSync.DIFF_ITEM_ADDED] = items_added
+        if items_removed:
+            resource_diff[DatimSync.DIFF_ITEM_REMOVED] = items_removed
+        if values_changed:
+            resource_diff[DatimSync.DIFF_VALUES_CHANGED] = values_changed
+        return resource_diff
+
+    def perform_diff(self, ocl_diff=None, dhis2_diff=None, ocl_fingerprints=None, dhis2_fingerprints=None):
+        """
+        Performs keyed diff on the prepared OCL and DHIS2 resources
         :param ocl_diff: Content from OCL for the diff
         :param dhis2_diff: Content from DHIS2 for the diff
+        :param ocl_fingerprints: Optional merged fingerprints of the OCL content (see get_merged_fingerprints)
+        :param dhis2_fingerprints: Optional merged fingerprints of the DHIS2 content (see get_merged_fingerprints)
         :return:
         """
+        ocl_fingerprints = ocl_fingerprints or {}
+        dhis2_fingerprints = dhis2_fingerprints or {}
         diff = {}
         retirable_resources = [ocldev.oclconstants.OclConstants.RESOURCE_TYPE_CONCEPT,
                                ocldev.oclconstants.OclConstants.RESOURCE_TYPE_MAPPING]
@@ -357,17 +656,20 @@ class DatimSync(datimbase.DatimBase):
             for resource_type in self.sync_resource_types:
                 if resource_type in ocl_diff[import_batch_key] and resource_type in dhis2_diff[import_batch_key]:
                     # Perform diff for current resource type
-                    resource_specific_diff = deepdiff.DeepDiff(
+                    resource_specific_diff = DatimSync.diff_resources(
                         ocl_diff[import_batch_key][resource_type],
                         dhis2_diff[import_batch_key][resource_type],
-                        ignore_order=True, verbose_level=2)
+                        digests_a=ocl_fingerprints.get(import_batch_key, {}).get(resource_type),
+                        digests_b=dhis2_fingerprints.get(import_batch_key, {}).get(resource_type))
 
                     # Remove resources retired in OCL from the diff results - because no action is needed
-                    if resource_type in retirable_resources and 'dictionary_item_removed' in resource_specific_diff:
-                        keys = resource_specific_diff['dictionary_item_removed'].keys()
-                        for key in keys:
-                            if 'retired' in resource_specific_diff['dictionary_item_removed'][key] and resource_specific_diff['dictionary_item_removed'][key]['retired']:
-                                del(resource_specific_diff['dictionary_item_removed'][key])
+                    if resource_type in retirable_resources and self.DIFF_ITEM_REMOVED in resource_specific_diff:
+                        items_removed = resource_specific_diff[self.DIFF_ITEM_REMOVED]
+                        for key in items_removed.keys():
+                            if 'retired' in items_removed[key] and items_removed[key]['retired']:
+                                del(items_removed[key])
+                        if not items_removed:
+                            del(resource_specific_diff[self.DIFF_ITEM_REMOVED])
 
                     # Store the resource specific diff
                     diff[import_batch_key][resource_type] = resource_specific_diff
@@ -396,8 +698,8 @@ class DatimSync(datimbase.DatimBase):
                     # Process new items
                     consolidated_concept_refs = {}
                     consolidated_mapping_refs = {}
-                    if 'dictionary_item_added' in diff[import_batch][resource_type]:
-                        for k, r in diff[import_batch][resource_type]['dictionary_item_added'].iteritems():
+                    if self.DIFF_ITEM_ADDED in diff[import_batch][resource_type]:
+                        for k, r in diff[import_batch][resource_type][self.DIFF_ITEM_ADDED].iteritems():
                             if resource_type == ocldev.oclconstants.OclConstants.RESOURCE_TYPE_COLLECTION and r['type'] == ocldev.oclconstants.OclConstants.RESOURCE_TYPE_COLLECTION:
                                 output_file.write(json.dumps(r))
                                 output_file.write('\n')
@@ -448,15 +750,15 @@ class DatimSync(datimbase.DatimBase):
                             output_file.write('\n')
 
                     # Process updated items
-                    if 'value_changed' in diff[import_batch][resource_type]:
+                    if self.DIFF_VALUES_CHANGED in diff[import_batch][resource_type]:
                         self.vlog(1, 'WARNING: Updates are not yet supported. Skipping %s updates...' % len(
-                            diff[import_batch][resource_type]))
+                            diff[import_batch][resource_type][self.DIFF_VALUES_CHANGED]))
 
                     # Process deleted items
-                    if 'dictionary_item_removed' in diff[import_batch][resource_type]:
+                    if self.DIFF_ITEM_REMOVED in diff[import_batch][resource_type]:
                         self.vlog(
                             1, 'WARNING: Retiring and deletes are not yet supported. Skipping %s removals...' % len(
-                                diff[import_batch][resource_type]))
+                                diff[import_batch][resource_type][self.DIFF_ITEM_REMOVED]))
 
         self.vlog(1, 'New import script written to file "%s"' % self.NEW_IMPORT_SCRIPT_FILENAME)
 
@@ -571,20 +873,41 @@ class DatimSync(datimbase.DatimBase):
         return reference_key, reference_json
 
     def load_dhis2_exports(self):
-        """ Fetch DHIS2 exports based on DHIS2_QUERIES configuration and save to temp data folder """
-        cnt = 0
-        for dhis2_query_key, dhis2_query_def in self.DHIS2_QUERIES.iteritems():
-            cnt += 1
-            self.vlog(1, '** [DHIS2 Export %s of %s] %s:' % (cnt, len(self.DHIS2_QUERIES), dhis2_query_key))
-            dhis2filename_export_new = datimbase.DatimBase.dhis2filename_export_new(dhis2_query_def['id'])
-            if not self.run_dhis2_offline:
-                query_attr = {'active_dataset_ids': self.str_active_dataset_ids}
-                content_length = self.save_dhis2_query_to_file(
-                    query=dhis2_query_def['query'], query_attr=query_attr, outputfilename=dhis2filename_export_new)
-                self.vlog(1, '%s bytes retrieved from DHIS2 and written to file "%s"' % (
-                    content_length, dhis2filename_export_new))
-            else:
+        """
+        Fetch DHIS2 exports based on DHIS2_QUERIES configuration and save to temp data folder.
+        Queries are fetched concurrently (up to dhis2_max_concurrent_queries at a time) using
+        the shared pooled HTTP session.
+        """
+        if self.run_dhis2_offline:
+            cnt = 0
+            for dhis2_query_key, dhis2_query_def in self.DHIS2_QUERIES.iteritems():
+                cnt += 1
+                self.vlog(1, '** [DHIS2 Export %s of %s] %s:' % (cnt, len(self.DHIS2_QUERIES), dhis2_query_key))
+                dhis2filename_export_new = datimbase.DatimBase.dhis2filename_export_new(dhis2_query_def['id'])
                 self.does_offline_data_file_exist(dhis2filename_export_new, exit_if_missing=True)
+            return
+
+        query_attr = {'active_dataset_ids': self.str_active_dataset_ids}
+
+        def fetch_dhis2_query(dhis2_query_item):
+            dhis2_query_key, dhis2_query_def = dhis2_query_item
+            dhis2filename_export_new = datimbase.DatimBase.dhis2filename_export_new(dhis2_query_def['id'])
+            start_time = time.time()
+            content_length = self.save_dhis2_query_to_file(
+                query=dhis2_query_def['query'], query_attr=query_attr, outputfilename=dhis2filename_export_new)
+            return dhis2_query_key, dhis2filename_export_new, content_length, time.time() - start_time
+
+        cnt = 0
+        pool = gevent.pool.Pool(max(self.dhis2_max_concurrent_queries, 1))
+        try:
+            for dhis2_query_key, dhis2filename_export_new, content_length, elapsed_seconds in pool.imap_unordered(
+                    fetch_dhis2_query, self.DHIS2_QUERIES.items()):
+                cnt += 1
+                self.vlog(1, '** [DHIS2 Export %s of %s] %s: %s bytes retrieved from DHIS2 in %.2f seconds and '
+                             'written to file "%s"' % (cnt, len(self.DHIS2_QUERIES), dhis2_query_key,
+                                                       content_length, elapsed_seconds, dhis2filename_export_new))
+        finally:
+            pool.kill()
 
     def bulk_import_references(self):
         """ Shortcut to only import references """
@@ -679,18 +1002,16 @@ class DatimSync(datimbase.DatimBase):
         # NOTE: In "complete rebuild" mode this step could be removed
         sync_timer.lap(label='Step 3')
         self.vlog(1, '**** STEP 4 of 12: Fetch latest versions of relevant OCL exports')
-        cnt = 0
-        num_total = len(self.OCL_EXPORT_DEFS)
-        for ocl_export_def_key in self.OCL_EXPORT_DEFS:
-            cnt += 1
-            self.vlog(1, '** [OCL Export %s of %s] %s:' % (cnt, num_total, ocl_export_def_key))
-            export_def = self.OCL_EXPORT_DEFS[ocl_export_def_key]
-            zip_filename = datimbase.DatimBase.endpoint2filename_ocl_export_zip(export_def['endpoint'])
-            json_filename = datimbase.DatimBase.endpoint2filename_ocl_export_json(export_def['endpoint'])
-            if not self.run_ocl_offline:
-                self.get_ocl_export(endpoint=export_def['endpoint'], version='latest', zipfilename=zip_filename,
-                                    jsonfilename=json_filename)
-            else:
+        if not self.run_ocl_offline:
+            self.get_ocl_exports(ocl_export_defs=self.OCL_EXPORT_DEFS, version='latest')
+        else:
+            cnt = 0
+            num_total = len(self.OCL_EXPORT_DEFS)
+            for ocl_export_def_key in self.OCL_EXPORT_DEFS:
+                cnt += 1
+                self.vlog(1, '** [OCL Export %s of %s] %s:' % (cnt, num_total, ocl_export_def_key))
+                export_def = self.OCL_EXPORT_DEFS[ocl_export_def_key]
+                json_filename = datimbase.DatimBase.endpoint2filename_ocl_export_json(export_def['endpoint'])
                 self.does_offline_data_file_exist(json_filename, exit_if_missing=True)
 
         # STEP 5 of 12: Transform new DHIS2 export to diff/import format
@@ -698,11 +1019,7 @@ class DatimSync(datimbase.DatimBase):
         # NOTE: In "complete rebuild" mode this step is required
         sync_timer.lap(label='Step 4')
         self.vlog(1, '**** STEP 5 of 12: Transform DHIS2 exports to OCL-formatted JSON')
-        self.dhis2_diff = {}
-        for import_batch_key in self.IMPORT_BATCHES:
-            self.dhis2_diff[import_batch_key] = {}
-            for resource_type in self.sync_resource_types:
-                self.dhis2_diff[import_batch_key][resource_type] = {}
+        self.dhis2_diff = self.get_empty_diff_content()
         conversion_attr = {
             'ocl_dataset_repos': self.ocl_dataset_repos,
             'active_dataset_keys': self.active_dataset_keys,
@@ -714,20 +1031,36 @@ class DatimSync(datimbase.DatimBase):
         # NOTE: "Complete rebuild" mode could skip this step
         sync_timer.lap(label='Step 5')
         self.vlog(1, '**** STEP 6 of 12: Prepare OCL exports for diff')
-        self.ocl_diff = {}
-        for import_batch_key in self.IMPORT_BATCHES:
-            self.ocl_diff[import_batch_key] = {}
-            for resource_type in self.sync_resource_types:
-                self.ocl_diff[import_batch_key][resource_type] = {}
+        self.ocl_diff = self.get_empty_diff_content()
         self.prepare_ocl_exports(cleaning_attr={})
 
-        # STEP 7 of 12: Perform deep diff
-        # One deep diff is performed per resource type in each import batch
+        # STEP 7 of 12: Perform keyed diff
+        # One keyed diff is performed per resource type in each import batch
+        # Exports skipped in STEPS 5 and 6 are only materialized if their resources differ from the other side
         # OCL/DHIS2 exports reloaded from file to eliminate unicode type_change diff -- but that may be short sighted!
+        # Fingerprint tables are only overwritten after the diff, so that the next run can reuse them
         # NOTE: This step occurs regardless of sync mode
         # NOTE: Remove this step in "complete rebuild mode"
         sync_timer.lap(label='Step 6')
-        self.vlog(1, '**** STEP 7 of 12: Perform deep diff')
+        self.vlog(1, '**** STEP 7 of 12: Perform keyed diff')
+        ocl_fingerprints = DatimSync.get_merged_fingerprints(self.ocl_fingerprints)
+        dhis2_fingerprints = DatimSync.get_merged_fingerprints(self.dhis2_fingerprints)
+        if not self.compare2previousexport:
+            # OCL content is cleared below, so none of the skipped OCL exports are needed
+            ocl_fingerprints = {}
+        else:
+            self.materialize_diff_sources(
+                'ocl_diff', self.ocl_fingerprints, self.ocl_skipped_sources, dhis2_fingerprints)
+        self.materialize_diff_sources(
+            'dhis2_diff', self.dhis2_fingerprints, self.dhis2_skipped_sources, ocl_fingerprints)
+        with open(self.attach_absolute_data_path(self.DHIS2_CONVERTED_EXPORT_FILENAME), 'wb') as output_file:
+            output_file.write(json.dumps(self.dhis2_diff))
+            self.vlog(1, 'Transformed DHIS2 exports successfully written to "%s"' % (
+                self.DHIS2_CONVERTED_EXPORT_FILENAME))
+        with open(self.attach_absolute_data_path(self.OCL_CLEANED_EXPORT_FILENAME), 'wb') as output_file:
+            output_file.write(json.dumps(self.ocl_diff))
+            self.vlog(1, 'Cleaned OCL exports successfully written to "%s"' % (
+                self.OCL_CLEANED_EXPORT_FILENAME))
         with open(self.attach_absolute_data_path(self.OCL_CLEANED_EXPORT_FILENAME), 'rb') as file_ocl_diff,\
                 open(self.attach_absolute_data_path(self.DHIS2_CONVERTED_EXPORT_FILENAME), 'rb') as file_dhis2_diff:
             local_ocl_diff = json.load(file_ocl_diff)
@@ -742,7 +1075,10 @@ class DatimSync(datimbase.DatimBase):
                             local_ocl_diff[import_batch_key][resource_type] = {}
 
             self.diff_result = self.perform_diff(
-                ocl_diff=local_ocl_diff, dhis2_diff=local_dhis2_diff)
+                ocl_diff=local_ocl_diff, dhis2_diff=local_dhis2_diff,
+                ocl_fingerprints=ocl_fingerprints, dhis2_fingerprints=dhis2_fingerprints)
+        self.save_fingerprints(self.ocl_fingerprints, self.OCL_CLEANED_EXPORT_FILENAME)
+        self.save_fingerprints(self.dhis2_fingerprints, self.DHIS2_CONVERTED_EXPORT_FILENAME)
 
         # TODO: Remove the diff_result display after final testing of content
         pprint.pprint(self.diff_result)
@@ -11,7 +11,6 @@ synchronized with repositories in OCL as described below.
 from __future__ import with_statement
 import os
 import sys
-import json
 import datimsync
 import datimconstants
 
@@ -72,7 +71,6 @@ class DatimSyncMechanisms(datimsync.DatimSync):
         dhis2filename_export_new = self.dhis2filename_export_new(dhis2_query_def['id'])
         with open(self.attach_absolute_data_path(dhis2filename_export_new), "rb") as input_file:
             self.vlog(1, 'Loading new DHIS2 export "%s"...' % dhis2filename_export_new)
-            new_dhis2_export = json.load(input_file)
             partner = ''
             primeid = ''
             agency = ''
@@ -81,7 +79,7 @@ class DatimSyncMechanisms(datimsync.DatimSync):
 
             # Iterate through each DataElement and transform to an OCL-JSON concept
             num_concepts = 0
-            for coc in new_dhis2_export['categoryOptionCombos']:
+            for coc in self.load_json_array_items(input_file, 'categoryOptionCombos'):
                 concept_id = coc['code']
                 concept_key = '/orgs/PEPFAR/sources/Mechanisms/concepts/%s/' % concept_id
                 for co in coc['categoryOptions']:
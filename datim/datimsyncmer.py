@@ -14,7 +14,6 @@ synchronized with repositories in OCL as described below.
 from __future__ import with_statement
 import os
 import sys
-import json
 import datimsync
 import datimconstants
 
@@ -73,7 +72,6 @@ class DatimSyncMer(datimsync.DatimSync):
         dhis2filename_export_new = self.dhis2filename_export_new(dhis2_query_def['id'])
         with open(self.attach_absolute_data_path(dhis2filename_export_new), "rb") as input_file:
             self.vlog(1, 'Loading new DHIS2 export "%s"...' % dhis2filename_export_new)
-            new_dhis2_export = json.load(input_file)
             ocl_dataset_repos = conversion_attr['ocl_dataset_repos']
 
             # Counts
@@ -84,7 +82,7 @@ class DatimSyncMer(datimsync.DatimSync):
             num_disaggregate_refs = 0
 
             # Iterate through each DataElement and transform to an Indicator concept
-            for de in new_dhis2_export['dataElements']:
+            for de in self.load_json_array_items(input_file, 'dataElements'):
                 indicator_concept_id = de['code']
                 indicator_concept_url = '/orgs/PEPFAR/sources/MER/concepts/' + indicator_concept_id + '/'
                 indicator_concept_key = indicator_concept_url
@@ -12,7 +12,6 @@ synchronized with repositories in OCL as described below.
 |-------------|---------|-------------------------------------------------|
 """
 from __future__ import with_statement
-import json
 import datimsync
 import datimconstants
 import ocldev.oclconstants
@@ -92,7 +91,6 @@ class DatimSyncMerMsp(datimsync.DatimSync):
         dhis2filename_export_new = datimbase.DatimBase.dhis2filename_export_new(dhis2_query_def['id'])
         with open(self.attach_absolute_data_path(dhis2filename_export_new), "rb") as input_file:
             self.vlog(1, 'Loading new DHIS2 export "%s"...' % dhis2filename_export_new)
-            new_dhis2_export = json.load(input_file)
             active_dataset_keys = conversion_attr['active_dataset_keys']
 
             # Counts
@@ -106,7 +104,7 @@ class DatimSyncMerMsp(datimsync.DatimSync):
             num_disaggregate_refs = 0
 
             # Iterate through each DataElement and transform to a Data Element Concept
-            for de in new_dhis2_export['dataElements']:
+            for de in self.load_json_array_items(input_file, 'dataElements'):
                 de_concept_id = de['code']
                 de_concept_url = '/orgs/%s/sources/%s/concepts/%s/' % (
                     self.DATIM_MER_MSP_ORG_ID, self.DATIM_MER_MSP_SOURCE_ID, de_concept_id)
@@ -16,7 +16,6 @@ TODO: Implement new repo versioning model (e.g. FY19.v0)
 TODO: Add "indicator_category_code" attribute for each indicator (e.g. PMTCT_STAT)
 """
 from __future__ import with_statement
-import json
 import datimsync
 import datimconstants
 import datimsyncmohhelper
@@ -89,7 +88,6 @@ class DatimSyncMohFy19(datimsync.DatimSync):
         dhis2filename_export_new = self.dhis2filename_export_new(dhis2_query_def['id'])
         with open(self.attach_absolute_data_path(dhis2filename_export_new), "rb") as input_file:
             self.vlog(1, 'Loading new DHIS2 export "%s"...' % dhis2filename_export_new)
-            new_dhis2_export = json.load(input_file)
             ocl_dataset_repos = conversion_attr['ocl_dataset_repos']
 
             # Counts
@@ -100,7 +98,7 @@ class DatimSyncMohFy19(datimsync.DatimSync):
             num_disaggregate_refs = 0
 
             # Iterate through each DataElement and transform to Data Element concepts
-            for de in new_dhis2_export['dataElements']:
+            for de in self.load_json_array_items(input_file, 'dataElements'):
                 de_concept_id = de['code']
                 de_concept_url = '/orgs/%s/sources/%s/concepts/%s/' % (
                     self.DATIM_MOH_ORG_ID, self.DATIM_MOH_SOURCE_ID, de_concept_id)
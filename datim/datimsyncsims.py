@@ -18,7 +18,6 @@ synchronized with repositories in OCL as described below.
 |-------------|-------------------------|--------------------------------------------|
 """
 from __future__ import with_statement
-import json
 import datimsync
 import datimconstants
 
@@ -75,13 +74,12 @@ class DatimSyncSims(datimsync.DatimSync):
         """
         dhis2filename_export_new = self.dhis2filename_export_new(dhis2_query_def['id'])
         with open(self.attach_absolute_data_path(dhis2filename_export_new), "rb") as input_file:
-            new_dhis2_export = json.load(input_file)
             ocl_dataset_repos = conversion_attr['ocl_dataset_repos']
             num_concepts = 0
             num_references = 0
 
             # Iterate through each OptionSet and transform to an OCL-JSON concept
-            for option_set in new_dhis2_export['optionSets']:
+            for option_set in self.load_json_array_items(input_file, 'optionSets'):
                 for option in option_set['options']:
                     option_concept_id = option['id']
                     option_concept_url = '/orgs/PEPFAR/sources/SIMS/concepts/%s/' % option_concept_id
@@ -138,13 +136,12 @@ class DatimSyncSims(datimsync.DatimSync):
         """
         dhis2filename_export_new = self.dhis2filename_export_new(dhis2_query_def['id'])
         with open(self.attach_absolute_data_path(dhis2filename_export_new), "rb") as input_file:
-            new_dhis2_export = json.load(input_file)
             ocl_dataset_repos = conversion_attr['ocl_dataset_repos']
             num_concepts = 0
             num_references = 0
 
             # Iterate through each DataElement and transform to an OCL-JSON concept
-            for data_element in new_dhis2_export['dataElements']:
+            for data_element in self.load_json_array_items(input_file, 'dataElements'):
                 sims_concept_id = data_element['code']
                 sims_concept_url = '/orgs/PEPFAR/sources/SIMS/concepts/%s/' % sims_concept_id
                 sims_concept_key = sims_concept_url
@@ -4,13 +4,13 @@ a point of service system (POS) to a FHIR Questionnaire.
 """
 import re
 import json
-import requests
 import ocldev.oclconstants
-import ocldev.oclexport
 import ocldev.oclvalidator
 import ocldev.oclresourcelist
 import ocldev.oclfleximporter
 import fhir
+import utils.httpsession
+import utils.oclexportcache
 
 
 class Qmap(object):
@@ -57,7 +57,7 @@ class Qmap(object):
             owner_id=domain, repository_id=qmap_id, include_trailing_slash=True))
         if verbosity:
             print 'Requesting export from: %s ' % qmap_repo_url
-        qmap_export = ocldev.oclexport.OclExportFactory.load_latest_export(
+        qmap_export = utils.oclexportcache.load_latest_export(
             qmap_repo_url, oclapitoken=ocl_api_token)
         if not qmap_export:
             err_msg = "Unable to load QMAP export from OCL for domain '%s' and qmap_id '%s'" % (
@@ -72,7 +72,7 @@ class Qmap(object):
         ocl_api_headers = {'Content-Type': 'application/json'}
         if ocl_api_token:
             ocl_api_headers['Authorization'] = 'Token ' + ocl_api_token
-        response = requests.get(ocl_resource_url, headers=ocl_api_headers)
+        response = utils.httpsession.get_session().get(ocl_resource_url, headers=ocl_api_headers)
         try:
             response.raise_for_status()
             return response.json()
@@ -112,7 +112,7 @@ class Qmap(object):
         ocl_api_headers = {'Content-Type': 'application/json'}
         if ocl_api_token:
             ocl_api_headers['Authorization'] = 'Token ' + ocl_api_token
-        response = requests.get(qmap_org_url, headers=ocl_api_headers)
+        response = utils.httpsession.get_session().get(qmap_org_url, headers=ocl_api_headers)
         try:
             response.raise_for_status()
         except Exception:
@@ -284,7 +284,7 @@ class Qmap(object):
         ocl_api_headers = {'Content-Type': 'application/json'}
         if ocl_api_token:
             ocl_api_headers['Authorization'] = 'Token ' + ocl_api_token
-        response = requests.delete(qmap_repo_url, headers=ocl_api_headers)
+        response = utils.httpsession.get_session().delete(qmap_repo_url, headers=ocl_api_headers)
         response.raise_for_status()
         if response.status_code == 204:
             # Successfully deleted
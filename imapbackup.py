@@ -28,11 +28,17 @@ However, if verbosity is turned on, then you can output the IMAPs in any availab
 # Displays all IMAPs as CSV, including a header and ALL DEBUG OUTPUT for each one
 
     python imapbackup.py --env=staging -v2 -fcsv
+
+Use `--ndjson` to stream the backup as one JSON object per line, written as soon as each IMAP is
+exported. Combined with `--output`, an interrupted backup can be resumed with `--resume`, which
+skips countries that were already backed up successfully:
+
+    python imapbackup.py --env=staging --ndjson --output=imap-backup.ndjson
+    python imapbackup.py --env=staging --ndjson --output=imap-backup.ndjson --resume
 """
 import sys
 import json
 import argparse
-import requests
 import common
 import datim.datimimapexport
 
@@ -57,9 +63,19 @@ parser.add_argument(
     '--exclude_empty_maps', help='Excludes empty maps', default=True, required=False)
 parser.add_argument(
     '--include_extra_info', help='Includes extra IMAP columns', default=False, required=False)
+parser.add_argument(
+    '--max_workers', help='Maximum number of IMAPs to export concurrently',
+    default=datim.datimimapexport.DatimImapExport.DEFAULT_IMAP_EXPORT_MAX_WORKERS, type=int)
+parser.add_argument(
+    '--ndjson', action='store_true', default=False,
+    help='Stream the backup as one JSON object per line (NDJSON) as each IMAP is exported')
+parser.add_argument('-o', '--output', help='Filename to save the backup to instead of printing it')
+parser.add_argument(
+    '--resume', action='store_true', default=False,
+    help='Append to an existing NDJSON backup, skipping countries already backed up successfully')
 parser.add_argument('--version', action='version', version='%(prog)s v' + common.APP_VERSION)
 args = parser.parse_args()
-ocl_env_url = args.env if args.env else args.env_url
+ocl_env_url = args.env if args.env else args.envurl
 if args.verbosity > 1:
     print args
     print 'ocl_env_url=%s' % ocl_env_url
@@ -73,16 +89,50 @@ if args.country_code:
     country_code_filter = [x.strip() for x in args.country_code.split(',')]
 imap_export_verbosity = 1 if args.verbosity > 1 else 0
 
+if args.resume and not (args.ndjson and args.output):
+    parser.error('--resume requires --ndjson and --output')
+
 # Get the list of IMAP orgs
 ocl_imap_orgs = common.get_imap_orgs(
     ocl_env_url=ocl_env_url, ocl_api_token=args.token, verbose=bool(args.verbosity),
     period_filter=period_filter, country_code_filter=country_code_filter)
 
-# Export each one
+# Skip IMAP orgs that are already in the backup file if resuming
+if args.resume:
+    completed_country_orgs = common.get_imap_backup_country_orgs(args.output, status_filter=['Success'])
+    ocl_imap_orgs = [org for org in ocl_imap_orgs if org['id'] not in completed_country_orgs]
+    if args.verbosity:
+        print 'Resuming backup: %s IMAPs already backed up, %s remaining' % (
+            len(completed_country_orgs), len(ocl_imap_orgs))
+
+# Prepare the output
+ndjson_output_file = None
+if args.ndjson and args.output:
+    ndjson_output_file = open(args.output, 'ab' if args.resume else 'wb')
+    if ndjson_output_file.tell():
+        # Start on a new line in case the previous backup was interrupted in the middle of a line
+        with open(args.output, 'rb') as backup_file:
+            backup_file.seek(-1, 2)
+            if backup_file.read(1) != '\n':
+                ndjson_output_file.write('\n')
+elif args.ndjson and not args.verbosity:
+    ndjson_output_file = sys.stdout
+
+
+def save_imap_backup(imap_backup):
+    """ Writes the IMAP backup as soon as it is complete if streaming, otherwise saves it for later """
+    if ndjson_output_file:
+        common.write_imap_backup_line(ndjson_output_file, imap_backup)
+    elif not args.ndjson:
+        imap_backups.append(imap_backup)
+
+
+# Export the IMAPs concurrently, handling each one as soon as it is complete
 imap_backups = []
+num_imap_backups = 0
 imap_export = datim.datimimapexport.DatimImapExport(
     oclenv=ocl_env_url, oclapitoken=args.token, verbosity=imap_export_verbosity)
-for org in ocl_imap_orgs:
+for org, imap, error in imap_export.get_imaps(ocl_imap_orgs, max_workers=args.max_workers):
     # Print debug info for the current IMAP org
     if args.verbosity:
         print '\n\n' + '*' * 100
@@ -91,29 +141,24 @@ for org in ocl_imap_orgs:
             org['extras']['datim_moh_period'], str(args.exclude_empty_maps), str(args.verbosity))
         print '*' * 100
 
-    # Generate the IMAP export
-    try:
-        imap = imap_export.get_imap(
-            period=org['extras']['datim_moh_period'], country_org=org['id'],
-            country_code=org['extras']['datim_moh_country_code'])
-    except (requests.exceptions.HTTPError, Exception) as e:
+    if error:
         imap_error = {
             'country_org': org['id'],
             'country_code': org['extras'].get('datim_moh_country_code'),
             'country_name': org.get('location'),
             'period': org['extras'].get('datim_moh_period'),
             'status': 'Error',
-            'message': str(e),
+            'message': str(error),
             'imap': None
         }
         if args.verbosity:
             print json.dumps(imap_error)
-        imap_backups.append(imap_error)
+        save_imap_backup(imap_error)
     else:
         if args.verbosity:
             imap.display(fmt=args.format, sort=True, exclude_empty_maps=args.exclude_empty_maps,
                          include_extra_info=args.include_extra_info)
-        imap_backups.append({
+        save_imap_backup({
             'country_org': org['id'],
             'country_code': org['extras'].get('datim_moh_country_code'),
             'country_name': org.get('location'),
@@ -124,8 +169,15 @@ for org in ocl_imap_orgs:
                 exclude_empty_maps=args.exclude_empty_maps,
                 include_extra_info=args.include_extra_info)
         })
-
+    num_imap_backups += 1
+
+if ndjson_output_file and ndjson_output_file is not sys.stdout:
+    ndjson_output_file.close()
+if not args.ndjson:
+    if args.output:
+        with open(args.output, 'wb') as output_file:
+            output_file.write(json.dumps(imap_backups))
+    elif not args.verbosity:
+        print json.dumps(imap_backups)
 if args.verbosity:
-    print '\n%s IMAPs exported successfully' % len(imap_backups)
-else:
-    print json.dumps(imap_backups)
+    print '\n%s IMAPs exported successfully' % num_imap_backups
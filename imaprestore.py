@@ -5,6 +5,11 @@ This command will import an IMAP backup into OCL staging:
 
     python imaprestore.py --env=staging -t=[my-token] imap_backup_filename.json
 
+Backups are read one IMAP at a time, so both JSON array backups and NDJSON backups created
+with `imapbackup.py --ndjson` are supported. IMAPs are grouped by period so that each DATIM-MOH
+source export is loaded once, and are validated and submitted concurrently. Use
+`--max_concurrent_imports` and `--max_workers` to limit the load on OCL and on this machine.
+
 """
 import json
 import argparse
@@ -30,6 +35,12 @@ parser.add_argument(
 parser.add_argument(
     '-p', '--period', help='Filter by period, eg "FY18", "FY19"', required=False, default='')
 parser.add_argument('--public_access', help="Level of public access: View, None", default='View')
+parser.add_argument(
+    '--max_concurrent_imports', help='Maximum number of IMAPs submitted to OCL concurrently',
+    default=datim.datimimapimport.DatimImapImport.DEFAULT_MAX_CONCURRENT_IMPORTS, type=int)
+parser.add_argument(
+    '--max_workers', help='Number of processes used to validate IMAPs and generate import scripts',
+    default=datim.datimimapimport.DatimImapImport.DEFAULT_IMPORT_MAX_WORKERS, type=int)
 parser.add_argument('--version', action='version', version='%(prog)s v' + common.APP_VERSION)
 parser.add_argument(
     'file', type=argparse.FileType('r'), help='IMAP file (JSON or CSV), eg "BI-FY20.csv"')
@@ -44,36 +55,31 @@ country_code_filter = ''
 if args.country_code:
     country_code_filter = [x.strip() for x in args.country_code.split(',')]
 
-# Filter IMAPs
-all_imap_backups = json.load(args.file)
-imap_backups = []
-for imap_backup in all_imap_backups:
-    if period_filter and imap_backup['period'] not in period_filter:
-        continue
-    elif country_code_filter and imap_backup['country_code'] not in country_code_filter:
-        continue
-    imap_backups.append(imap_backup)
-
 # Display debug info
 if args.verbosity:
     print args
     print 'ocl_env_url=%s' % ocl_env_url
     print 'country_codes=%s' % country_code_filter
     print 'periods=%s' % period_filter
-    print '%s IMAPs (after filter) of %s IMAP backups loaded' % (
-        len(imap_backups), len(all_imap_backups))
 
-# Loop through each and import
+# Load each IMAP backup as it is read from the backup file
+num_imap_backups = 0
 current_num = 0
-for imap_backup in imap_backups:
+imap_inputs = []
+for imap_backup in common.iter_imap_backups(args.file):
+    num_imap_backups += 1
+    if period_filter and imap_backup['period'] not in period_filter:
+        continue
+    elif country_code_filter and imap_backup['country_code'] not in country_code_filter:
+        continue
     current_num += 1
 
     # Display debug info for the current IMAP org
     if args.verbosity:
         if args.verbosity > 1:
             print '\n\n' + '*' * 100
-        print '** [IMAP %s of %s] Org: %s, Country Code: %s, Country Name: %s, Period: %s' % (
-            current_num, len(imap_backups), imap_backup['country_org'],
+        print '** [IMAP %s] Org: %s, Country Code: %s, Country Name: %s, Period: %s' % (
+            current_num, imap_backup['country_org'],
             imap_backup['country_code'], imap_backup['country_name'], imap_backup['period'])
         if args.verbosity > 1:
             print '*' * 100
@@ -87,7 +93,8 @@ for imap_backup in imap_backups:
         period=imap_backup['period'],
         country_org=imap_backup['country_org'],
         country_name=imap_backup['country_name'],
-        country_code=imap_backup['country_code'])
+        country_code=imap_backup['country_code'],
+        compact_storage=True)
     if args.verbosity > 1 and imap_input:
         imap_input.display(sort=True, exclude_empty_maps=True)
         # print 'INFO: IMAP import file "%s" loaded successfully' % args.file.name
@@ -95,27 +102,29 @@ for imap_backup in imap_backups:
         print 'ERROR: Unable to load IMAP import file "%s"' % args.file.name
         exit(1)
 
-    # Import IMAP
-    output_json = {
-        "country_org": imap_backup['country_org'],
-        "country_code": imap_backup['country_code'],
-        "country_name": imap_backup['country_name'],
-        "period": imap_backup['period']
-    }
-    try:
-        bulk_import_task_id = ''
-        if not args.test_mode:
-            imap_import = datim.datimimapimport.DatimImapImport(
-                oclenv=ocl_env_url, oclapitoken=args.token, verbosity=args.verbosity,
-                run_ocl_offline=False, test_mode=args.test_mode,
-                country_public_access=args.public_access)
-            bulk_import_task_id = imap_import.import_imap(imap_input=imap_input)
-    except Exception as err:
-        output_json["status"] = "Error"
-        output_json["message"] = str(err)
-    else:
-        if args.test_mode:
-            output_json["status"] = "Test"
+    imap_inputs.append(imap_input)
+
+# Import the IMAPs concurrently, printing the result of each one as soon as it is submitted
+if not args.test_mode:
+    imap_import = datim.datimimapimport.DatimImapImport(
+        oclenv=ocl_env_url, oclapitoken=args.token, verbosity=args.verbosity,
+        run_ocl_offline=False, test_mode=args.test_mode,
+        country_public_access=args.public_access)
+    for imap_input, bulk_import_task_id, err in imap_import.import_imaps(
+            imap_inputs, max_concurrent_imports=args.max_concurrent_imports,
+            max_workers=args.max_workers):
+        output_json = {
+            "country_org": imap_input.country_org,
+            "country_code": imap_input.country_code,
+            "country_name": imap_input.country_name,
+            "period": imap_input.period
+        }
+        if isinstance(err, datim.datimimapimport.ImapDuplicateCountryOrgError):
+            output_json["status"] = "Skipped"
+            output_json["message"] = str(err)
+        elif err:
+            output_json["status"] = "Error"
+            output_json["message"] = str(err)
         elif bulk_import_task_id:
             output_json["status"] = "Success"
             output_json["message"] = ("IMAP successfully queued for bulk import into OCL. "
@@ -124,5 +133,7 @@ for imap_backup in imap_backups:
             output_json["ocl_bulk_import_task_id"] = bulk_import_task_id
             output_json["ocl_bulk_import_status_url"] = "%s/manage/bulkimport?task=%s" % (
                 ocl_env_url, bulk_import_task_id)
-    if output_json and not args.test_mode:
         print json.dumps(output_json)
+
+if args.verbosity:
+    print '%s IMAPs (after filter) of %s IMAP backups processed' % (current_num, num_imap_backups)
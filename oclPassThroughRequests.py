@@ -7,8 +7,8 @@ python bulkImportStatus.py --env=staging -t="my-api-token-here"
 """
 import json
 import argparse
-import requests
 import common
+import utils.httpsession
 
 
 # Checks OCL bulk import status
@@ -23,7 +23,7 @@ def check_bulk_import_status(bulkImportId='', ocl_env_url='', ocl_api_token='',
         ocl_api_headers['Authorization'] = 'Token ' + ocl_api_token
     import_status_url = "%s/manage/bulkimport/?task=%s&result=%s" % (
         ocl_env_url, bulkImportId, import_result_format)
-    response = requests.get(import_status_url, headers=ocl_api_headers)
+    response = utils.httpsession.get_session().get(import_status_url, headers=ocl_api_headers)
     response.raise_for_status() #- see if raise for status can be implemented without conflict
     # check for if it is JSON or Text - if can't check test if it can be converted to json
     is_json = True
@@ -54,7 +54,7 @@ def getQMAPDomainDetails(ocl_env_url='', domain=''):
     ocl_api_headers = {'Content-Type': 'application/json'}
     qmapDetailsURL = "%s/orgs/%s" % (
         ocl_env_url, domain)
-    response = requests.get(qmapDetailsURL, headers=ocl_api_headers)
+    response = utils.httpsession.get_session().get(qmapDetailsURL, headers=ocl_api_headers)
     response.raise_for_status()
     return response.text
 
@@ -64,7 +64,7 @@ def getDATIMCodeLists(ocl_env_url='',owner=''):
     ocl_api_headers = {'Content-Type': 'application/json'}
     datimCodelistsDetailsURL = '%s/orgs/%s/collections/?collectionType="Code+List"&limit=0' % (
         ocl_env_url,owner)
-    response = requests.get(datimCodelistsDetailsURL, headers=ocl_api_headers)
+    response = utils.httpsession.get_session().get(datimCodelistsDetailsURL, headers=ocl_api_headers)
     response.raise_for_status()
     return response.text
 
@@ -74,7 +74,7 @@ def getMOHCodelists(ocl_env_url='',owner=''):
     ocl_api_headers = {'Content-Type': 'application/json'}
     mohCodelistsDetailsURL = '%s/orgs/%s/sources/?extras__datim_moh_codelist=true&verbose=true' % (
         ocl_env_url,owner)
-    response = requests.get(mohCodelistsDetailsURL, headers=ocl_api_headers)
+    response = utils.httpsession.get_session().get(mohCodelistsDetailsURL, headers=ocl_api_headers)
     response.raise_for_status()
     return response.text
 
@@ -0,0 +1,43 @@
+"""
+Tests for incremental parsing of JSON exports in utils.jsonstream
+Usage: python -m unittest discover -s tests -p "test_*.py"
+"""
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils.jsonstream
+
+
+class JsonStreamNumberTest(unittest.TestCase):
+    """ Numbers must be decoded in full wherever the chunk boundaries fall """
+
+    def assert_items_at_every_chunk_size(self, document, key, expected_items):
+        for chunk_size in range(1, len(document) + 1):
+            items = [item for item_key, item in utils.jsonstream.iter_arrays_items(
+                StringIO(document), [key], chunk_size=chunk_size)]
+            self.assertEqual(items, expected_items, 'chunk_size=%s' % chunk_size)
+
+    def test_float_split_at_every_chunk_boundary(self):
+        self.assert_items_at_every_chunk_size('{"concepts": [1.5]}', 'concepts', [1.5])
+
+    def test_exponent_split_at_every_chunk_boundary(self):
+        self.assert_items_at_every_chunk_size('{"concepts": [2.5e3]}', 'concepts', [2500.0])
+
+    def test_numbers_in_objects_split_at_every_chunk_boundary(self):
+        self.assert_items_at_every_chunk_size(
+            '{"concepts": [{"a": -12.25E-1, "b": 10}, 3, true, null, 0.125]}', 'concepts',
+            [{'a': -1.225, 'b': 10}, 3, True, None, 0.125])
+
+    def test_load_object_members_number_split_at_every_chunk_boundary(self):
+        document = '{"id": 12.75, "concepts": [1, 2], "released": true}'
+        for chunk_size in range(1, len(document) + 1):
+            members = utils.jsonstream.load_object_members(
+                StringIO(document), skip_keys=['concepts'], chunk_size=chunk_size)
+            self.assertEqual(members, {'id': 12.75, 'released': True}, 'chunk_size=%s' % chunk_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Adaptive concurrency limit for batches of HTTP requests.
+Usage:
+limiter = AdaptiveConcurrency(initial=2, minimum=1, maximum=16)
+while ...:
+    if limiter.has_capacity(): limiter.acquire() ...start another request...
+    limiter.release(); limiter.record(status_code, elapsed_seconds)
+The limit grows by one after a full window of successful requests whose latency stays
+within latency_tolerance of the best latency seen, and is halved when a request is
+throttled (429) or fails with a server error (5xx). A limiter can be shared by several
+concurrent batches: the limit then applies to their requests in flight combined, and a
+backoff caused by one batch slows all of them.
+"""
+
+
+class AdaptiveConcurrency(object):
+    """ Additive-increase/multiplicative-decrease concurrency limit """
+
+    THROTTLE_STATUS_CODES = [429]
+
+    def __init__(self, initial=2, minimum=1, maximum=16, latency_tolerance=1.5):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.latency_tolerance = latency_tolerance
+        self.best_latency = None
+        self.num_stable = 0
+        self.num_backoffs = 0
+        self.num_active = 0
+
+    @staticmethod
+    def is_overloaded(status_code):
+        """ Returns True if the status code indicates that the server is throttling or overloaded """
+        return status_code in AdaptiveConcurrency.THROTTLE_STATUS_CODES or 500 <= status_code <= 599
+
+    def has_capacity(self):
+        """ Returns True if another request can be started within the current limit """
+        return self.num_active < self.limit
+
+    def acquire(self):
+        """ Counts a request that was started """
+        self.num_active += 1
+
+    def release(self):
+        """ Counts a request that finished, was cancelled or failed """
+        self.num_active = max(self.num_active - 1, 0)
+
+    def record(self, status_code, elapsed_seconds):
+        """
+        Adjusts the limit based on the result of one request
+        :param status_code: HTTP status code of the response
+        :param elapsed_seconds: Latency of the request
+        :return: Updated limit
+        """
+        if AdaptiveConcurrency.is_overloaded(status_code):
+            self.backoff()
+            return self.limit
+        if self.best_latency is None or elapsed_seconds < self.best_latency:
+            self.best_latency = elapsed_seconds
+        if elapsed_seconds <= self.best_latency * self.latency_tolerance:
+            self.num_stable += 1
+            if self.num_stable >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.num_stable = 0
+        else:
+            self.num_stable = 0
+        return self.limit
+
+    def backoff(self):
+        """ Halves the limit, e.g. after the server throttled a request """
+        self.limit = max(self.limit // 2, self.minimum)
+        self.num_stable = 0
+        self.num_backoffs += 1
+        return self.limit
@@ -0,0 +1,82 @@
+"""
+Shared pooled HTTP session used for all OCL and DHIS2 requests.
+Usage:
+s = utils.httpsession.get_session()
+r = s.get(url, headers=headers)
+s.add_timing_hook(lambda method, url, status_code, elapsed_seconds: ...)
+"""
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+# Default (connect, read) timeout in seconds applied to every request that does not set its own
+DEFAULT_TIMEOUT = (30, 600)
+
+# Retry settings: connection errors and the listed status codes are retried with exponential
+# backoff. Only idempotent methods (GET, HEAD, PUT, DELETE, OPTIONS, TRACE) are retried.
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_RETRY_STATUS_CODES = [429, 502, 503, 504]
+
+# Connection pool settings: number of hosts to keep pools for and max connections kept per host.
+# Concurrent request limits, e.g. DatimBase.DEFAULT_OCL_EXPORT_ASYNC_MAX_CONCURRENCY, are capped at
+# DEFAULT_POOL_MAXSIZE so that connections are reused rather than opened and discarded.
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+
+class PooledSession(requests.Session):
+    """
+    requests.Session with keep-alive connection pooling, a per-host connection limit,
+    a default timeout, automatic retry with backoff and request-level timing hooks.
+    Timing hooks are called as hook(method, url, status_code, elapsed_seconds) after the
+    response headers are received.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, retry_status_codes=None,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+        requests.Session.__init__(self)
+        self.timeout = timeout
+        self.timing_hooks = []
+        if retry_status_codes is None:
+            retry_status_codes = DEFAULT_RETRY_STATUS_CODES
+        retries = Retry(total=max_retries, backoff_factor=backoff_factor,
+                        status_forcelist=retry_status_codes, raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retries, pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.hooks['response'].append(self._call_timing_hooks)
+
+    def request(self, method, url, **kwargs):
+        """ Send a request, applying the session default timeout if none is specified """
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return requests.Session.request(self, method, url, **kwargs)
+
+    def add_timing_hook(self, hook):
+        """ Register a callable hook(method, url, status_code, elapsed_seconds) """
+        if hook not in self.timing_hooks:
+            self.timing_hooks.append(hook)
+
+    def remove_timing_hook(self, hook):
+        """ Unregister a timing hook """
+        if hook in self.timing_hooks:
+            self.timing_hooks.remove(hook)
+
+    def _call_timing_hooks(self, response, *args, **kwargs):
+        for hook in self.timing_hooks:
+            hook(response.request.method, response.url, response.status_code,
+                 response.elapsed.total_seconds())
+
+
+_session = None
+
+
+def get_session():
+    """ Returns the shared PooledSession, creating it on first use """
+    global _session
+    if _session is None:
+        _session = PooledSession()
+    return _session
@@ -0,0 +1,199 @@
+"""
+Incremental parsing of large JSON exports, e.g. OCL repository exports and DHIS2 exports.
+Usage:
+with open(filename, 'rb') as input_file:
+    for key, item in utils.jsonstream.iter_arrays_items(input_file, ['concepts', 'mappings']):
+        ...
+with open(filename, 'rb') as input_file:
+    header = utils.jsonstream.load_object_members(input_file, skip_keys=['concepts', 'mappings'])
+
+The document must be a JSON object. Items of the requested top-level arrays are decoded and
+yielded one at a time as the file is read, so only one item (plus a read buffer) is held in
+memory at once. Top-level members that are not requested are scanned without being decoded.
+"""
+import json
+import codecs
+
+
+# Number of bytes read from the file at a time
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = ' \t\n\r'
+
+# Characters that can continue a partially read number
+NUMBER_CHARS = '0123456789+-.eE'
+
+_decoder = json.JSONDecoder()
+
+
+class JsonStreamError(ValueError):
+    """ Raised when the JSON document is malformed or is not of the expected shape """
+    pass
+
+
+class _JsonStreamReader(object):
+    """ Buffered reader that decodes JSON values from a file-like object one at a time """
+
+    def __init__(self, input_file, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.input_file = input_file
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = u''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, min_size=0):
+        """ Reads at least one more chunk into the buffer. Returns False at end of file. """
+        if self.eof:
+            return False
+        if self.pos:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        target_size = len(self.buffer) + max(min_size, 1)
+        while len(self.buffer) < target_size:
+            chunk = self.input_file.read(self.chunk_size)
+            if not chunk:
+                self.buffer += self.text_decoder.decode('', final=True)
+                self.eof = True
+                break
+            if isinstance(chunk, unicode):
+                self.buffer += chunk
+            else:
+                self.buffer += self.text_decoder.decode(chunk)
+        return True
+
+    def peek(self):
+        """ Skips whitespace and returns the next character, or '' at end of file """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, expected_chars):
+        """ Consumes and returns the next character, which must be one of expected_chars """
+        char = self.peek()
+        if not char or char not in expected_chars:
+            raise JsonStreamError('Expected one of "%s" at position %d, found "%s"' % (
+                expected_chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def decode_value(self):
+        """ Decodes and returns the next JSON value """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # Value is incomplete -- grow the buffer geometrically so that large values
+                # are not re-parsed once per chunk
+                if not self.fill(min_size=len(self.buffer) - self.pos):
+                    raise JsonStreamError('Incomplete JSON value at end of file')
+                continue
+            if (isinstance(value, (int, long, float)) and not isinstance(value, bool) and not self.eof and
+                    (end == len(self.buffer) or self.buffer[end] in NUMBER_CHARS)):
+                # A number that is followed by the end of the buffer or by a character that can continue
+                # a number (e.g. "1." or "2.5e" split across chunks) is decoded again with more data
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+    def skip_value(self):
+        """ Consumes the next JSON value without decoding it """
+        char = self.peek()
+        if char not in '{[':
+            self.decode_value()
+            return
+        depth = 0
+        in_string = False
+        while True:
+            buffer_length = len(self.buffer)
+            pos = self.pos
+            while pos < buffer_length:
+                char = self.buffer[pos]
+                if in_string:
+                    if char == '\\':
+                        if pos + 1 >= buffer_length:
+                            break
+                        pos += 1
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = True
+                elif char in '{[':
+                    depth += 1
+                elif char in '}]':
+                    depth -= 1
+                    if not depth:
+                        self.pos = pos + 1
+                        return
+                pos += 1
+            self.pos = pos
+            if not self.fill():
+                raise JsonStreamError('Incomplete JSON value at end of file')
+
+    def iter_object_keys(self):
+        """ Consumes an object, yielding each key when the reader is positioned at its value """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.decode_value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def iter_array_values(self):
+        """ Consumes an array, yielding each decoded item """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode_value()
+            if self.expect(',]') == ']':
+                return
+
+
+def iter_arrays_items(input_file, keys, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields (key, item) for each item of the top-level arrays listed in keys, in document order
+    :param input_file: File-like object opened on a JSON object
+    :param keys: List of top-level keys whose array items to yield
+    :param chunk_size: Number of bytes to read at a time
+    """
+    reader = _JsonStreamReader(input_file, chunk_size=chunk_size)
+    for key in reader.iter_object_keys():
+        if key in keys and reader.peek() == '[':
+            for item in reader.iter_array_values():
+                yield key, item
+        else:
+            reader.skip_value()
+
+
+def iter_array_items(input_file, key, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Yields each item of the top-level array with the specified key """
+    for item_key, item in iter_arrays_items(input_file, [key], chunk_size=chunk_size):
+        yield item
+
+
+def load_object_members(input_file, skip_keys=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Returns a dictionary of the top-level members of a JSON object except those in skip_keys,
+    which are scanned without being decoded, e.g. to read an export's "type" without its concepts
+    """
+    skip_keys = skip_keys or []
+    reader = _JsonStreamReader(input_file, chunk_size=chunk_size)
+    members = {}
+    for key in reader.iter_object_keys():
+        if key in skip_keys:
+            reader.skip_value()
+        else:
+            members[key] = reader.decode_value()
+    return members
@@ -0,0 +1,292 @@
+"""
+Local content-addressed cache for OCL repository version exports.
+Usage:
+status_code, content = utils.oclexportcache.get_export_content(export_url, headers=headers)
+repo_export = utils.oclexportcache.load_export(repo_version_url, oclapitoken=token)
+
+Compressed exports are stored once per content digest under "blobs/", and each export URL
+has a small reference file under "refs/" pointing at the digest of its content. References are
+keyed by the export URL and a digest of the API token, so exports are never shared between
+tokens. Only exports of repository versions that OCL confirmed as released are served from the
+cache without contacting OCL. Any other export (HEAD, latest or unreleased versions, which can be
+deleted and recreated under the same URL) is revalidated with a conditional request using the
+ETag or Last-Modified date returned by OCL. Blobs are verified against their digest when read and
+the cache is kept under a maximum size by evicting the least recently used blobs.
+"""
+import os
+import json
+import hashlib
+import tempfile
+import zipfile
+from StringIO import StringIO
+import ocldev.oclexport
+import settings
+import httpsession
+
+
+# Default maximum size of the cache
+DEFAULT_MAX_SIZE_BYTES = 2 * 1024 * 1024 * 1024
+
+
+class OclExportCache(object):
+    """ On-disk cache of compressed OCL repository version exports keyed by export URL """
+
+    MUTABLE_REPO_VERSION_IDS = ['HEAD', 'latest']
+
+    def __init__(self, cache_dir='', max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.blob_dir = os.path.join(cache_dir, 'blobs')
+        self.ref_dir = os.path.join(cache_dir, 'refs')
+        for directory in [self.blob_dir, self.ref_dir]:
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    if not os.path.isdir(directory):
+                        raise
+
+    @staticmethod
+    def is_repo_version_export_url(export_url):
+        """
+        Returns True if the export URL refers to a specific repository version rather than to
+        HEAD or the latest version, e.g.
+        https://api.openconceptlab.org/orgs/PEPFAR/sources/DATIM-MOH-FY20/FY20.v1/export/
+        """
+        url_parts = export_url.rstrip('/').split('/')
+        return (len(url_parts) >= 2 and url_parts[-1] == 'export' and
+                url_parts[-2] not in OclExportCache.MUTABLE_REPO_VERSION_IDS)
+
+    @staticmethod
+    def get_digest(content):
+        return hashlib.sha256(content).hexdigest()
+
+    @staticmethod
+    def get_auth_digest(headers):
+        """ Returns a digest of the Authorization header, or '' if there is none """
+        authorization = (headers or {}).get('Authorization')
+        if not authorization:
+            return ''
+        return hashlib.sha256(authorization).hexdigest()
+
+    def _get_ref_path(self, export_url, headers=None):
+        ref_key = '%s\n%s' % (export_url, OclExportCache.get_auth_digest(headers))
+        return os.path.join(self.ref_dir, '%s.json' % hashlib.sha256(ref_key).hexdigest())
+
+    def _get_blob_path(self, digest):
+        return os.path.join(self.blob_dir, '%s.zip' % digest)
+
+    def _write_atomic(self, path, content):
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(handle, 'wb') as output_file:
+            output_file.write(content)
+        os.rename(temp_path, path)
+
+    def get_ref(self, export_url, headers=None):
+        """ Returns the cache reference for the export URL and token or None if not cached """
+        try:
+            with open(self._get_ref_path(export_url, headers=headers), 'rb') as input_file:
+                return json.load(input_file)
+        except (IOError, ValueError):
+            return None
+
+    def get(self, export_url, headers=None):
+        """
+        Returns the cached compressed export for the export URL and token, or None if it is not
+        cached or fails its integrity check. Corrupt entries are removed. The export is returned
+        whether or not it is trusted -- use get_trusted to read an export without revalidating it.
+        """
+        ref = self.get_ref(export_url, headers=headers)
+        if not ref:
+            return None
+        blob_path = self._get_blob_path(ref['digest'])
+        try:
+            with open(blob_path, 'rb') as input_file:
+                content = input_file.read()
+        except IOError:
+            self.remove(export_url, headers=headers)
+            return None
+        if OclExportCache.get_digest(content) != ref['digest']:
+            self.remove(export_url, headers=headers)
+            if os.path.isfile(blob_path):
+                os.remove(blob_path)
+            return None
+        os.utime(blob_path, None)
+        return content
+
+    def get_trusted(self, export_url, headers=None):
+        """
+        Returns the cached compressed export for the export URL and token if it can be used
+        without revalidation, i.e. it is an export of a repository version that OCL confirmed as
+        released when the export was cached. Returns None otherwise.
+        """
+        ref = self.get_ref(export_url, headers=headers)
+        if not ref or ref.get('released') is not True or not OclExportCache.is_repo_version_export_url(export_url):
+            return None
+        return self.get(export_url, headers=headers)
+
+    @staticmethod
+    def is_released_repo_version(export_url, headers=None, session=None):
+        """
+        Returns True if OCL confirms that the repository version of the export URL is released.
+        Returns False for HEAD and latest exports and if the repository version cannot be retrieved.
+        """
+        if not OclExportCache.is_repo_version_export_url(export_url):
+            return False
+        repo_version_url = export_url.rstrip('/')[:-len('export')]
+        try:
+            r = (session or httpsession.get_session()).get(repo_version_url, headers=headers)
+            return r.status_code == 200 and r.json().get('released') is True
+        except Exception:
+            return False
+
+    def put(self, export_url, content, etag=None, headers=None, session=None, last_modified=None):
+        """
+        Stores a compressed export for the export URL and token. The export is only cached if it
+        is a valid zip file containing "export.json". Whether the repository version is released
+        is confirmed with OCL and stored with the reference (see get_trusted).
+        Returns the content digest or None.
+        """
+        try:
+            zipref = zipfile.ZipFile(StringIO(content), 'r')
+            is_valid = 'export.json' in zipref.namelist() and zipref.testzip() is None
+            zipref.close()
+        except zipfile.BadZipfile:
+            is_valid = False
+        if not is_valid:
+            return None
+        digest = OclExportCache.get_digest(content)
+        blob_path = self._get_blob_path(digest)
+        if os.path.isfile(blob_path):
+            os.utime(blob_path, None)
+        else:
+            self._write_atomic(blob_path, content)
+        released = OclExportCache.is_released_repo_version(export_url, headers=headers, session=session)
+        self._write_atomic(self._get_ref_path(export_url, headers=headers), json.dumps({
+            'url': export_url, 'digest': digest, 'size': len(content), 'etag': etag,
+            'last_modified': last_modified, 'released': released}))
+        self.evict()
+        return digest
+
+    def remove(self, export_url, headers=None):
+        """ Removes the cache reference for the export URL and token """
+        ref_path = self._get_ref_path(export_url, headers=headers)
+        if os.path.isfile(ref_path):
+            os.remove(ref_path)
+
+    def remove_url_prefix(self, url_prefix):
+        """
+        Removes the cache references of all export URLs starting with url_prefix for all tokens,
+        e.g. the exports of an org that is deleted and recreated
+        """
+        for filename in os.listdir(self.ref_dir):
+            ref_path = os.path.join(self.ref_dir, filename)
+            try:
+                with open(ref_path, 'rb') as input_file:
+                    ref = json.load(input_file)
+                if ref.get('url', '').startswith(url_prefix):
+                    os.remove(ref_path)
+            except (IOError, OSError, ValueError):
+                continue
+
+    def evict(self):
+        """ Removes least recently used blobs until the cache is within max_size_bytes """
+        blobs = []
+        total_size = 0
+        for filename in os.listdir(self.blob_dir):
+            blob_path = os.path.join(self.blob_dir, filename)
+            try:
+                blob_stat = os.stat(blob_path)
+            except OSError:
+                continue
+            blobs.append((blob_stat.st_mtime, blob_stat.st_size, blob_path))
+            total_size += blob_stat.st_size
+        for blob_mtime, blob_size, blob_path in sorted(blobs):
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(blob_path)
+            except OSError:
+                pass
+            total_size -= blob_size
+
+    def get_export_content(self, export_url, headers=None, session=None):
+        """
+        Returns (status_code, content) for the export URL, using the cache where possible.
+        Exports of released repository versions are served from the cache without a request.
+        Other exports are revalidated with If-None-Match or If-Modified-Since. Exports retrieved
+        with status 200 are cached. Content is None for any status code other than 200.
+        """
+        session = session or httpsession.get_session()
+        content = self.get_trusted(export_url, headers=headers)
+        if content is not None:
+            return 200, content
+        request_headers = dict(headers or {})
+        ref = self.get_ref(export_url, headers=headers)
+        if ref and ref.get('etag'):
+            request_headers['If-None-Match'] = ref['etag']
+        elif ref and ref.get('last_modified'):
+            request_headers['If-Modified-Since'] = ref['last_modified']
+        r = session.get(export_url, headers=request_headers, allow_redirects=True)
+        if r.status_code == 304:
+            content = self.get(export_url, headers=headers)
+            if content is not None:
+                return 200, content
+            r = session.get(export_url, headers=headers, allow_redirects=True)
+        r.raise_for_status()
+        if r.status_code != 200:
+            return r.status_code, None
+        self.put(export_url, r.content, etag=r.headers.get('ETag'), headers=headers, session=session,
+                 last_modified=r.headers.get('Last-Modified'))
+        return r.status_code, r.content
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    Returns the shared OclExportCache. The location and size can be configured with
+    OCL_EXPORT_CACHE_DIR and OCL_EXPORT_CACHE_MAX_SIZE_BYTES in settings.
+    """
+    global _cache
+    if _cache is None:
+        cache_dir = getattr(settings, 'OCL_EXPORT_CACHE_DIR', '') or os.path.join(
+            settings.ROOT_DIR, 'data', 'ocl-export-cache')
+        max_size_bytes = getattr(settings, 'OCL_EXPORT_CACHE_MAX_SIZE_BYTES', DEFAULT_MAX_SIZE_BYTES)
+        _cache = OclExportCache(cache_dir=cache_dir, max_size_bytes=max_size_bytes)
+    return _cache
+
+
+def get_export_content(export_url, headers=None, session=None):
+    """ Returns (status_code, content) for the export URL using the shared cache """
+    return get_cache().get_export_content(export_url, headers=headers, session=session)
+
+
+def load_export(repo_version_url='', oclapitoken=''):
+    """
+    Cached equivalent of ocldev.oclexport.OclExportFactory.load_export: retrieves a repository
+    version export, decompresses and parses it in memory and returns it as an OclExport
+    """
+    oclapiheaders = {'Content-Type': 'application/json'}
+    if oclapitoken:
+        oclapiheaders['Authorization'] = 'Token ' + oclapitoken
+    repo_export_url = '%sexport/' % repo_version_url
+    status_code, content = get_export_content(repo_export_url, headers=oclapiheaders)
+    if status_code == 204:
+        raise ocldev.oclexport.OclExportNotAvailableError(
+            repo_export_url, 'Export at "%s" not available' % repo_export_url)
+    zipref = zipfile.ZipFile(StringIO(content), 'r')
+    try:
+        repo_export = json.loads(zipref.read('export.json'))
+    finally:
+        zipref.close()
+    return ocldev.oclexport.OclExport(repo_export)
+
+
+def load_latest_export(repo_url, oclapitoken=''):
+    """ Cached equivalent of ocldev.oclexport.OclExportFactory.load_latest_export """
+    repo_id = ocldev.oclexport.OclExportFactory.get_latest_version_id(repo_url, oclapitoken=oclapitoken)
+    if repo_id:
+        return load_export('%s%s/' % (repo_url, repo_id), oclapitoken=oclapitoken)
+    return None